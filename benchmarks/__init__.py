@@ -0,0 +1 @@
+"""Benchmarks of the inference and learning hot paths of mrftools."""
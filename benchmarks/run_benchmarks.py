@@ -0,0 +1,500 @@
+"""
+Benchmark suite for the inference and learning hot paths of mrftools.
+
+Run from the root of the repository with
+
+    python -m benchmarks.run_benchmarks --output results.json
+
+and compare against a previous run with
+
+    python -m benchmarks.run_benchmarks --output new.json --compare results.json
+
+Each benchmark runs on synthetic grid, chain, and random graphs at several sizes and cardinalities and reports the
+time per call or iteration, the peak memory allocated during one call, and, for inference, the number of iterations
+to convergence.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import mrftools
+from mrftools import *
+
+# directory containing the mrftools package, so child interpreters import the same copy regardless of the working
+# directory
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(mrftools.__file__)))
+
+# optional dependencies that importing mrftools should not load
+HEAVY_MODULES = ['matplotlib', 'PIL', 'scipy.optimize']
+
+IMPORT_SCRIPT = """
+import json, sys, time, tracemalloc
+if sys.argv[1] == 'memory':
+    tracemalloc.start()
+start = time.time()
+import mrftools
+elapsed = time.time() - start
+peak = tracemalloc.get_traced_memory()[1] if sys.argv[1] == 'memory' else 0
+print(json.dumps({'time': elapsed, 'peak_memory': peak, 'loaded': [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+MATRIX_INFERENCE_TYPES = [MatrixBeliefPropagator, MatrixTRBeliefPropagator, ConvexBeliefPropagator,
+                          MaxProductBeliefPropagator, MaxProductLinearProgramming]
+
+# inference classes that only support grid structures
+GRID_INFERENCE_TYPES = [GridBeliefPropagator]
+
+MAP_INFERENCE_TYPES = [MaxProductBeliefPropagator, MaxProductLinearProgramming, TRWSBeliefPropagator, GraphCutInference]
+
+
+def grid_edges(num_vars):
+    """
+    Generate the edges of a 4-connected square grid with approximately num_vars variables.
+
+    :param num_vars: approximate number of variables
+    :type num_vars: int
+    :return: tuple of the variable names and the list of edges
+    :rtype: tuple
+    """
+    length = int(np.ceil(np.sqrt(num_vars)))
+    variables = [(x, y) for x in range(length) for y in range(length)]
+    edges = [((x, y), (x + 1, y)) for x in range(length - 1) for y in range(length)]
+    edges += [((x, y), (x, y + 1)) for x in range(length) for y in range(length - 1)]
+    return variables, edges
+
+
+def chain_edges(num_vars):
+    """
+    Generate the edges of a chain.
+
+    :param num_vars: number of variables
+    :type num_vars: int
+    :return: tuple of the variable names and the list of edges
+    :rtype: tuple
+    """
+    variables = list(range(num_vars))
+    edges = [(i, i + 1) for i in range(num_vars - 1)]
+    return variables, edges
+
+
+def random_edges(num_vars, degree=4):
+    """
+    Generate the edges of a random graph with the given average degree.
+
+    :param num_vars: number of variables
+    :type num_vars: int
+    :param degree: average number of neighbors of each variable
+    :type degree: int
+    :return: tuple of the variable names and the list of edges
+    :rtype: tuple
+    """
+    variables = list(range(num_vars))
+    edges = set()
+    num_edges = min(num_vars * degree // 2, num_vars * (num_vars - 1) // 2)
+    while len(edges) < num_edges:
+        i, j = np.random.randint(num_vars, size=2)
+        if i != j:
+            edges.add((min(i, j), max(i, j)))
+    return variables, sorted(edges)
+
+
+GRAPH_TYPES = {'grid': grid_edges, 'chain': chain_edges, 'random': random_edges}
+
+
+def create_model(graph, num_vars, num_states, num_features=0, potts=False):
+    """
+    Create a random Markov net or log-linear model with the given structure.
+
+    :param graph: name of the graph type, one of the keys of GRAPH_TYPES
+    :type graph: str
+    :param num_vars: (approximate) number of variables
+    :type num_vars: int
+    :param num_states: cardinality of every variable
+    :type num_states: int
+    :param num_features: if positive, create a LogLinearModel with this many random unary and edge features
+    :type num_features: int
+    :param potts: if True, edge factors are random positive multiples of the identity, like the initial edge
+                    potentials of image segmentation models, instead of random matrices
+    :type potts: bool
+    :return: model with matrices not yet created
+    :rtype: MarkovNet
+    """
+    np.random.seed(0)
+    variables, edges = GRAPH_TYPES[graph](num_vars)
+
+    model = LogLinearModel() if num_features > 0 else MarkovNet()
+
+    for var in variables:
+        model.set_unary_factor(var, np.random.randn(num_states))
+        if num_features > 0:
+            model.set_unary_features(var, np.random.randn(num_features))
+
+    for edge in edges:
+        if potts:
+            model.set_edge_factor(edge, np.random.rand() * np.eye(num_states))
+        else:
+            model.set_edge_factor(edge, np.random.randn(num_states, num_states))
+        if num_features > 0:
+            model.set_edge_features(edge, np.random.randn(num_features))
+
+    model.tree_probabilities = dict((edge, 0.5) for edge in edges)
+
+    return model
+
+
+def measure(function, repeat=3):
+    """
+    Measure the best wall time of several calls of function, and the peak memory allocated during one more call.
+
+    :param function: function with no arguments
+    :param repeat: number of timed calls
+    :type repeat: int
+    :return: dict containing the best time in seconds and the peak memory in bytes
+    :rtype: dict
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'time': min(times), 'peak_memory': peak}
+
+
+def measure_import(mode='time'):
+    """
+    Import mrftools in a fresh interpreter.
+
+    :param mode: 'time' to only time the import, or 'memory' to also trace its peak memory, which slows it down
+    :type mode: str
+    :return: dict containing the import time, the peak memory, and which of HEAVY_MODULES were loaded
+    :rtype: dict
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([PACKAGE_ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT, mode] + HEAVY_MODULES, env=env)
+    return json.loads(output.decode())
+
+
+def bench_import(config):
+    """Benchmark the time to import mrftools and check that it does not load heavy optional dependencies."""
+    times = [measure_import()['time'] for _ in range(config['repeat'])]
+    result = measure_import('memory')
+    return [{'time': min(times), 'peak_memory': result['peak_memory'], 'heavy_modules_loaded': len(result['loaded'])}]
+
+
+def bench_create_matrices(config):
+    """Benchmark building the matrix representation of a model."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states)
+        result = measure(model.create_matrices)
+        result.update({'graph': graph, 'num_vars': num_vars, 'num_states': num_states})
+        results.append(result)
+    return results
+
+
+def bench_update_messages(config):
+    """Benchmark one message update and inference to convergence for each matrix inference class."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states)
+        model.create_matrices()
+        inference_types = MATRIX_INFERENCE_TYPES + (GRID_INFERENCE_TYPES if graph == 'grid' else [])
+        for inference_type in inference_types:
+            bp = inference_type(model)
+            result = measure(bp.update_messages, config['repeat'])
+
+            bp = inference_type(model)
+            bp.set_max_iter(config['max_iter'])
+            start = time.time()
+            bp.infer(display='off')
+            result['infer_time'] = time.time() - start
+            result['iterations'] = bp.num_iterations
+
+            result.update({'inference_type': inference_type.__name__, 'graph': graph, 'num_vars': num_vars,
+                           'num_states': num_states})
+            results.append(result)
+    return results
+
+
+def bench_threaded_updates(config):
+    """Benchmark one message update computed in parallel blocks on different numbers of threads."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states)
+        model.create_matrices()
+        for num_threads in config['num_threads']:
+            bp = MatrixBeliefPropagator(model)
+            bp.set_num_threads(num_threads)
+            result = measure(bp.update_messages, config['repeat'])
+            result.update({'num_threads': num_threads, 'graph': graph, 'num_vars': num_vars,
+                           'num_states': num_states})
+            results.append(result)
+    return results
+
+
+def bench_sum_messages(config):
+    """Benchmark summing messages into their receiving variables with the cached operator and with sparse_dot."""
+    from mrftools.MatrixBeliefPropagator import sparse_dot
+
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states)
+        model.create_matrices()
+        messages = np.random.randn(model.max_states, 2 * model.num_edges)
+
+        for method, function in [('sum_messages', lambda: model.sum_messages(messages)),
+                                 ('sparse_dot', lambda: sparse_dot(messages, model.message_to_map))]:
+            result = measure(function, config['repeat'])
+            result.update({'method': method, 'graph': graph, 'num_vars': num_vars, 'num_states': num_states})
+            results.append(result)
+    return results
+
+
+def bench_map_inference(config):
+    """Benchmark MAP inference on Potts models and record the log score of the inferred states."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states, potts=True)
+        model.create_matrices()
+        for inference_type in MAP_INFERENCE_TYPES:
+            def infer():
+                bp = inference_type(model)
+                bp.set_max_iter(config['max_iter'])
+                bp.infer(display='off')
+                return bp
+
+            result = measure(infer, config['repeat'])
+
+            bp = infer()
+            bp.load_beliefs()
+            states = dict((var, int(np.argmax(bp.var_beliefs[var]))) for var in model.variables)
+            result.update({'inference_type': inference_type.__name__, 'graph': graph, 'num_vars': num_vars,
+                           'num_states': num_states, 'score': model.evaluate_state(states),
+                           'iterations': bp.num_iterations})
+            results.append(result)
+    return results
+
+
+def bench_set_weights(config):
+    """Benchmark updating the potentials of a log-linear model from a new weight vector."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states, config['num_features'])
+        model.create_matrices()
+        weights = np.random.randn(model.weight_dim)
+
+        def set_new_weights():
+            # perturb the weights so that every call updates the potentials
+            weights[0] += 1.0
+            model.set_weights(weights)
+
+        result = measure(set_new_weights, config['repeat'])
+        result.update({'graph': graph, 'num_vars': num_vars, 'num_states': num_states,
+                       'num_features': config['num_features']})
+        results.append(result)
+    return results
+
+
+def bench_learner(config):
+    """Benchmark the learner objective and gradient at new weight vectors."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        learner = Learner(MatrixBeliefPropagator)
+        for i in range(config['num_examples']):
+            model = create_model(graph, num_vars, num_states, config['num_features'])
+            model.create_matrices()
+            labels = dict((var, np.random.randint(num_states)) for var in model.variables)
+            learner.add_data(labels, model)
+
+        weights = np.zeros(learner.weight_dim)
+
+        def objective():
+            weights[:] = 0.1 * np.random.randn(len(weights))
+            learner.subgrad_obj(weights)
+
+        def gradient():
+            learner.subgrad_grad(weights)
+
+        for name, function in [('objective', objective), ('gradient', gradient)]:
+            result = measure(function, config['repeat'])
+            result.update({'function': name, 'graph': graph, 'num_vars': num_vars, 'num_states': num_states,
+                           'num_examples': config['num_examples'], 'num_features': config['num_features']})
+            results.append(result)
+    return results
+
+
+def bench_compute_features(config):
+    """Benchmark computing image features of a random image."""
+    from PIL import Image
+
+    results = []
+    for size in config['image_sizes']:
+        np.random.seed(0)
+        img = Image.fromarray(np.random.randint(0, 256, (size, size, 3)).astype(np.uint8))
+        result = measure(lambda: ImageLoader.compute_features(img), config['repeat'])
+        result.update({'width': size, 'height': size})
+        results.append(result)
+    return results
+
+
+def bench_gibbs(config):
+    """Benchmark Gibbs sampling sweeps over all variables."""
+    results = []
+    for graph, num_vars, num_states in config['structures']:
+        model = create_model(graph, num_vars, num_states)
+        sampler = GibbsSampler(model)
+        sampler.init_states(0)
+        result = measure(sampler.update_states, config['repeat'])
+        result.update({'graph': graph, 'num_vars': num_vars, 'num_states': num_states})
+        results.append(result)
+    return results
+
+
+BENCHMARKS = {
+    'import': bench_import,
+    'create_matrices': bench_create_matrices,
+    'update_messages': bench_update_messages,
+    'sum_messages': bench_sum_messages,
+    'threaded_updates': bench_threaded_updates,
+    'map_inference': bench_map_inference,
+    'set_weights': bench_set_weights,
+    'learner': bench_learner,
+    'compute_features': bench_compute_features,
+    'gibbs': bench_gibbs,
+}
+
+FULL_CONFIG = {
+    'structures': [(graph, num_vars, num_states) for graph in ['grid', 'chain', 'random']
+                   for num_vars in [100, 2500, 10000] for num_states in [2, 8]],
+    'image_sizes': [16, 64],
+    'num_features': 16,
+    'num_examples': 4,
+    'num_threads': [1, 2, 4],
+    'max_iter': 300,
+    'repeat': 5,
+}
+
+QUICK_CONFIG = {
+    'structures': [(graph, 64, 3) for graph in ['grid', 'chain', 'random']],
+    'image_sizes': [8],
+    'num_features': 4,
+    'num_examples': 2,
+    'num_threads': [1, 2],
+    'max_iter': 30,
+    'repeat': 1,
+}
+
+
+def get_metadata():
+    """
+    Describe the environment the benchmarks ran in.
+
+    :return: dict containing the current git commit, the Python and NumPy versions, and the time
+    :rtype: dict
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'time': time.time()}
+
+
+def run(names=None, quick=False):
+    """
+    Run benchmarks.
+
+    :param names: names of the benchmarks to run, or None to run all of them
+    :type names: list
+    :param quick: if True, run tiny configurations that only check the benchmarks work
+    :type quick: bool
+    :return: dict containing the metadata and a list of result records for each benchmark
+    :rtype: dict
+    """
+    config = QUICK_CONFIG if quick else FULL_CONFIG
+    results = {'metadata': get_metadata(), 'benchmarks': dict()}
+
+    for name in names or sorted(BENCHMARKS):
+        results['benchmarks'][name] = BENCHMARKS[name](config)
+
+    return results
+
+
+def _record_key(record):
+    """Identify a benchmark record by its configuration (every entry that is not a measurement)."""
+    return tuple(sorted((k, v) for k, v in record.items()
+                        if k not in ('time', 'peak_memory', 'infer_time', 'iterations', 'score')))
+
+
+def compare(new_results, old_results):
+    """
+    Compute the ratio of new to old times for every benchmark record present in both sets of results.
+
+    :param new_results: results returned by run
+    :type new_results: dict
+    :param old_results: results returned by run, e.g., loaded from the JSON file of a previous commit
+    :type old_results: dict
+    :return: list of (benchmark name, configuration, old time, new time, ratio) tuples
+    :rtype: list
+    """
+    comparison = []
+    for name, records in new_results['benchmarks'].items():
+        old_records = dict((_record_key(r), r) for r in old_results['benchmarks'].get(name, []))
+        for record in records:
+            old_record = old_records.get(_record_key(record))
+            if old_record is not None and old_record['time'] > 0:
+                comparison.append((name, dict(_record_key(record)), old_record['time'], record['time'],
+                                   record['time'] / old_record['time']))
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark mrftools inference and learning.")
+    parser.add_argument('--output', help="path of the JSON file to save results to")
+    parser.add_argument('--compare', help="path of a JSON file of previous results to compare against")
+    parser.add_argument('--quick', action='store_true', help="run tiny configurations")
+    parser.add_argument('benchmarks', nargs='*', help="benchmarks to run, from %s (default: all)" % sorted(BENCHMARKS))
+    args = parser.parse_args(argv)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+    results = run(args.benchmarks, args.quick)
+
+    for name, records in results['benchmarks'].items():
+        for record in records:
+            config = ", ".join("%s=%s" % item for item in _record_key(record))
+            print("%-16s %-70s %10.6f s %12d B" % (name, config, record['time'], record['peak_memory']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)
+        print("\nRatio of new to old time (above 1.0 is slower):")
+        for name, config, old_time, new_time, ratio in compare(results, old_results):
+            config = ", ".join("%s=%s" % item for item in sorted(config.items()))
+            print("%-16s %-70s %6.2fx" % (name, config, ratio))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
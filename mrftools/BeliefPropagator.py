@@ -1,8 +1,12 @@
 """BeliefPropagator class."""
+import logging
+
 import numpy as np
 
 from .Inference import Inference
 
+logger = logging.getLogger(__name__)
+
 
 class BeliefPropagator(Inference):
     """
@@ -163,27 +167,33 @@ class BeliefPropagator(Inference):
         
         :param tolerance: the minimum amount that the messages can change while message passing can be considered not 
                             converged
-        :param display: string parameter indicating how much to display. Options are 'full' and 'iter'
-                        'full' prints the energy functional and dual objective each iteration, 
+        :param display: string parameter indicating how much to log. Options are 'full', 'iter', 'final', and 'off'.
+                        'full' logs the energy functional and dual objective each iteration at DEBUG level, 
                                 which requires extra computation
-                        'iter' prints just the change in messages each iteration
+                        'iter' logs just the change in messages each iteration at DEBUG level
+                        'final' logs only the number of iterations at INFO level, which 'full' and 'iter' also do
+                        Nothing is computed or formatted for display unless this module's logger is enabled.
         :return: None
         """
+        log_iter = display in ('full', 'iter') and logger.isEnabledFor(logging.DEBUG)
+        log_final = display in ('full', 'iter', 'final') and logger.isEnabledFor(logging.INFO)
+
         change = np.inf
         iteration = 0
         while change > tolerance and iteration < self.max_iter:
             change = self.update_messages()
-            if display == "full":
+            if log_iter and display == "full":
                 disagreement = self.compute_inconsistency()
                 energy_func = self.compute_energy_functional()
                 dual_obj = self.compute_dual_objective()
-                print("Iteration %d, change in messages %f. Calibration disagreement: %f, energy functional: %f, "
-                      "dual obj: %f" % (iteration, change, disagreement, energy_func, dual_obj))
-            elif display == "iter":
-                print("Iteration %d, change in messages %f." % (iteration, change))
+                logger.debug("Iteration %d, change in messages %f. Calibration disagreement: %f, "
+                             "energy functional: %f, dual obj: %f",
+                             iteration, change, disagreement, energy_func, dual_obj)
+            elif log_iter:
+                logger.debug("Iteration %d, change in messages %f.", iteration, change)
             iteration += 1
-        if display == 'final' or display == 'full' or display == 'iter':
-            print("Belief propagation finished in %d iterations." % iteration)
+        if log_final:
+            logger.info("Belief propagation finished in %d iterations.", iteration)
 
     def compute_bethe_entropy(self):
         """
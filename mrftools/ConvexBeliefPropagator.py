@@ -1,7 +1,7 @@
 """Convexified Belief Propagation Class"""
 import numpy as np
 
-from .MatrixBeliefPropagator import MatrixBeliefPropagator, logsumexp, sparse_dot
+from .MatrixBeliefPropagator import MatrixBeliefPropagator, logsumexp
 
 
 class ConvexBeliefPropagator(MatrixBeliefPropagator):
@@ -71,7 +71,11 @@ class ConvexBeliefPropagator(MatrixBeliefPropagator):
             self.unary_coefficients[self.mn.var_index[edge[0]]] += self.edge_counting_numbers[i]
             self.unary_coefficients[self.mn.var_index[edge[1]]] += self.edge_counting_numbers[i]
 
-    def compute_bethe_entropy(self):
+        self.invalidate_beliefs()
+
+    def _compute_bethe_entropy(self):
+        self.compute_pairwise_beliefs()
+
         if self.fully_conditioned:
             entropy = 0
         else:
@@ -81,34 +85,46 @@ class ConvexBeliefPropagator(MatrixBeliefPropagator):
                                (np.nan_to_num(self.belief_mat) * np.exp(self.belief_mat)))
         return entropy
 
-    def update_messages(self):
+    def update_messages(self, compute_change=True):
         self.compute_beliefs()
 
-        adjusted_message_prod = self.mn.edge_pot_tensor - np.hstack((self.message_mat[:, self.mn.num_edges:],
-                                                                     self.message_mat[:, :self.mn.num_edges]))
-        adjusted_message_prod /= self.edge_counting_numbers
-        adjusted_message_prod += self.belief_mat[:, self.mn.message_from]
+        return self._update_message_blocks(compute_change, self.belief_mat)
+
+    def _compute_message_block(self, start, stop, beliefs):
+        counting_numbers = self.edge_counting_numbers[start:stop]
+
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, start:stop] - self._reversed_messages(start, stop)
+        adjusted_message_prod /= counting_numbers
+        adjusted_message_prod += beliefs[:, self.mn.message_from[start:stop]]
 
-        messages = np.squeeze(logsumexp(adjusted_message_prod, 1)) * self.edge_counting_numbers
-        messages = np.nan_to_num(messages - messages.max(0))
+        messages = logsumexp(adjusted_message_prod, 1).reshape((self.mn.max_states, stop - start)) * counting_numbers
+        return np.nan_to_num(messages - messages.max(0))
 
-        change = np.sum(np.abs(messages - self.message_mat))
+    def _compute_messages(self, indices):
+        variables = self.mn.message_from[indices]
+        beliefs = self.mn.unary_mat[:, variables] + self.augmented_mat[:, variables] + self._sum_incoming(variables)
+        beliefs /= self.unary_coefficients[variables].T
+        beliefs -= logsumexp(beliefs, 0)
 
-        self.message_mat = messages
+        reverse = (indices + self.mn.num_edges) % (2 * self.mn.num_edges)
+        counting_numbers = self.edge_counting_numbers[indices]
+        adjusted_message_prod = (self.mn.edge_pot_tensor[:, :, indices] - self.message_mat[:, reverse]) / \
+            counting_numbers + beliefs
 
-        return change
+        messages = logsumexp(adjusted_message_prod, 1).reshape((self.mn.max_states, len(indices))) * counting_numbers
+        return np.nan_to_num(messages - messages.max(0))
 
-    def compute_beliefs(self):
+    def _compute_beliefs(self):
         if not self.fully_conditioned:
             self.belief_mat = self.mn.unary_mat + self.augmented_mat
-            self.belief_mat += sparse_dot(self.message_mat, self.mn.message_to_map)
+            self.belief_mat += self.mn.sum_messages(self.message_mat)
 
             self.belief_mat /= self.unary_coefficients.T
             log_z = logsumexp(self.belief_mat, 0)
 
             self.belief_mat = self.belief_mat - log_z
 
-    def compute_pairwise_beliefs(self):
+    def _compute_pairwise_beliefs(self):
         if not self.fully_conditioned:
             adjusted_message_prod = self.belief_mat[:, self.mn.message_from] \
                                     - np.nan_to_num(np.hstack((self.message_mat[:, self.mn.num_edges:],
@@ -8,6 +8,8 @@ class EM(Learner):
     """
     def __init__(self, inference_type):
         super(EM, self).__init__(inference_type)
+        # weights of the most recent E-step, which are the starting point of the current M-step
+        self.e_step_weights = None
 
     def learn(self, weights, optimizer=ada_grad, callback=None, opt_args=None):
         """
@@ -24,16 +26,37 @@ class EM(Learner):
         old_weights = np.inf
         new_weights = weights
         self.start_time = time.time()
+        # a checkpoint is saved during an M-step, so resuming continues that M-step with the restored E-step results
+        resuming = self.resume_state is not None
         while not np.allclose(old_weights, new_weights, rtol=1e-4, atol=1e-5):
-            old_weights = new_weights
-            self.e_step(new_weights)
+            if resuming:
+                old_weights = self.e_step_weights
+                resuming = False
+            else:
+                old_weights = new_weights
+                self.e_step(new_weights)
             new_weights = self.m_step(new_weights, optimizer, callback, opt_args)
 
+        self._finish_learning()
         return new_weights
 
     def e_step(self, weights):
         self.label_expectations = self.calculate_expectations(weights, self.conditioned_belief_propagators, True)
+        self.e_step_weights = np.array(weights, copy=True)
+        self.clear_cache()
 
     def m_step(self, weights, optimizer=ada_grad, callback=None, opt_args=None):
-        res = optimizer(self.objective, self.gradient, weights, args=opt_args, callback=callback)
+        func, grad = self.cached_functions(self.objective)
+        opt_args, callback = self._checkpointing(opt_args, callback)
+        res = optimizer(func, grad, weights, args=opt_args, callback=callback)
         return res
+
+    def _checkpoint_arrays(self):
+        arrays = super(EM, self)._checkpoint_arrays()
+        if self.e_step_weights is not None:
+            arrays['e_step_weights'] = self.e_step_weights
+        return arrays
+
+    def _restore_checkpoint_arrays(self, arrays):
+        super(EM, self)._restore_checkpoint_arrays(arrays)
+        self.e_step_weights = arrays.get('e_step_weights')
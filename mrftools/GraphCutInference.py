@@ -0,0 +1,254 @@
+"""Class to run graph-cut MAP inference with min-cut and move-making algorithms."""
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow, breadth_first_order
+
+from .MatrixBeliefPropagator import MatrixBeliefPropagator
+
+# the max-flow routine only accepts integer capacities, so costs are scaled so their total fits in this range
+MAX_CAPACITY = 2 ** 30
+
+
+class GraphCutInference(MatrixBeliefPropagator):
+    """
+    Class to find the most likely state of a MarkovNet with graph cuts. Models whose variables all have two states are
+    solved with a single minimum cut, which is exact when every edge potential is submodular (i.e., each edge prefers
+    agreement: phi(0, 0) + phi(1, 1) >= phi(0, 1) + phi(1, 0)). Models with more states are solved with
+    alpha-expansion moves, which stay within a constant factor of the optimum for metric edge potentials such as
+    Potts potentials, or with alpha-beta-swap moves, which only require a semi-metric. Each move is a binary problem
+    solved as a minimum cut, and a move is only accepted if it improves the score of the labeling, so non-metric
+    potentials are handled approximately without ever making the labeling worse.
+
+    Each call of update_messages sweeps over every expansion label (or every pair of swap labels) and returns the
+    improvement in the log score of the labeling, so infer runs sweeps until no move improves the labeling by more than
+    the tolerance. The result is stored as one-hot log beliefs in belief_mat and pair_belief_tensor, in the same format
+    as MaxProductBeliefPropagator. The labeling is kept between calls of infer to warm-start later inference.
+    """
+    def __init__(self, markov_net, method='expansion'):
+        """
+        Initialize a graph-cut inference object.
+
+        :param markov_net: MarkovNet object encoding the probability distribution
+        :type markov_net: MarkovNet
+        :param method: move-making algorithm for variables with more than two states, either 'expansion' or 'swap'
+        :type method: str
+        """
+        assert method in ('expansion', 'swap'), "Unknown graph-cut method %s" % repr(method)
+        self.labels = None
+        super(GraphCutInference, self).__init__(markov_net)
+        self.method = method
+
+    def initialize_messages(self):
+        """
+        Initialize messages to zeros and discard the current labeling, so the next inference starts from the states
+        that maximize the unary potentials.
+
+        :return: None
+        """
+        super(GraphCutInference, self).initialize_messages()
+        self.labels = None
+
+    def _costs(self):
+        """
+        Compute the unary and pairwise costs, which are the negated log potentials, with conditioning applied.
+
+        :return: tuple of the (max_states, num_variables) unary cost matrix and the (max_states, max_states, num_edges)
+                    pairwise cost tensor indexed by the states of message_from and message_to of each forward message
+        :rtype: tuple
+        """
+        unary_cost = -(self.mn.unary_mat + self.augmented_mat)
+        pair_cost = -self.mn.edge_pot_tensor[:, :, self.mn.num_edges:]
+        return unary_cost, pair_cost
+
+    def _validate_labels(self, unary_cost):
+        """
+        Initialize the labeling, or reset the labels of variables whose current state became impossible (e.g., after
+        conditioning), to the states with the lowest unary cost.
+
+        :param unary_cost: unary cost matrix
+        :type unary_cost: ndarray
+        :return: None
+        """
+        best = unary_cost.argmin(0)
+        if self.labels is None:
+            self.labels = best
+        else:
+            invalid = np.isinf(unary_cost[self.labels, np.arange(len(self.labels))])
+            self.labels[invalid] = best[invalid]
+
+    def labeling_cost(self, labels, unary_cost, pair_cost):
+        """
+        Compute the cost of a labeling, i.e., the negated log score of the state it represents.
+
+        :param labels: array of the state index of each variable
+        :type labels: ndarray
+        :param unary_cost: unary cost matrix
+        :type unary_cost: ndarray
+        :param pair_cost: pairwise cost tensor
+        :type pair_cost: ndarray
+        :return: the total cost of the labeling
+        :rtype: float
+        """
+        num_edges = self.mn.num_edges
+        from_labels = labels[self.mn.message_from[:num_edges]]
+        to_labels = labels[self.mn.message_to[:num_edges]]
+
+        return unary_cost[labels, np.arange(len(labels))].sum() + \
+            pair_cost[from_labels, to_labels, np.arange(num_edges)].sum()
+
+    def _solve_move(self, free, label0, label1, unary_cost, pair_cost):
+        """
+        Find the best move in which each free variable takes either label0 or label1 and every other variable keeps its
+        current label. The move is a binary problem, which is solved exactly by a minimum cut if all its pairwise terms
+        are submodular. Non-submodular terms are truncated.
+
+        :param free: Boolean array indicating which variables may change
+        :type free: ndarray
+        :param label0: array of the first candidate label of each variable
+        :type label0: ndarray
+        :param label1: array of the second candidate label of each variable
+        :type label1: ndarray
+        :param unary_cost: unary cost matrix
+        :type unary_cost: ndarray
+        :param pair_cost: pairwise cost tensor
+        :type pair_cost: ndarray
+        :return: the labeling after the move
+        :rtype: ndarray
+        """
+        labels = self.labels.copy()
+        free_vars = np.nonzero(free)[0]
+        num_free = len(free_vars)
+        if num_free == 0:
+            return labels
+
+        # index of each free variable among the nodes of the cut graph
+        node = np.zeros(len(labels), dtype=np.intp)
+        node[free_vars] = np.arange(num_free)
+
+        cost0 = unary_cost[label0[free_vars], free_vars].copy()
+        cost1 = unary_cost[label1[free_vars], free_vars].copy()
+
+        edges = np.arange(self.mn.num_edges)
+        var_from = self.mn.message_from[:self.mn.num_edges]
+        var_to = self.mn.message_to[:self.mn.num_edges]
+        free_from = free[var_from]
+        free_to = free[var_to]
+
+        # edges with one free end add their cost given the fixed end's label to the free variable's unary costs
+        e = edges[free_from & ~free_to]
+        fixed_labels = labels[var_to[e]]
+        cost0 += np.bincount(node[var_from[e]], pair_cost[label0[var_from[e]], fixed_labels, e], minlength=num_free)
+        cost1 += np.bincount(node[var_from[e]], pair_cost[label1[var_from[e]], fixed_labels, e], minlength=num_free)
+
+        e = edges[free_to & ~free_from]
+        fixed_labels = labels[var_from[e]]
+        cost0 += np.bincount(node[var_to[e]], pair_cost[fixed_labels, label0[var_to[e]], e], minlength=num_free)
+        cost1 += np.bincount(node[var_to[e]], pair_cost[fixed_labels, label1[var_to[e]], e], minlength=num_free)
+
+        # decompose each pairwise term between free variables into unary terms and a cut edge
+        e = edges[free_from & free_to]
+        i = var_from[e]
+        j = var_to[e]
+        a = pair_cost[label0[i], label0[j], e]
+        b = pair_cost[label0[i], label1[j], e]
+        c = pair_cost[label1[i], label0[j], e]
+        d = pair_cost[label1[i], label1[j], e]
+
+        cost1 += np.bincount(node[i], c - a, minlength=num_free)
+        cost1 += np.bincount(node[j], d - c, minlength=num_free)
+        weights = np.maximum(b + c - a - d, 0)
+
+        difference = cost1 - cost0
+        total = np.abs(difference).sum() + weights.sum()
+        if not np.isfinite(total) or total == 0:
+            return labels
+        scale = MAX_CAPACITY / total
+
+        # variables on the source side of the cut take label0, and variables on the sink side take label1
+        source = num_free
+        sink = num_free + 1
+        to_sink = difference < 0
+        terminals = np.arange(num_free)
+        rows = np.concatenate((node[i], np.where(to_sink, terminals, source)))
+        cols = np.concatenate((node[j], np.where(to_sink, sink, terminals)))
+        capacities = np.rint(scale * np.concatenate((weights, np.abs(difference)))).astype(np.int32)
+
+        keep = capacities > 0
+        graph = csr_matrix((capacities[keep], (rows[keep], cols[keep])), shape=(num_free + 2, num_free + 2))
+
+        flow = maximum_flow(graph, source, sink).flow
+        residual = (graph - flow).tocsr()
+        residual.data[residual.data < 0] = 0
+        residual.eliminate_zeros()
+
+        source_side = breadth_first_order(residual, source, directed=True, return_predecessors=False)
+
+        take_label1 = np.ones(num_free + 2, dtype=bool)
+        take_label1[source_side] = False
+        take_label1 = take_label1[:num_free]
+
+        labels[free_vars] = np.where(take_label1, label1[free_vars], label0[free_vars])
+        return labels
+
+    def _moves(self, unary_cost):
+        """
+        Generate the moves of one sweep.
+
+        :param unary_cost: unary cost matrix, used to exclude moves to impossible states
+        :type unary_cost: ndarray
+        :return: generator of (free, label0, label1) tuples describing each move
+        """
+        num_vars = len(self.labels)
+        possible = np.isfinite(unary_cost)
+
+        if self.mn.max_states == 2:
+            # a binary model is solved by a single cut over all variables
+            yield possible.all(0), np.zeros(num_vars, dtype=np.intp), np.ones(num_vars, dtype=np.intp)
+        elif self.method == 'expansion':
+            for alpha in range(self.mn.max_states):
+                free = (self.labels != alpha) & possible[alpha]
+                yield free, self.labels, alpha * np.ones(num_vars, dtype=np.intp)
+        else:
+            for alpha in range(self.mn.max_states):
+                for beta in range(alpha + 1, self.mn.max_states):
+                    free = ((self.labels == alpha) | (self.labels == beta)) & possible[alpha] & possible[beta]
+                    yield free, alpha * np.ones(num_vars, dtype=np.intp), beta * np.ones(num_vars, dtype=np.intp)
+
+    def update_messages(self, compute_change=True):
+        """
+        Run one sweep of graph-cut moves and keep each move that improves the labeling.
+
+        :param compute_change: ignored, since the improvement is always computed
+        :return: the decrease in the cost of the labeling during the sweep
+        :rtype: float
+        """
+        unary_cost, pair_cost = self._costs()
+        self._validate_labels(unary_cost)
+
+        start_cost = current_cost = self.labeling_cost(self.labels, unary_cost, pair_cost)
+
+        for free, label0, label1 in self._moves(unary_cost):
+            labels = self._solve_move(free, label0, label1, unary_cost, pair_cost)
+            cost = self.labeling_cost(labels, unary_cost, pair_cost)
+            if cost < current_cost:
+                self.labels = labels
+                current_cost = cost
+
+        self.invalidate_beliefs()
+        self.compute_beliefs()
+
+        if not np.isfinite(start_cost):
+            return np.inf if np.isfinite(current_cost) else 0
+        return start_cost - current_cost
+
+    def _compute_beliefs(self):
+        self._validate_labels(-(self.mn.unary_mat + self.augmented_mat))
+
+        self.belief_mat = -np.inf * np.ones((self.mn.max_states, len(self.labels)))
+        self.belief_mat[self.labels, np.arange(len(self.labels))] = 0
+
+    def _compute_pairwise_beliefs(self):
+        num_edges = self.mn.num_edges
+        self.pair_belief_tensor = -np.inf * np.ones((self.mn.max_states, self.mn.max_states, num_edges))
+        self.pair_belief_tensor[self.labels[self.mn.message_from[:num_edges]],
+                                self.labels[self.mn.message_to[:num_edges]], np.arange(num_edges)] = 0
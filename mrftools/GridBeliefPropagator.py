@@ -0,0 +1,230 @@
+"""Class to run belief propagation on 4-connected grid models with array shifts."""
+import numpy as np
+
+from .MatrixBeliefPropagator import MatrixBeliefPropagator, logsumexp
+
+
+class GridBeliefPropagator(MatrixBeliefPropagator):
+    """
+    Class to run sum-product belief propagation on grid-structured models, such as those created by
+    ImageLoader.create_model. Variables must be the (x, y) pixel coordinates of a width-by-height image, and each pixel
+    must be connected to its horizontal and vertical neighbors.
+
+    Instead of gathering beliefs through message_from and summing messages with the sparse message_to_map, messages are
+    stored as four directional arrays of shape (max_states, width, height) (rightward, leftward, downward, and upward),
+    and each update combines them with slice shifts. The message matrix used by the rest of MatrixBeliefPropagator is
+    assembled from the directional arrays only when it is accessed, so this class is a drop-in replacement that
+    produces the same beliefs, feature expectations, and energy functional as MatrixBeliefPropagator.
+
+    Adaptive damping is applied through the generic message update, so it does not benefit from the grid layout. The
+    grid update runs in a single block, so set_num_threads only affects updates with adaptive damping.
+    """
+    def __init__(self, markov_net):
+        """
+        Initialize a grid belief propagator.
+
+        :param markov_net: MarkovNet object encoding the probability distribution of a grid
+        :type markov_net: MarkovNet
+        """
+        if not markov_net.matrix_mode:
+            markov_net.create_matrices()
+
+        self._grid_messages = None
+        self._message_mat = None
+        self._set_grid(markov_net)
+
+        # the directional potential tensors and unary grid, with the state they were computed from
+        self._grid_potentials = None
+        self._grid_potential_version = None
+        self._grid_unary = None
+        self._grid_unary_state = None
+
+        super(GridBeliefPropagator, self).__init__(markov_net)
+
+    def _set_grid(self, markov_net):
+        """
+        Find the grid layout of the model's variables and the message index of each directional message.
+
+        :param markov_net: MarkovNet in matrix mode
+        :type markov_net: MarkovNet
+        :return: None
+        """
+        pixels = markov_net.var_list
+        assert all(isinstance(pixel, tuple) and len(pixel) == 2 for pixel in pixels), \
+            "Grid belief propagation requires variables named by (x, y) coordinates"
+
+        self.width = max(pixel[0] for pixel in pixels) + 1
+        self.height = max(pixel[1] for pixel in pixels) + 1
+        assert len(pixels) == self.width * self.height and \
+            markov_net.num_edges == (self.width - 1) * self.height + self.width * (self.height - 1), \
+            "Grid belief propagation requires a complete 4-connected grid"
+
+        self.pixel_index = np.zeros((self.width, self.height), dtype=np.intp)
+        for pixel, i in markov_net.var_index.items():
+            self.pixel_index[pixel] = i
+
+        num_edges = markov_net.num_edges
+
+        def message_number(var, neighbor):
+            """Find the index of the message from var to neighbor."""
+            if (var, neighbor) in markov_net.message_index:
+                return markov_net.message_index[(var, neighbor)]
+            assert (neighbor, var) in markov_net.message_index, \
+                "Grid belief propagation requires an edge between %s and %s" % (repr(var), repr(neighbor))
+            return markov_net.message_index[(neighbor, var)] + num_edges
+
+        horizontal = [((x, y), (x + 1, y)) for x in range(self.width - 1) for y in range(self.height)]
+        vertical = [((x, y), (x, y + 1)) for x in range(self.width) for y in range(self.height - 1)]
+
+        # messages are stored in one (max_states, 2 * num_edges) array whose columns hold the rightward, leftward,
+        # downward, and upward messages in turn, so each direction is a reshaped view of a block of columns
+        self.grid_order = np.array([message_number(s, t) for s, t in horizontal] +
+                                   [message_number(t, s) for s, t in horizontal] +
+                                   [message_number(s, t) for s, t in vertical] +
+                                   [message_number(t, s) for s, t in vertical], dtype=np.intp)
+
+        num_horizontal = len(horizontal)
+        num_vertical = len(vertical)
+        self.grid_blocks = [(0, num_horizontal, (self.width - 1, self.height)),
+                            (num_horizontal, 2 * num_horizontal, (self.width - 1, self.height)),
+                            (2 * num_horizontal, 2 * num_horizontal + num_vertical, (self.width, self.height - 1)),
+                            (2 * num_horizontal + num_vertical, 2 * num_edges, (self.width, self.height - 1))]
+
+    def _directions(self, grid_mat):
+        """
+        Split a matrix in the grid message order into views of its rightward, leftward, downward, and upward blocks.
+
+        :param grid_mat: (max_states, 2 * num_edges) matrix in the order of grid_order
+        :type grid_mat: ndarray
+        :return: list of the four directional views of shape (max_states, width - 1, height) for horizontal messages
+                    and (max_states, width, height - 1) for vertical messages
+        :rtype: list
+        """
+        return [grid_mat[:, start:stop].reshape((grid_mat.shape[0],) + shape) for start, stop, shape in self.grid_blocks]
+
+    @property
+    def message_mat(self):
+        """
+        Message matrix in the layout used by MatrixBeliefPropagator, assembled from the grid-ordered messages. The
+        same array is returned until the messages change.
+        """
+        if self._message_mat is None and self._grid_messages is not None:
+            self._message_mat = np.empty(self._grid_messages.shape)
+            self._message_mat[:, self.grid_order] = self._grid_messages
+        return self._message_mat
+
+    @message_mat.setter
+    def message_mat(self, messages):
+        self._message_mat = messages
+        self._grid_messages = None if messages is None else messages[:, self.grid_order]
+
+    def _update_grid_potentials(self):
+        """
+        Reorder the edge potentials into the grid message order if they changed since they were last reordered.
+
+        :return: None
+        """
+        if self._grid_potential_version != self.mn.potential_version:
+            self._grid_potentials = self.mn.edge_pot_tensor[:, :, self.grid_order]
+
+            # exponentiated potentials, shifted by each edge's largest potential, which normalization cancels
+            with np.errstate(invalid='ignore', under='ignore'):
+                self._grid_exp_potentials = np.exp(self._grid_potentials -
+                                                   np.nan_to_num(self._grid_potentials.max((0, 1))))
+
+            self._grid_potential_version = self.mn.potential_version
+
+    def _compute_grid_beliefs(self):
+        """
+        Compute the normalized unary log beliefs of every pixel from the directional messages.
+
+        :return: (max_states, width, height) array of log beliefs
+        :rtype: ndarray
+        """
+        state = (self.mn.potential_version, self.augmented_version)
+        if self._grid_unary_state != state:
+            self._grid_unary = (self.mn.unary_mat + self.augmented_mat)[:, self.pixel_index]
+            self._grid_unary_state = state
+
+        right, left, down, up = self._directions(self._grid_messages)
+
+        beliefs = self._grid_unary.copy()
+        beliefs[:, 1:, :] += right
+        beliefs[:, :-1, :] += left
+        beliefs[:, :, 1:] += down
+        beliefs[:, :, :-1] += up
+
+        beliefs -= logsumexp(beliefs, 0)
+
+        return beliefs
+
+    def _compute_beliefs(self):
+        if not self.fully_conditioned:
+            beliefs = self._compute_grid_beliefs()
+            self.belief_mat = np.empty((self.mn.max_states, len(self.mn.variables)))
+            self.belief_mat[:, self.pixel_index] = beliefs
+
+    def update_messages(self, compute_change=True):
+        """
+        Update all messages between pixels with slice shifts of the directional message arrays.
+
+        :param compute_change: Boolean value of whether to measure the change in messages. If False, the change is not
+                                computed and np.inf is returned.
+        :return: the float change in messages from previous iteration.
+        """
+        if self.adaptive_damping:
+            return super(GridBeliefPropagator, self).update_messages(compute_change)
+
+        self._update_grid_potentials()
+        beliefs = self._compute_grid_beliefs()
+        right, left, down, up = self._directions(self._grid_messages)
+
+        # each message combines its sender's belief with everything except the message coming back along its edge
+        adjusted = np.empty(self._grid_messages.shape)
+        adjusted_right, adjusted_left, adjusted_down, adjusted_up = self._directions(adjusted)
+        np.subtract(beliefs[:, :-1, :], left, out=adjusted_right)
+        np.subtract(beliefs[:, 1:, :], right, out=adjusted_left)
+        np.subtract(beliefs[:, :, :-1], up, out=adjusted_down)
+        np.subtract(beliefs[:, :, 1:], down, out=adjusted_up)
+
+        # log-sum-exp as a product with the exponentiated potentials, so only the beliefs are exponentiated
+        with np.errstate(divide='ignore', invalid='ignore', under='ignore', over='ignore'):
+            scaled = np.exp(adjusted - np.nan_to_num(adjusted.max(0)))
+            # einsum writes its result in column-major order, which makes the reductions over states below slow
+            messages = np.log(np.ascontiguousarray(np.einsum('jim,im->jm', self._grid_exp_potentials, scaled)))
+
+        # recompute messages that underflowed with the stable log-sum-exp
+        underflow = ~np.all(np.isfinite(messages), 0)
+        if underflow.any():
+            messages[:, underflow] = logsumexp(self._grid_potentials[:, :, underflow] + adjusted[:, underflow],
+                                               1)[:, 0]
+            messages = np.nan_to_num(messages - messages.max(0))
+        else:
+            messages -= messages.max(0)
+
+        change = np.inf
+        if compute_change or self.damping != 0:
+            with np.errstate(over='ignore', invalid='ignore'):
+                delta = messages - self._grid_messages
+
+                if self.damping != 0:
+                    delta *= self.message_step
+                    messages = np.nan_to_num(self._grid_messages + delta)
+                    messages -= messages.max(0)
+
+                if compute_change:
+                    np.abs(delta, out=delta)
+                    if self.convergence_norm == 'max':
+                        residuals = self._residual_buffer()
+                        residuals[self.grid_order] = delta.max(0)
+                        change = residuals.max() if residuals.size else 0
+                    else:
+                        change = delta.sum()
+                        if self.convergence_norm == 'mean' and delta.shape[1] > 0:
+                            change /= delta.shape[1]
+
+        self._grid_messages = messages
+        self._message_mat = None
+        self.message_version += 1
+
+        return change
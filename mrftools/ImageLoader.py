@@ -3,10 +3,7 @@ import itertools
 import os
 import time
 
-import PIL
-import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image
 
 from .LogLinearModel import LogLinearModel
 
@@ -34,11 +31,13 @@ class ImageLoader(object):
         :type path: string
         :return: PIL image object
         """
+        from PIL import Image
+
         img = Image.open(path)
         img1 = img
 
         if self.max_width > 0 and self.max_height > 0:
-            img = img.resize((self.max_width, self.max_height), resample=PIL.Image.BICUBIC)
+            img = img.resize((self.max_width, self.max_height), resample=Image.BICUBIC)
 
         return img
 
@@ -60,10 +59,12 @@ class ImageLoader(object):
         label_file = os.path.splitext(image_name)[0] + '_label.txt'
         label_mat = np.loadtxt(label_file)
 
+        from PIL import Image
+
         label_img = Image.fromarray(label_mat.astype(np.uint8))
 
         if self.max_width > 0 and self.max_height > 0:
-            label_img = label_img.resize((self.max_width, self.max_height), resample=PIL.Image.NEAREST)
+            label_img = label_img.resize((self.max_width, self.max_height), resample=Image.NEAREST)
 
         return label_img
 
@@ -98,6 +99,8 @@ class ImageLoader(object):
         labels = self.load_label_img(name)
         features = ImageLoader.compute_features(img)
 
+        import matplotlib.pyplot as plt
+
         plt.subplot(121)
         plt.imshow(img, interpolation='nearest')
         plt.xlabel('Original Image')
@@ -191,6 +194,8 @@ class ImageLoader(object):
         :type images: iterable
         :return: None
         """
+        import matplotlib.pyplot as plt
+
         plt.clf()
         total = len(images)
 
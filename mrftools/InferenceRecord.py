@@ -0,0 +1,52 @@
+"""Class for recording the per-iteration metrics reported by inference."""
+import numpy as np
+
+
+class InferenceRecord(object):
+    """
+    Class used to store the metrics inference reports each iteration. Its callback method can be passed to 
+    MatrixBeliefPropagator.set_callback. Recording only appends to lists, so it adds little overhead to inference.
+    """
+    def __init__(self):
+        """Initialize an empty record."""
+        self.iterations = []
+        self.changes = []
+        self.times = []
+        self.diagnostic_iterations = []
+        self.diagnostics = dict()
+
+    def callback(self, metrics):
+        """
+        Save the metrics of one iteration of inference.
+        
+        :param metrics: dict of metrics as reported by MatrixBeliefPropagator.infer
+        :type metrics: dict
+        :return: None
+        """
+        self.iterations.append(metrics['iteration'])
+        self.changes.append(metrics['change'])
+        self.times.append(metrics['time'])
+
+        if 'energy_functional' in metrics:
+            self.diagnostic_iterations.append(metrics['iteration'])
+            for name in ('energy_functional', 'inconsistency', 'dual_objective'):
+                self.diagnostics.setdefault(name, []).append(metrics[name])
+
+    def to_arrays(self):
+        """
+        Get the recorded metrics as arrays.
+        
+        :return: dict of arrays, with keys 'iteration', 'change', 'time', and, if any diagnostics were recorded,
+                    'diagnostic_iteration' and the names of the diagnostics
+        :rtype: dict
+        """
+        arrays = {'iteration': np.asarray(self.iterations),
+                  'change': np.asarray(self.changes),
+                  'time': np.asarray(self.times)}
+
+        if self.diagnostic_iterations:
+            arrays['diagnostic_iteration'] = np.asarray(self.diagnostic_iterations)
+            for name, values in self.diagnostics.items():
+                arrays[name] = np.asarray(values)
+
+        return arrays
@@ -1,7 +1,9 @@
 """Main learner class for log-linear model parameter learning. """
 import copy
+import os
 
 from .ConvexBeliefPropagator import ConvexBeliefPropagator
+from .LearnerProfile import LearnerProfile, NULL_PHASE
 from .opt import *
 from .MatrixBeliefPropagator import MatrixBeliefPropagator
 
@@ -36,6 +38,31 @@ class Learner(object):
         self.max_time = np.inf
         self.display = 'off'
 
+        # convergence tolerance for inference. If tolerance_scale is set, the tolerance tightens to tolerance_scale times
+        # the latest gradient norm, but never below min_inference_tolerance
+        self.inference_tolerance = 1e-8
+        self.tolerance_scale = None
+        self.min_inference_tolerance = 1e-8
+
+        # size of the random mini-batch of examples used for each objective and gradient evaluation (None uses all)
+        self.batch_size = None
+        self.batch_indices = None
+
+        # cache of the most recent combined objective and gradient evaluation, keyed by weight vector and objective
+        self.cached_weights = None
+        self.cached_objective_function = None
+        self.cached_value = None
+        self.cached_gradient = None
+
+        # timing counters for the phases of learning, or None if profiling is disabled
+        self.profile = None
+
+        # file that learning progress is periodically saved to, and optimizer state loaded from a checkpoint
+        self.checkpoint_path = None
+        self.checkpoint_interval = 10
+        self.checkpoint_iteration = 0
+        self.resume_state = None
+
     def set_regularization(self, l1, l2):
         """
         Set the regularization parameters.
@@ -46,6 +73,71 @@ class Learner(object):
         """
         self.l1_regularization = l1
         self.l2_regularization = l2
+        self.clear_cache()
+
+    def set_batch_size(self, batch_size):
+        """
+        Enable stochastic learning on mini-batches. Each new weight vector the optimizer evaluates draws a new uniform
+        random subset of batch_size examples without replacement, and inference, expectations, and the data terms of
+        the objective and gradient are computed only on that subset. The averages over the batch are unbiased 
+        estimates of the full-data averages, so this mode pairs with the stochastic optimizers sgd, ada_grad, rms_prop,
+        and adam. Each example keeps its own inference objects, so messages are still warm-started across batches.
+
+        :param batch_size: number of examples per batch, or None to use all examples every evaluation
+        :type batch_size: int
+        :return: None
+        """
+        assert batch_size is None or batch_size > 0, "Batch size must be positive"
+        self.batch_size = batch_size
+        self.batch_indices = None
+        self.clear_cache()
+
+    def enable_profiling(self, enabled=True):
+        """
+        Turn on or off timing counters that attribute learning time to updating potentials, inference, computing
+        expectations, computing energies, assembling gradients, and the optimizer. The counters accumulate across
+        calls to learn until profiling is enabled again.
+
+        :param enabled: Boolean value of whether to profile
+        :return: the new profile, or None if profiling was turned off
+        :rtype: LearnerProfile
+        """
+        self.profile = LearnerProfile() if enabled else None
+        return self.profile
+
+    def _phase(self, name):
+        """
+        Get a context manager that times a phase of learning if profiling is enabled.
+
+        :param name: name of the phase
+        :return: context manager
+        """
+        if self.profile is None:
+            return NULL_PHASE
+        return self.profile.phase(name)
+
+    def sample_batch(self):
+        """
+        Draw a new random mini-batch of example indices if stochastic learning is enabled.
+
+        :return: None
+        """
+        if self.batch_size is not None and self.batch_size < self.num_examples:
+            self.batch_indices = np.sort(np.random.choice(self.num_examples, self.batch_size, replace=False))
+        else:
+            self.batch_indices = None
+
+    def get_batch(self, belief_propagators):
+        """
+        Select the inference objects of the current mini-batch.
+
+        :param belief_propagators: list with one inference object per example
+        :return: list of the inference objects for the examples in the current batch, or all of them if there is no 
+                    current batch
+        """
+        if self.batch_indices is None or len(belief_propagators) != self.num_examples:
+            return belief_propagators
+        return [belief_propagators[i] for i in self.batch_indices]
 
     def add_data(self, labels, model):
         """
@@ -94,6 +186,7 @@ class Learner(object):
         self.conditioned_belief_propagators.append(conditioned_bp)
 
         self.num_examples += 1
+        self.clear_cache()
 
     def _set_initialize_every_iter(self, flag):
         """
@@ -105,6 +198,7 @@ class Learner(object):
         :return: None:
         """
         self.initialization_flag = flag
+        self.clear_cache()
 
     def do_inference(self, belief_propagators):
         """
@@ -113,10 +207,14 @@ class Learner(object):
         :param belief_propagators: iterable of inference objects
         :return: None
         """
-        for bp in belief_propagators:
-            if self.initialization_flag:
-                bp.initialize_messages()
-            bp.infer(display=self.display)
+        with self._phase('inference'):
+            for bp in belief_propagators:
+                if self.initialization_flag:
+                    bp.initialize_messages()
+                bp.infer(tolerance=self.inference_tolerance, display=self.display)
+
+        if self.profile is not None:
+            self.profile.record_inference(belief_propagators)
 
     def set_inference_truncation(self, bp_iter):
         """
@@ -127,6 +225,35 @@ class Learner(object):
         """
         for bp in self.belief_propagators + self.conditioned_belief_propagators:
             bp.set_max_iter(bp_iter)
+        self.clear_cache()
+
+    def set_adaptive_inference_tolerance(self, initial_tolerance=1e-2, min_tolerance=1e-8, scale=1e-2):
+        """
+        Make inference precision follow the needs of the optimizer. Inference starts with a loose convergence tolerance,
+        and after each gradient computation, the tolerance tightens to scale times the gradient norm, so early
+        optimizer iterations far from the optimum do not pay for exact inference. The tolerance never loosens.
+
+        :param initial_tolerance: inference tolerance for the first objective and gradient evaluations
+        :param min_tolerance: tightest tolerance the schedule will reach
+        :param scale: ratio between the inference tolerance and the gradient norm
+        :return: None
+        """
+        self.inference_tolerance = initial_tolerance
+        self.min_inference_tolerance = min_tolerance
+        self.tolerance_scale = scale
+        self.clear_cache()
+
+    def _update_inference_tolerance(self, grad):
+        """
+        Tighten the inference tolerance according to the adaptive schedule, if it is enabled.
+
+        :param grad: most recently computed gradient vector
+        :return: None
+        """
+        if self.tolerance_scale is not None:
+            grad_norm = np.sqrt(grad.dot(grad))
+            self.inference_tolerance = max(self.min_inference_tolerance,
+                                           min(self.inference_tolerance, self.tolerance_scale * grad_norm))
 
     def get_feature_expectations(self, belief_propagators):
         """
@@ -136,8 +263,9 @@ class Learner(object):
         :return: vector of feature expectations
         """
         marginal_sum = 0
-        for bp in belief_propagators:
-            marginal_sum += np.true_divide(bp.get_feature_expectations(), len(bp.mn.variables))
+        with self._phase('expectations'):
+            for bp in belief_propagators:
+                marginal_sum += np.true_divide(bp.get_feature_expectations(), len(bp.mn.variables))
 
         return marginal_sum / len(belief_propagators)
 
@@ -165,9 +293,7 @@ class Learner(object):
         :param do_inference: Boolean value indicating whether or not to run inference. Defaults to True.
         :return: objective value (float)
         """
-        if self.label_expectations is None or not self.fully_observed:
-            self.label_expectations = self.calculate_expectations(weights, self.conditioned_belief_propagators,
-                                                                  do_inference)
+        self._update_label_expectations(weights, do_inference)
         return self.objective(weights)
 
     def subgrad_grad(self, weights, options=None, do_inference=False):
@@ -179,11 +305,103 @@ class Learner(object):
                             typically the objective function was called immediately before, which does inference.
         :return: gradient with respect to weights
         """
-        if self.label_expectations is None or not self.fully_observed:
-            self.label_expectations = self.calculate_expectations(weights, self.conditioned_belief_propagators,
-                                                                  do_inference)
+        self._update_label_expectations(weights, do_inference)
         return self.gradient(weights)
 
+    def _update_label_expectations(self, weights, should_infer):
+        """
+        Compute the expectations of the features under the label distributions. When all variables are observed, these
+        do not depend on the weights, so they are computed once from all examples. Otherwise, they are recomputed for
+        the current batch.
+
+        :param weights: weight vector containing weights for all potentials
+        :param should_infer: Boolean value of whether to run inference on latent variables
+        :return: None
+        """
+        if self.label_expectations is None and self.fully_observed:
+            self.label_expectations = self.calculate_expectations(weights, self.conditioned_belief_propagators,
+                                                                  should_infer)
+        elif not self.fully_observed:
+            self.label_expectations = self.calculate_expectations(
+                weights, self.get_batch(self.conditioned_belief_propagators), should_infer)
+
+    def clear_cache(self):
+        """
+        Discard the cached objective and gradient evaluation. Must be called whenever something other than the weight
+        vector changes the objective, e.g., new data, new regularization, or new label expectations.
+
+        :return: None
+        """
+        self.cached_weights = None
+        self.cached_objective_function = None
+        self.cached_value = None
+        self.cached_gradient = None
+
+    def value_and_grad(self, weights, options=None, objective=None):
+        """
+        Compute an objective and its gradient together, running inference and computing expectations once. The result
+        is cached, so asking again for either quantity at the same weights returns immediately, no matter which order
+        an optimizer requests them in.
+
+        :param weights: weight vector containing weights for all potentials
+        :param options: options passed through to the objective function
+        :param objective: objective method that runs inference and sets self.inferred_expectations (and, if needed, 
+                            self.label_expectations) for the weights, e.g., self.objective or self.dual_obj. 
+                            Defaults to self.subgrad_obj.
+        :return: tuple of the objective value and gradient vector
+        :rtype: tuple
+        """
+        if objective is None:
+            objective = self.subgrad_obj
+
+        if self.cached_weights is not None and self.cached_objective_function == objective \
+                and np.array_equal(self.cached_weights, weights):
+            if self.profile is not None:
+                self.profile.cache_hits += 1
+            return self.cached_value, self.cached_gradient
+
+        start = time.time()
+        if self.profile is not None:
+            self.profile.evaluating = True
+
+        # every new weight vector is a new optimizer step, so it gets a new mini-batch in stochastic mode
+        self.sample_batch()
+
+        value = objective(weights, options)
+        if self._time_exceeded():
+            grad = np.zeros(len(weights))
+        else:
+            grad = self._expectation_gradient(weights)
+
+        self.cached_weights = np.array(weights, copy=True)
+        self.cached_objective_function = objective
+        self.cached_value = value
+        self.cached_gradient = grad
+
+        if self.profile is not None:
+            self.profile.evaluating = False
+            now = time.time()
+            self.profile.record_evaluation(objective.__name__, value, now - start, now - self.start_time)
+
+        return value, grad
+
+    def cached_functions(self, objective=None):
+        """
+        Create objective and gradient functions for the optimizers in opt.py that share a single cached evaluation
+        via value_and_grad.
+
+        :param objective: objective method to evaluate (see value_and_grad). Defaults to self.subgrad_obj.
+        :return: tuple containing the objective function and the gradient function
+        :rtype: tuple
+        """
+        def cached_objective(weights, options=None):
+            return self.value_and_grad(weights, options, objective)[0]
+
+        def cached_gradient(weights, options=None):
+            return self.value_and_grad(weights, options, objective)[1]
+
+        return cached_objective, cached_gradient
+
     def learn(self, weights, optimizer=ada_grad, callback=None, opt_args=None):
         """
         Fit model parameters my maximizing the variational likelihood
@@ -195,11 +413,181 @@ class Learner(object):
         :return: learned weights
         """
         self.start_time = time.time()
-        res = optimizer(self.subgrad_obj, self.subgrad_grad, weights, opt_args, callback=callback)
+        self.clear_cache()
+        func, grad = self.cached_functions(self.subgrad_obj)
+        opt_args, callback = self._checkpointing(opt_args, callback)
+        res = optimizer(func, grad, weights, opt_args, callback=callback)
         new_weights = res
+        self._finish_learning()
 
         return new_weights
 
+    def set_checkpointing(self, path, interval=10):
+        """
+        Periodically save learning progress so that an interrupted learning job can continue with resume. Every 
+        interval optimizer iterations, the current weights, the optimizer's iteration counter and accumulators, the 
+        messages of all inference objects, and the learner's inference tolerance, label expectations, and random state
+        are written to path.
+
+        :param path: file name of the checkpoint, or None to disable checkpointing
+        :param interval: number of optimizer iterations between checkpoints
+        :type interval: int
+        :return: None
+        """
+        assert interval > 0, "Checkpoint interval must be positive"
+        self.checkpoint_path = path
+        self.checkpoint_interval = interval
+
+    def _checkpointing(self, opt_args, callback):
+        """
+        Prepare the arguments and callback of an optimizer run to restore optimizer state from a loaded checkpoint and
+        to save checkpoints.
+
+        :param opt_args: optimization arguments passed to learn
+        :param callback: callback function passed to learn
+        :return: tuple of the optimization arguments and callback to pass to the optimizer
+        :rtype: tuple
+        """
+        if self.checkpoint_path is None and self.resume_state is None:
+            return opt_args, callback
+
+        # the optimizer reads its counter and accumulators from the state dict and updates them every iteration
+        state = self.resume_state if self.resume_state is not None else dict()
+        self.resume_state = None
+        opt_args = dict(opt_args or {})
+        opt_args['state'] = state
+
+        if self.checkpoint_path is None:
+            return opt_args, callback
+
+        def checkpoint_callback(x):
+            if callback:
+                callback(x)
+            self.checkpoint_iteration += 1
+            if self.checkpoint_iteration % self.checkpoint_interval == 0:
+                self.save_checkpoint(self.checkpoint_path, x, state)
+
+        return opt_args, checkpoint_callback
+
+    def save_checkpoint(self, path, weights, optimizer_state=None):
+        """
+        Save learning progress to a file. The file is replaced atomically, so an interruption while saving leaves the
+        previous checkpoint intact.
+
+        :param path: file name of the checkpoint
+        :param weights: current weight vector
+        :param optimizer_state: dict of the optimizer's iteration counter and accumulators
+        :type optimizer_state: dict
+        :return: None
+        """
+        arrays = self._checkpoint_arrays()
+        arrays['weights'] = weights
+        arrays['checkpoint_iteration'] = np.array(self.checkpoint_iteration)
+
+        for key, value in (optimizer_state or {}).items():
+            arrays['optimizer_' + key] = np.asarray(value)
+
+        for i, bp in enumerate(self.belief_propagators):
+            arrays['messages_%d' % i] = bp.message_mat
+        for i, bp in enumerate(self.conditioned_belief_propagators):
+            arrays['conditioned_messages_%d' % i] = bp.message_mat
+
+        _, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+        arrays.update({'random_keys': keys, 'random_position': np.array(position),
+                       'random_has_gauss': np.array(has_gauss), 'random_cached_gaussian': np.array(cached_gaussian)})
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+    def load_checkpoint(self, path):
+        """
+        Restore learning progress from a checkpoint saved by a learner with the same training data. The messages of 
+        all inference objects, the learner state, and the random state are restored immediately. The optimizer state 
+        is used by the next optimizer run.
+
+        :param path: file name of the checkpoint
+        :return: weight vector saved in the checkpoint
+        """
+        with np.load(path) as data:
+            arrays = dict((name, data[name]) for name in data.files)
+
+        # learners may share one inference object among examples, so compare against the inference objects
+        num_messages = len([name for name in arrays if name.startswith('messages_')])
+        assert num_messages == len(self.belief_propagators), \
+            "Checkpoint has messages for %d inference objects, but the learner has %d" % \
+            (num_messages, len(self.belief_propagators))
+
+        self._restore_checkpoint_arrays(arrays)
+        self.checkpoint_iteration = int(arrays['checkpoint_iteration'])
+
+        for i, bp in enumerate(self.belief_propagators):
+            bp.set_messages(arrays['messages_%d' % i])
+        for i, bp in enumerate(self.conditioned_belief_propagators):
+            bp.set_messages(arrays['conditioned_messages_%d' % i])
+
+        np.random.set_state(('MT19937', arrays['random_keys'], int(arrays['random_position']),
+                             int(arrays['random_has_gauss']), float(arrays['random_cached_gaussian'])))
+
+        # scalars such as the iteration counter are restored as Python numbers
+        self.resume_state = dict((name[len('optimizer_'):], value.item() if value.ndim == 0 else value)
+                                 for name, value in arrays.items() if name.startswith('optimizer_'))
+        self.clear_cache()
+
+        return arrays['weights']
+
+    def resume(self, optimizer=ada_grad, callback=None, opt_args=None, path=None):
+        """
+        Continue learning from a checkpoint. With the same optimizer and options as the interrupted run, learning 
+        continues exactly where the checkpoint was saved.
+
+        :param optimizer: gradient-based optimization function, as defined in opt.py
+        :param callback: callback function run during each iteration of the optimizer
+        :param opt_args: optimization arguments. Usually a dictionary of parameter values
+        :param path: file name of the checkpoint. Defaults to the file set by set_checkpointing.
+        :return: learned weights
+        """
+        weights = self.load_checkpoint(path or self.checkpoint_path)
+        return self.learn(weights, optimizer, callback, opt_args)
+
+    def _checkpoint_arrays(self):
+        """
+        Collect the learner state that a checkpoint must save besides weights, optimizer state, and messages.
+
+        :return: dict of arrays
+        :rtype: dict
+        """
+        arrays = {'inference_tolerance': np.array(self.inference_tolerance)}
+        if self.label_expectations is not None:
+            arrays['label_expectations'] = self.label_expectations
+        return arrays
+
+    def _restore_checkpoint_arrays(self, arrays):
+        """
+        Restore learner state collected by _checkpoint_arrays.
+
+        :param arrays: dict of arrays loaded from a checkpoint
+        :type arrays: dict
+        :return: None
+        """
+        self.inference_tolerance = float(arrays['inference_tolerance'])
+        if 'label_expectations' in arrays:
+            self.label_expectations = arrays['label_expectations']
+
+    def _finish_learning(self):
+        """
+        Reset per-run learning state so that evaluating the objective after learning uses all examples.
+
+        :return: None
+        """
+        self.batch_indices = None
+        self.checkpoint_iteration = 0
+        self.clear_cache()
+
+        if self.profile is not None:
+            self.profile.learn_time += time.time() - self.start_time
+
     def set_weights(self, weight_vector, belief_propagators):
         """
         Set weights of Markov net from vector using the order in self.potentials.
@@ -207,8 +595,9 @@ class Learner(object):
         :param belief_propagators: iterable of belief propagators whose models should be updated with the weights
         :return: None
         """
-        for bp in belief_propagators:
-            bp.mn.set_weights(weight_vector)
+        with self._phase('set_weights'):
+            for bp in belief_propagators:
+                bp.mn.set_weights(weight_vector)
 
     def calculate_expectations(self, weights, belief_propagators, should_infer=True):
         """
@@ -234,16 +623,20 @@ class Learner(object):
         :param options: Unused (for now) options for objective function
         :return: objective value
         """
-        self.inferred_expectations = self.calculate_expectations(weights, self.belief_propagators, True)
+        belief_propagators = self.get_batch(self.belief_propagators)
+        self.inferred_expectations = self.calculate_expectations(weights, belief_propagators, True)
 
-        term_p = sum([np.true_divide(x.compute_energy_functional(), len(x.mn.variables)) for x in
-                      self.belief_propagators]) / len(self.belief_propagators)
+        with self._phase('energy'):
+            term_p = sum([np.true_divide(x.compute_energy_functional(), len(x.mn.variables)) for x in
+                          belief_propagators]) / len(belief_propagators)
 
         if not self.fully_observed:
             # recompute energy functional for label distributions only in latent variable case
-            self.set_weights(weights, self.conditioned_belief_propagators)
-            term_q = sum([np.true_divide(x.compute_energy_functional(), len(x.mn.variables)) for x in
-                          self.conditioned_belief_propagators]) / len(self.conditioned_belief_propagators)
+            conditioned_belief_propagators = self.get_batch(self.conditioned_belief_propagators)
+            self.set_weights(weights, conditioned_belief_propagators)
+            with self._phase('energy'):
+                term_q = sum([np.true_divide(x.compute_energy_functional(), len(x.mn.variables)) for x in
+                              conditioned_belief_propagators]) / len(conditioned_belief_propagators)
         else:
             term_q = np.dot(self.label_expectations, weights)
 
@@ -264,14 +657,37 @@ class Learner(object):
         :param options: Unused (for now) options for objective function
         :return: gradient vector
         """
-        if self.start_time != 0 and time.time() - self.start_time > self.max_time:
-            if self.display == 'full':
-                print('more than %d seconds...' % self.max_time)
+        if self._time_exceeded():
             grad = np.zeros(len(weights))
             return grad
         else:
-            self.inferred_expectations = self.calculate_expectations(weights, self.belief_propagators, False)
+            self.inferred_expectations = self.calculate_expectations(weights, self.get_batch(self.belief_propagators),
+                                                                     False)
+
+            return self._expectation_gradient(weights)
+
+    def _time_exceeded(self):
+        """
+        Check whether learning has run longer than self.max_time.
 
+        :return: True if the time limit has passed
+        :rtype: bool
+        """
+        if self.start_time != 0 and time.time() - self.start_time > self.max_time:
+            if self.display == 'full':
+                print('more than %d seconds...' % self.max_time)
+            return True
+        return False
+
+    def _expectation_gradient(self, weights):
+        """
+        Compute the gradient of the regularized negative variational log likelihood from the stored label and inferred
+        expectations, which must be current for weights.
+
+        :param weights: weight vector containing weights for all potentials
+        :return: gradient vector
+        """
+        with self._phase('gradient'):
             grad = np.zeros(len(weights))
 
             # add regularization penalties
@@ -281,7 +697,9 @@ class Learner(object):
             grad -= np.squeeze(self.label_expectations)
             grad += np.squeeze(self.inferred_expectations)
 
-            return grad
+        self._update_inference_tolerance(grad)
+
+        return grad
 
     def dual_obj(self, weights, options=None):
         """
@@ -291,17 +709,20 @@ class Learner(object):
         :param options: Unused (for now) options for objective function
         :return: dual objective value
         """
-        if self.label_expectations is None or not self.fully_observed:
-            self.label_expectations = self.calculate_expectations(weights, self.conditioned_belief_propagators, True)
-        self.inferred_expectations = self.calculate_expectations(weights, self.belief_propagators, True)
-        term_p = sum(
-            [np.true_divide(x.compute_dual_objective(), len(x.mn.variables)) for x in self.belief_propagators]) / len(
-            self.belief_propagators)
+        self._update_label_expectations(weights, True)
+        belief_propagators = self.get_batch(self.belief_propagators)
+        self.inferred_expectations = self.calculate_expectations(weights, belief_propagators, True)
+        with self._phase('energy'):
+            term_p = sum(
+                [np.true_divide(x.compute_dual_objective(), len(x.mn.variables)) for x in belief_propagators]) / len(
+                belief_propagators)
         if not self.fully_observed:
             # recompute energy functional for label distributions only in latent variable case
-            self.set_weights(weights, self.conditioned_belief_propagators)
-            term_q = sum([np.true_divide(x.compute_dual_objective(), len(x.mn.variables)) for x in
-                          self.conditioned_belief_propagators]) / len(self.conditioned_belief_propagators)
+            conditioned_belief_propagators = self.get_batch(self.conditioned_belief_propagators)
+            self.set_weights(weights, conditioned_belief_propagators)
+            with self._phase('energy'):
+                term_q = sum([np.true_divide(x.compute_dual_objective(), len(x.mn.variables)) for x in
+                              conditioned_belief_propagators]) / len(conditioned_belief_propagators)
         else:
             term_q = np.dot(self.label_expectations, weights)
 
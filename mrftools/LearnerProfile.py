@@ -0,0 +1,173 @@
+"""Class for profiling where weight learning spends its time."""
+import time
+
+import numpy as np
+
+
+class LearnerProfile(object):
+    """
+    Class used to accumulate timing counters for the phases of weight learning: updating potentials from weights,
+    inference, computing feature expectations, computing energies or dual objectives, and assembling gradients. 
+    Learning time not covered by objective and gradient evaluations or by these phases is attributed to the optimizer.
+    Each phase only costs two clock reads, so profiling can stay enabled in long training jobs.
+    """
+    def __init__(self):
+        """Initialize an empty profile."""
+        self.phase_times = dict()
+        self.phase_calls = dict()
+        self.learn_time = 0.0
+        self.evaluation_time = 0.0
+        self.evaluating = False
+        self.outside_evaluation_time = 0.0
+        self.evaluations = 0
+        self.cache_hits = 0
+        self.inference_calls = 0
+        self.inference_iterations = []
+        self.trace = []
+
+        self._last_phase_times = dict()
+        self._evaluation_iterations = []
+
+    def phase(self, name):
+        """
+        Create a context manager that adds the wall time of its block to a phase.
+
+        :param name: name of the phase
+        :type name: str
+        :return: context manager timing the phase
+        """
+        return _PhaseTimer(self, name)
+
+    def add_time(self, name, seconds):
+        """
+        Add time to a phase and count one call of it.
+
+        :param name: name of the phase
+        :type name: str
+        :param seconds: wall time to add
+        :type seconds: float
+        :return: None
+        """
+        self.phase_times[name] = self.phase_times.get(name, 0.0) + seconds
+        self.phase_calls[name] = self.phase_calls.get(name, 0) + 1
+        if not self.evaluating:
+            self.outside_evaluation_time += seconds
+
+    def record_inference(self, belief_propagators):
+        """
+        Record how many iterations each inference object ran during its last call to infer.
+
+        :param belief_propagators: iterable of inference objects that just ran inference
+        :return: None
+        """
+        iterations = [bp.num_iterations for bp in belief_propagators]
+        self.inference_calls += 1
+        self.inference_iterations.extend(iterations)
+        self._evaluation_iterations.extend(iterations)
+
+    def record_evaluation(self, name, value, seconds, elapsed):
+        """
+        Record one objective and gradient evaluation at a new weight vector and append its entry to the trace.
+
+        :param name: name of the objective function that was evaluated
+        :type name: str
+        :param value: objective value
+        :type value: float
+        :param seconds: wall time of the evaluation
+        :type seconds: float
+        :param elapsed: wall time since learning started
+        :type elapsed: float
+        :return: None
+        """
+        self.evaluations += 1
+        self.evaluation_time += seconds
+
+        phase_times = dict((phase, phase_time - self._last_phase_times.get(phase, 0.0))
+                           for phase, phase_time in self.phase_times.items())
+        self._last_phase_times = dict(self.phase_times)
+
+        self.trace.append({'evaluation': self.evaluations,
+                           'objective': name,
+                           'value': value,
+                           'time': seconds,
+                           'elapsed': elapsed,
+                           'phase_times': phase_times,
+                           'inference_iterations': list(self._evaluation_iterations)})
+        self._evaluation_iterations = []
+
+    def summary(self):
+        """
+        Summarize the profile.
+
+        :return: dict containing the total learning time, the time, call count, and fraction of learning time of each
+                    phase (including 'optimizer'), the number of evaluations and cache hits, and statistics of the
+                    number of inference iterations per example
+        :rtype: dict
+        """
+        phases = dict()
+        for name in self.phase_times:
+            phases[name] = {'time': self.phase_times[name], 'calls': self.phase_calls[name]}
+
+        if self.learn_time > 0:
+            optimizer_time = self.learn_time - self.evaluation_time - self.outside_evaluation_time
+            phases['optimizer'] = {'time': max(optimizer_time, 0.0),
+                                   'calls': self.evaluations + self.cache_hits}
+
+        total = self.learn_time or sum(phase['time'] for phase in phases.values())
+        for phase in phases.values():
+            phase['fraction'] = phase['time'] / total if total > 0 else 0.0
+
+        iterations = np.asarray(self.inference_iterations)
+
+        return {'learn_time': self.learn_time,
+                'phases': phases,
+                'evaluations': self.evaluations,
+                'cache_hits': self.cache_hits,
+                'inference_calls': self.inference_calls,
+                'mean_inference_iterations': iterations.mean() if iterations.size else 0.0,
+                'max_inference_iterations': int(iterations.max()) if iterations.size else 0}
+
+    def report(self):
+        """
+        Format the summary as a human-readable table.
+
+        :return: multi-line report
+        :rtype: str
+        """
+        summary = self.summary()
+        lines = ["%-14s %12s %8s %8s" % ("phase", "time (s)", "calls", "share")]
+        for name, phase in sorted(summary['phases'].items(), key=lambda item: -item[1]['time']):
+            lines.append("%-14s %12.4f %8d %7.1f%%" % (name, phase['time'], phase['calls'], 100 * phase['fraction']))
+        lines.append("learning time %.4f s, %d evaluations, %d cache hits" %
+                     (summary['learn_time'], summary['evaluations'], summary['cache_hits']))
+        lines.append("inference iterations per example: mean %.1f, max %d" %
+                     (summary['mean_inference_iterations'], summary['max_inference_iterations']))
+        return "\n".join(lines)
+
+
+class _PhaseTimer(object):
+    """Context manager that adds the wall time of its block to a phase of a LearnerProfile."""
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add_time(self.name, time.time() - self.start)
+        return False
+
+
+class _NullPhase(object):
+    """Context manager that does nothing, used when profiling is disabled."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_PHASE = _NullPhase()
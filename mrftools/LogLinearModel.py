@@ -1,8 +1,8 @@
 """Class to convert from log linear model to MRF"""
 import numpy as np
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, coo_matrix, issparse
 
-from .MarkovNet import MarkovNet
+from .MarkovNet import MarkovNet, _lazy_view
 
 
 class LogLinearModel(MarkovNet):
@@ -10,6 +10,11 @@ class LogLinearModel(MarkovNet):
     Log linear model class. Able to convert from log linear features to pairwise MRF.
     """
 
+    unary_features = _lazy_view('unary_features', 'feature')
+    edge_features = _lazy_view('edge_features', 'feature')
+    num_features = _lazy_view('num_features', 'feature')
+    num_edge_features = _lazy_view('num_edge_features', 'feature')
+
     def __init__(self):
         """Initialize a LogLinearModel. Create a Markov net."""
         super(LogLinearModel, self).__init__()
@@ -29,6 +34,12 @@ class LogLinearModel(MarkovNet):
         self.unary_feature_mat = None
         self.edge_feature_mat = None
 
+        # copy of the last weight vector passed to set_weights, used to skip recomputing unchanged potentials
+        self.last_weights = None
+
+        # if True, create_matrices stores the feature matrices as scipy sparse matrices even if all features are dense
+        self.sparse_features = False
+
     def set_edge_factor(self, edge, potential):
         """
         Set a factor by inputting the involved variables then the potential function. 
@@ -60,28 +71,32 @@ class LogLinearModel(MarkovNet):
     def set_unary_features(self, var, values):
         """
         Set the log-linear features for a particular variable.  Used for non-matrix mode only.
+        If any feature vector is a scipy sparse matrix, create_matrices stores the unary feature matrix in sparse form.
+
         :param var: variable whose features to set
-        :param values: ndarray feature vector describing the unary variable of any length
+        :param values: ndarray or scipy sparse row or column vector describing the unary variable of any length
         :return: None
         """
-        assert isinstance(values, np.ndarray)
+        assert isinstance(values, np.ndarray) or issparse(values)
         self.unary_features[var] = values
 
-        self.num_features[var] = len(values)
+        self.num_features[var] = _feature_length(values)
 
     def set_edge_features(self, edge, values):
         """
         Set the log-linear feature for a particular edge.  Used for non-matrix mode only. Currently does not work.
+        If any feature vector is a scipy sparse matrix, create_matrices stores the edge feature matrix in sparse form.
+
         :param edge: pair of variables representing the edge being set
-        :param values: ndarray of feature values describing the edge
+        :param values: ndarray or scipy sparse row or column vector of feature values describing the edge
         :return: None
         """
         reversed_edge = (edge[1], edge[0])
         self.edge_features[edge] = values
-        self.num_edge_features[edge] = len(values)
+        self.num_edge_features[edge] = _feature_length(values)
 
         self.edge_features[reversed_edge] = values
-        self.num_edge_features[reversed_edge] = len(values)
+        self.num_edge_features[reversed_edge] = _feature_length(values)
 
     def set_all_unary_factors(self):
         """
@@ -97,24 +112,37 @@ class LogLinearModel(MarkovNet):
         """
         Set matrix of features for all unary variables. Used for matrix mode.
         
-        :param feature_mat: ndarray of shape (max_unary_features, len(variables)) with variables as ordered in self.variables.
-                            Each jth column is the jth variable's feature vector.
+        :param feature_mat: ndarray or scipy sparse matrix of shape (max_unary_features, len(variables)) with variables
+                            as ordered in self.variables. Each jth column is the jth variable's feature vector.
         :return: None
         """
         assert (np.array_equal(self.unary_feature_mat.shape, feature_mat.shape))
+        self.last_weights = None
+
+        if issparse(feature_mat) or issparse(self.unary_feature_mat):
+            # sparse matrices can't be copied into in place, so replace the stored matrix
+            self.unary_feature_mat = csr_matrix(feature_mat)
+        else:
+            self.unary_feature_mat[:, :] = feature_mat
 
-        self.unary_feature_mat[:, :] = feature_mat
+        # inference objects reuse feature expectations until the version changes. The potentials themselves only
+        # change when the weights are next applied
+        self._record_potential_change()
 
     def set_weights(self, weight_vector):
         """
         Set the unary and edge weight matrices by splitting and reshaping a weight vector. Useful for optimization when
         the optimizer is searching for a vector value. Used for matrix mode.
         
+        If the weight vector equals the one most recently set, the potentials are already current, so this method 
+        returns without recomputing them.
+        
         :param weight_vector: real vector of length self.max_unary_features * self.max_state + 
                                 self.max_edge_features * self.max_states ** 2
         :return: None
         """
-        num_vars = len(self.variables)
+        if self.last_weights is not None and np.array_equal(self.last_weights, weight_vector):
+            return
 
         feature_size = self.max_unary_features * self.max_states
         feature_weights = weight_vector[:feature_size].reshape((self.max_unary_features, self.max_states))
@@ -127,6 +155,8 @@ class LogLinearModel(MarkovNet):
         self.update_unary_matrix()
         self.update_edge_tensor()
 
+        self.last_weights = np.array(weight_vector, copy=True)
+
     def set_unary_weight_matrix(self, weight_mat):
         """
         Set unary weight matrix. Convenience method that also checks the shape of the new matrix. Used for matrix mode.
@@ -140,6 +170,7 @@ class LogLinearModel(MarkovNet):
         """
         assert (np.array_equal(self.unary_weight_mat.shape, weight_mat.shape))
         self.unary_weight_mat[:, :] = weight_mat
+        self.last_weights = None
 
     def set_edge_weight_matrix(self, edge_weight_mat):
         """
@@ -153,10 +184,13 @@ class LogLinearModel(MarkovNet):
         """
         assert (np.array_equal(self.edge_weight_mat.shape, edge_weight_mat.shape))
         self.edge_weight_mat[:, :] = edge_weight_mat
+        self.last_weights = None
 
     def update_unary_matrix(self):
         """
-        Set the unary potential matrix by multiplying the feature matrix by the weight matrix.
+        Set the unary potential matrix by multiplying the feature matrix by the weight matrix. If the feature matrix is
+        sparse, the product only touches its nonzero entries.
+        
         :return: None
         """
         self.set_unary_mat(self.unary_feature_mat.T.dot(self.unary_weight_mat).T)
@@ -172,7 +206,7 @@ class LogLinearModel(MarkovNet):
         """
         half_edge_tensor = self.edge_feature_mat.T.dot(self.edge_weight_mat).T.reshape(
             (self.max_states, self.max_states, self.num_edges))
-        self.edge_pot_tensor[:, :, :] = np.concatenate((half_edge_tensor.transpose(1, 0, 2), half_edge_tensor), axis=2)
+        self.set_edge_tensor(np.concatenate((half_edge_tensor.transpose(1, 0, 2), half_edge_tensor), axis=2))
 
     def create_matrices(self):
         """
@@ -181,26 +215,60 @@ class LogLinearModel(MarkovNet):
         :return: None
         """
         super(LogLinearModel, self).create_matrices()
+        self.last_weights = None
 
         # create unary matrices
         self.max_unary_features = max([x for x in self.num_features.values()])
         self.unary_weight_mat = np.zeros((self.max_unary_features, self.max_states))
-        self.unary_feature_mat = np.zeros((self.max_unary_features, len(self.variables)))
-
-        for var in self.variables:
-            index = self.var_index[var]
-            self.unary_feature_mat[:, index] = self.unary_features[var]
+        self.unary_feature_mat = self._create_feature_matrix(
+            [(self.var_index[var], self.unary_features[var]) for var in self.variables],
+            self.max_unary_features, len(self.variables))
 
         # create edge matrices
         self.max_edge_features = max([x for x in self.num_edge_features.values()] or [0])
         self.edge_weight_mat = np.zeros((self.max_edge_features, self.max_states ** 2))
-        self.edge_feature_mat = np.zeros((self.max_edge_features, self.num_edges))
-
-        for edge, i in self.message_index.items():
-            self.edge_feature_mat[:, i] = self.edge_features[edge]
+        self.edge_feature_mat = self._create_feature_matrix(
+            [(i, self.edge_features[edge]) for edge, i in self.message_index.items()],
+            self.max_edge_features, self.num_edges)
 
         self.weight_dim = self.max_states * self.max_unary_features + self.max_edge_features * self.max_states ** 2
 
+    def _create_feature_matrix(self, columns, num_features, num_columns):
+        """
+        Stack feature vectors as the columns of a feature matrix. The matrix is a csr_matrix if self.sparse_features is
+        set or if any of the feature vectors is sparse, in which case only the nonzero entries are ever materialized.
+        Otherwise, it is a dense ndarray.
+
+        :param columns: list of (column index, feature vector) pairs
+        :type columns: list
+        :param num_features: number of rows of the feature matrix
+        :type num_features: int
+        :param num_columns: number of columns of the feature matrix
+        :type num_columns: int
+        :return: feature matrix of shape (num_features, num_columns)
+        :rtype: ndarray or csr_matrix
+        """
+        if not self.sparse_features and not any(issparse(values) for _, values in columns):
+            feature_mat = np.zeros((num_features, num_columns))
+            for index, values in columns:
+                feature_mat[:, index] = values
+            return feature_mat
+
+        rows = []
+        cols = []
+        data = []
+        for index, values in columns:
+            values = coo_matrix(values)
+            # feature vectors may be either row or column vectors
+            rows.append(values.col if values.shape[0] == 1 else values.row)
+            cols.append(np.full(values.nnz, index, dtype=np.intp))
+            data.append(values.data)
+
+        return csr_matrix((np.concatenate(data or [np.zeros(0)]),
+                           (np.concatenate(rows or [np.zeros(0, dtype=np.intp)]),
+                            np.concatenate(cols or [np.zeros(0, dtype=np.intp)]))),
+                          shape=(num_features, num_columns))
+
     def create_indicator_model(self, markov_net):
         """
         Sets this object to be a log-linear model representation of a Markov Net to enable directly learning the 
@@ -213,13 +281,14 @@ class LogLinearModel(MarkovNet):
         """
         n = len(markov_net.variables)
 
+        # indicator features are one-hot, so store them sparsely rather than as n-by-n dense matrices
+        self.sparse_features = True
+
         # set unary variables
         for i, var in enumerate(markov_net.variables):
             self.declare_variable(var, num_states=markov_net.num_states[var])
             self.set_unary_factor(var, markov_net.unary_potentials[var])
-            indicator_features = np.zeros(n)
-            indicator_features[i] = 1.0
-            self.set_unary_features(var, indicator_features)
+            self.set_unary_features(var, _indicator_vector(i, n))
 
         # count edges
         num_edges = 0
@@ -235,16 +304,11 @@ class LogLinearModel(MarkovNet):
                 if var < neighbor:
                     edge = (var, neighbor)
                     self.set_edge_factor(edge, markov_net.get_potential(edge))
-                    indicator_features = np.zeros(num_edges)
-                    indicator_features[i] = 1.0
-                    self.set_edge_features(edge, indicator_features)
+                    self.set_edge_features(edge, _indicator_vector(i, num_edges))
                     i += 1
 
         self.create_matrices()
 
-        self.unary_feature_mat = csr_matrix(self.unary_feature_mat)
-        self.edge_feature_mat = csr_matrix(self.edge_feature_mat)
-
         # load current unary potentials into unary_weight_mat
         for (var, i) in self.var_index.items():
             self.unary_weight_mat[i, :] = -np.inf
@@ -277,3 +341,142 @@ class LogLinearModel(MarkovNet):
             self.set_edge_factor(edge,
                                  self.edge_pot_tensor[:self.num_states[edge[1]], :self.num_states[edge[0]],
                                  i].squeeze().T)
+
+    def _get_matrix_arrays(self):
+        """
+        Collect the arrays that define the matrix representation of the model, including the feature and weight 
+        matrices.
+
+        :return: dict of arrays to save
+        :rtype: dict
+        """
+        arrays = super(LogLinearModel, self)._get_matrix_arrays()
+
+        edges = sorted(self.message_index, key=self.message_index.get)
+        arrays.update({'num_features': np.array([self.num_features[var] for var in self.var_list], dtype=np.intp),
+                       'num_edge_features': np.array([self.num_edge_features[edge] for edge in edges],
+                                                     dtype=np.intp),
+                       'unary_weight_mat': self.unary_weight_mat,
+                       'edge_weight_mat': self.edge_weight_mat,
+                       'sparse_features': np.array(self.sparse_features)})
+        arrays.update(_matrix_to_arrays('unary_feature_mat', self.unary_feature_mat))
+        arrays.update(_matrix_to_arrays('edge_feature_mat', self.edge_feature_mat))
+
+        return arrays
+
+    def _set_matrix_arrays(self, arrays):
+        """
+        Restore the model from arrays collected by _get_matrix_arrays. The dictionary-based feature views are built
+        on first access, like the other views of a loaded model. For dense feature matrices, the feature vectors are
+        views of the matrix columns. For sparse feature matrices, they are not restored.
+
+        :param arrays: dict of arrays loaded from a saved model
+        :type arrays: dict
+        :return: None
+        """
+        super(LogLinearModel, self)._set_matrix_arrays(arrays)
+
+        self.unary_weight_mat = arrays['unary_weight_mat']
+        self.edge_weight_mat = arrays['edge_weight_mat']
+        self.unary_feature_mat = _matrix_from_arrays('unary_feature_mat', arrays)
+        self.edge_feature_mat = _matrix_from_arrays('edge_feature_mat', arrays)
+        self.sparse_features = bool(arrays['sparse_features'])
+
+        self.max_unary_features = self.unary_weight_mat.shape[0]
+        self.max_edge_features = self.edge_weight_mat.shape[0]
+        self.weight_dim = self.max_states * self.max_unary_features + self.max_edge_features * self.max_states ** 2
+        self.last_weights = None
+
+        self._pending_views.add('feature')
+
+    def _build_feature_views(self):
+        """
+        Build the dictionaries of feature counts and, for dense feature matrices, feature vectors of a loaded model.
+
+        :return: None
+        """
+        arrays = self._view_arrays
+        num_features = dict(zip(self.var_list, arrays['num_features'].tolist()))
+        edges = sorted(self.message_index, key=self.message_index.get)
+        num_edge_features = dict(zip(edges, arrays['num_edge_features'].tolist()))
+
+        unary_features = dict()
+        edge_features = dict()
+        if not issparse(self.unary_feature_mat):
+            unary_features = dict((var, self.unary_feature_mat[:num_features[var], i])
+                                  for var, i in self.var_index.items())
+        if not issparse(self.edge_feature_mat):
+            edge_features = dict((edge, self.edge_feature_mat[:num_edge_features[edge], i])
+                                 for edge, i in self.message_index.items())
+
+        self.num_features = num_features
+        self.num_edge_features = num_edge_features
+        self.unary_features = unary_features
+        self.edge_features = edge_features
+
+
+def _matrix_to_arrays(name, matrix):
+    """
+    Convert a dense or CSR feature matrix to arrays that can be saved.
+
+    :param name: prefix of the array names
+    :type name: str
+    :param matrix: feature matrix
+    :type matrix: ndarray or csr_matrix
+    :return: dict of arrays
+    :rtype: dict
+    """
+    if not issparse(matrix):
+        return {name: matrix}
+
+    matrix = csr_matrix(matrix)
+    return {name + '_data': matrix.data,
+            name + '_indices': matrix.indices,
+            name + '_indptr': matrix.indptr,
+            name + '_shape': np.array(matrix.shape)}
+
+
+def _matrix_from_arrays(name, arrays):
+    """
+    Convert arrays created by _matrix_to_arrays back to a feature matrix.
+
+    :param name: prefix of the array names
+    :type name: str
+    :param arrays: dict of loaded arrays
+    :type arrays: dict
+    :return: feature matrix
+    :rtype: ndarray or csr_matrix
+    """
+    if name in arrays:
+        return arrays[name]
+
+    return csr_matrix((arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr']),
+                      shape=tuple(arrays[name + '_shape']))
+
+
+def _feature_length(values):
+    """
+    Get the dimensionality of a feature vector stored as either a dense ndarray or a scipy sparse row or column vector.
+
+    :param values: feature vector
+    :type values: ndarray or sparse matrix
+    :return: number of feature dimensions
+    :rtype: int
+    """
+    if issparse(values):
+        return values.shape[0] * values.shape[1]
+    return len(values)
+
+
+def _indicator_vector(index, length):
+    """
+    Create a sparse one-hot feature vector.
+
+    :param index: index of the nonzero entry
+    :type index: int
+    :param length: dimensionality of the feature vector
+    :type length: int
+    :return: sparse row vector with a single 1.0 at index
+    :rtype: csr_matrix
+    """
+    return csr_matrix(([1.0], ([0], [index])), shape=(1, length))
@@ -1,13 +1,59 @@
 """Markov network class for storing potential functions and structure."""
+import struct
+import zipfile
+
 import numpy as np
 from scipy.sparse import coo_matrix
 
+POTENTIAL_LOG_LENGTH = 64  # number of recent potential changes a MarkovNet remembers. See potential_changes_since
+
+
+def _lazy_view(name, group):
+    """
+    Create a property for a dictionary-based view of a loaded model that is only built when it is first accessed. The
+    views are built together with the other views of their group by the method _build_<group>_views.
+
+    :param name: name of the attribute
+    :type name: str
+    :param group: name of the group of views built together
+    :type group: str
+    :return: property that builds the group's views before the attribute is read or replaced
+    :rtype: property
+    """
+    attribute = '_' + name
+
+    def get_view(self):
+        self._build_views(group)
+        return getattr(self, attribute)
+
+    def set_view(self, value):
+        # build the other views of the group first, so building them later does not overwrite this value
+        self._build_views(group)
+        setattr(self, attribute, value)
+
+    return property(get_view, set_view)
+
 
 class MarkovNet(object):
     """Object containing the definition of a pairwise Markov net."""
 
+    var_list = _lazy_view('var_list', 'variable')
+    var_index = _lazy_view('var_index', 'variable')
+    variables = _lazy_view('variables', 'variable')
+    num_states = _lazy_view('num_states', 'variable')
+    unary_potentials = _lazy_view('unary_potentials', 'variable')
+    neighbors = _lazy_view('neighbors', 'edge')
+    message_index = _lazy_view('message_index', 'edge')
+    edge_potentials = _lazy_view('edge_potentials', 'edge')
+    tree_probabilities = _lazy_view('tree_probabilities', 'edge')
+
     def __init__(self):
         """Initialize a Markov net."""
+        # groups of dictionary-based views of a loaded model that have not been built yet, and the arrays they are
+        # built from. See load
+        self._pending_views = set()
+        self._view_arrays = None
+
         self.edge_potentials = dict()
         self.unary_potentials = dict()
         self.neighbors = dict()
@@ -19,6 +65,7 @@ class MarkovNet(object):
         # initialize values only used in matrix mode to None
         self.max_states = None
         self.message_to_map = None
+        self.message_sum_map = None
         self.message_to = None
         self.message_from = None
         self.var_index = None
@@ -28,6 +75,11 @@ class MarkovNet(object):
         self.num_edges = None
         self.message_index = None
         self.degrees = None
+        self.state_counts = None
+
+        # counter incremented whenever the matrix-mode potentials change, so inference objects can detect stale results
+        self.potential_version = 0
+        self._potential_log = []  # the potentials changed by each recent increment of potential_version
 
     def set_unary_factor(self, variable, potential):
         """
@@ -126,7 +178,9 @@ class MarkovNet(object):
         :return: None
         """
         assert np.array_equal(self.unary_mat.shape, unary_mat.shape)
+        changed_vars = np.flatnonzero(np.any(self.unary_mat != unary_mat, 0))
         self.unary_mat[:, :] = unary_mat
+        self._record_potential_change(variables=changed_vars)
 
     def set_edge_tensor(self, edge_tensor):
         """
@@ -134,13 +188,54 @@ class MarkovNet(object):
         :param edge_tensor: (max states) by (max states) by (num edges) tensor of the edge potentials
         :return: None
         """
-        if np.array_equal(self.edge_pot_tensor.shape, edge_tensor.shape):
-            self.edge_pot_tensor[:, :, :] = edge_tensor
-        else:
-            mirrored_edge_tensor = np.concatenate((edge_tensor, edge_tensor.transpose((1, 0, 2))), 2)
-            assert np.array_equal(self.edge_pot_tensor.shape, mirrored_edge_tensor.shape)
+        if not np.array_equal(self.edge_pot_tensor.shape, edge_tensor.shape):
+            edge_tensor = np.concatenate((edge_tensor, edge_tensor.transpose((1, 0, 2))), 2)
+            assert np.array_equal(self.edge_pot_tensor.shape, edge_tensor.shape)
+
+        changed_edges = np.flatnonzero(np.any(self.edge_pot_tensor != edge_tensor, (0, 1))) % self.num_edges
+        self.edge_pot_tensor[:, :, :] = edge_tensor
+        self._record_potential_change(edges=changed_edges)
+
+    def _record_potential_change(self, variables=(), edges=(), rebuilt=False):
+        """
+        Increment potential_version and log which potentials changed, so inference objects can find them without
+        comparing the potentials. Only the last POTENTIAL_LOG_LENGTH changes are kept.
+
+        :param variables: indices of the variables whose unary potentials changed
+        :type variables: array_like
+        :param edges: indices, between 0 and num_edges, of the edges whose potentials changed
+        :type edges: array_like
+        :param rebuilt: if True, the matrices were rebuilt, so any potential may have changed
+        :type rebuilt: bool
+        :return: None
+        """
+        self.potential_version += 1
+        self._potential_log.append(None if rebuilt else (np.unique(np.asarray(variables, dtype=np.intp)),
+                                                         np.unique(np.asarray(edges, dtype=np.intp))))
+        del self._potential_log[:-POTENTIAL_LOG_LENGTH]
 
-            self.edge_pot_tensor[:, :, :] = mirrored_edge_tensor
+    def potential_changes_since(self, version):
+        """
+        Find the potentials that changed since potential_version had an earlier value.
+
+        :param version: earlier value of potential_version
+        :type version: int
+        :return: tuple of sorted arrays of the indices of the variables whose unary potentials changed and of the
+                    edges whose potentials changed, or None if the changes are unknown because the matrices were
+                    rebuilt or the changes are older than the log
+        :rtype: tuple
+        """
+        num_changes = self.potential_version - version
+        if num_changes > len(self._potential_log):
+            return None
+
+        changes = self._potential_log[len(self._potential_log) - num_changes:]
+        if any(change is None for change in changes):
+            return None
+
+        empty = np.zeros(0, dtype=np.intp)
+        return (np.unique(np.concatenate([empty] + [variables for variables, _ in changes])),
+                np.unique(np.concatenate([empty] + [edges for _, edges in changes])))
 
     def create_matrices(self):
         """
@@ -149,10 +244,12 @@ class MarkovNet(object):
         :return: None
         """
         self.matrix_mode = True
+        self._record_potential_change(rebuilt=True)
 
         self.max_states = max([len(x) for x in self.unary_potentials.values()])
         self.unary_mat = -np.inf * np.ones((self.max_states, len(self.variables)))
         self.degrees = np.zeros(len(self.variables))
+        self.state_counts = np.zeros(len(self.variables), dtype=np.intp)
 
         # var_index allows looking up the numerical index of a variable by its hashable name
         self.var_index = dict()
@@ -165,6 +262,7 @@ class MarkovNet(object):
             self.var_index[var] = message_num
             self.var_list.append(var)
             self.degrees[message_num] = len(self.neighbors[var])
+            self.state_counts[message_num] = self.num_states[var]
             message_num += 1
 
         # set up pairwise tensor
@@ -225,6 +323,7 @@ class MarkovNet(object):
         # generate a sparse matrix representation of the message indices to variables that receive messages
         self.message_to_map = coo_matrix((np.ones(len(to_rows)), (to_rows, to_cols)),
                                          (2 * self.num_edges, len(self.variables)))
+        self._set_message_sum_map()
 
         # store an array that lists which variable each message is sent to
         self.message_to = np.zeros(2 * self.num_edges, dtype=np.intp)
@@ -233,3 +332,268 @@ class MarkovNet(object):
         # store an array that lists which variable each message is received from
         self.message_from = np.zeros(2 * self.num_edges, dtype=np.intp)
         self.message_from[from_rows] = from_cols
+
+    def _set_message_sum_map(self):
+        """
+        Build the operator that sums messages into the variables that receive them. The transpose of message_to_map is
+        stored once, so summing messages does not build a transposed sparse matrix on every call. It is kept in
+        coordinate format, whose products with dense matrices are as fast as or faster than the compressed formats
+        for the shapes of message matrices.
+
+        :return: None
+        """
+        self.message_sum_map = self.message_to_map.T
+
+    def sum_messages(self, messages):
+        """
+        Sum messages into the variables they are sent to. Equivalent to sparse_dot(messages, self.message_to_map).
+
+        :param messages: array of shape (2 * num_edges,) or (rows, 2 * num_edges) of values for each message
+        :type messages: ndarray
+        :return: array of shape (num_variables,) or (rows, num_variables) of the summed values for each variable
+        :rtype: ndarray
+        """
+        return self.message_sum_map.dot(messages.T).T
+
+    def save(self, path):
+        """
+        Save the matrix representation of the Markov net to a single uncompressed .npz file. Only the arrays used by
+        matrix-mode inference are written, so this is much smaller and faster than pickling the object.
+        
+        :param path: file name (ending in .npz, otherwise numpy appends it) or writable file object
+        :return: None
+        """
+        assert self.matrix_mode, "create_matrices must be called before saving a model"
+        np.savez(path, **self._get_matrix_arrays())
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """
+        Load a model saved with save. The matrix representation is read directly, without rebuilding it through
+        set_unary_factor and create_matrices, so matrix-mode inference can start right away. The dictionary-based
+        views of the model, such as unary_potentials, edge_potentials, and neighbors, are only built when they are
+        first accessed, and the potentials in them are views into the matrices.
+        
+        :param path: file name of a model saved with save
+        :param mmap: if True, memory-map the stored arrays copy-on-write instead of reading them into memory, so only the
+                        parts used are read from disk and the file is never modified
+        :type mmap: bool
+        :return: the loaded model, in matrix mode
+        """
+        model = cls()
+        model._set_matrix_arrays(_load_arrays(path, mmap))
+        return model
+
+    def _get_matrix_arrays(self):
+        """
+        Collect the arrays that define the matrix representation of the model.
+        
+        :return: dict of arrays to save
+        :rtype: dict
+        """
+        var_names, var_name_kind = _encode_names(self.var_list)
+
+        tree_probabilities = np.full(self.num_edges, np.nan)
+        for (var, neighbor), i in self.message_index.items():
+            tree_probabilities[i] = self.tree_probabilities.get((var, neighbor),
+                                                                self.tree_probabilities.get((neighbor, var), np.nan))
+
+        return {'var_names': var_names,
+                'var_name_kind': np.array(var_name_kind),
+                'num_states': np.array([self.num_states[var] for var in self.var_list], dtype=np.intp),
+                'degrees': self.degrees,
+                'unary_mat': self.unary_mat,
+                'edge_pot_tensor': self.edge_pot_tensor,
+                'message_from': self.message_from,
+                'message_to': self.message_to,
+                'tree_probabilities': tree_probabilities}
+
+    def _set_matrix_arrays(self, arrays):
+        """
+        Restore the model from arrays collected by _get_matrix_arrays. Only the matrix representation is restored
+        here. Arrays are used without copying, so memory-mapped arrays stay mapped, and the dictionary-based views
+        are built from them on first access.
+
+        :param arrays: dict of arrays loaded from a saved model
+        :type arrays: dict
+        :return: None
+        """
+        self._view_arrays = arrays
+        self._pending_views = {'variable', 'edge'}
+
+        self.degrees = arrays['degrees']
+        self.state_counts = np.asarray(arrays['num_states'], dtype=np.intp)
+
+        self.unary_mat = arrays['unary_mat']
+        self.max_states = self.unary_mat.shape[0]
+
+        self.message_from = np.asarray(arrays['message_from'], dtype=np.intp)
+        self.message_to = np.asarray(arrays['message_to'], dtype=np.intp)
+        self.num_edges = len(self.message_from) // 2
+
+        self.edge_pot_tensor = arrays['edge_pot_tensor']
+        if self.edge_pot_tensor.shape[2] == self.num_edges:
+            # files saved by older versions only store the backward direction, so mirror it to recover the forward
+            # messages' potentials
+            self.edge_pot_tensor = np.concatenate((self.edge_pot_tensor.transpose(1, 0, 2), self.edge_pot_tensor),
+                                                  axis=2)
+
+        self.message_to_map = coo_matrix((np.ones(2 * self.num_edges), (np.arange(2 * self.num_edges), self.message_to)),
+                                         (2 * self.num_edges, self.unary_mat.shape[1]))
+        self._set_message_sum_map()
+
+        self.matrix_mode = True
+        self._record_potential_change(rebuilt=True)
+
+    def _build_views(self, group):
+        """
+        Build the dictionary-based views of a group if the model was loaded and they have not been built yet.
+
+        :param group: name of the group of views
+        :type group: str
+        :return: None
+        """
+        if group in self._pending_views:
+            self._pending_views.discard(group)
+            getattr(self, '_build_%s_views' % group)()
+
+    def _build_variable_views(self):
+        """
+        Build the variable list and the dictionaries of variable indices, cardinalities, and unary potentials of a
+        loaded model.
+
+        :return: None
+        """
+        arrays = self._view_arrays
+        self.var_list = _decode_names(arrays['var_names'], str(arrays['var_name_kind']))
+        self.var_index = dict((var, i) for i, var in enumerate(self.var_list))
+        self.variables = set(self.var_list)
+        num_states = self.state_counts.tolist()
+        self.num_states = dict(zip(self.var_list, num_states))
+        self.unary_potentials = dict((var, self.unary_mat[:num_states[i], i]) for i, var in enumerate(self.var_list))
+
+    def _build_edge_views(self):
+        """
+        Build the neighbor sets and the dictionaries of message indices, edge potentials, and tree probabilities of a
+        loaded model.
+
+        :return: None
+        """
+        var_list = self.var_list
+        num_states = self.state_counts.tolist()
+        neighbors = dict((var, set()) for var in var_list)
+        message_index = dict()
+        edge_potentials = dict()
+        tree_probabilities = dict()
+
+        message_from = self.message_from[:self.num_edges].tolist()
+        message_to = self.message_to[:self.num_edges].tolist()
+        for i in range(self.num_edges):
+            var = var_list[message_from[i]]
+            neighbor = var_list[message_to[i]]
+            neighbors[var].add(neighbor)
+            neighbors[neighbor].add(var)
+            message_index[(var, neighbor)] = i
+            edge_potentials[(var, neighbor)] = self.edge_pot_tensor[:num_states[message_from[i]],
+                                                                    :num_states[message_to[i]],
+                                                                    i + self.num_edges]
+
+        saved_probabilities = self._view_arrays['tree_probabilities']
+        for i in np.flatnonzero(~np.isnan(saved_probabilities)):
+            tree_probabilities[(var_list[message_from[i]], var_list[message_to[i]])] = float(saved_probabilities[i])
+
+        self.neighbors = neighbors
+        self.message_index = message_index
+        self.edge_potentials = edge_potentials
+        self.tree_probabilities = tree_probabilities
+
+
+def _encode_names(names):
+    """
+    Convert a list of variable names to an array that can be saved without pickling if possible. Names that are all 
+    numbers, all strings, or all equal-length tuples of these are stored as a plain array. Other names fall back to an 
+    object array, which numpy pickles.
+    
+    :param names: list of hashable variable names
+    :type names: list
+    :return: tuple of the array of names and a string describing how to decode it
+    :rtype: tuple
+    """
+    kind = 'tuple' if names and all(isinstance(name, tuple) for name in names) else 'scalar'
+    try:
+        encoded = np.array(names)
+    except ValueError:
+        # names of different lengths cannot form a rectangular array
+        encoded = None
+    if encoded is not None and encoded.dtype.kind in 'biufU' and encoded.ndim == (2 if kind == 'tuple' else 1) \
+            and _decode_names(encoded, kind) == list(names):
+        return encoded, kind
+
+    encoded = np.empty(len(names), dtype=object)
+    for i, name in enumerate(names):
+        encoded[i] = name
+    return encoded, 'object'
+
+
+def _decode_names(encoded, kind):
+    """
+    Convert an array created by _encode_names back to a list of variable names.
+    
+    :param encoded: array of names
+    :type encoded: ndarray
+    :param kind: string describing how the names were encoded
+    :type kind: str
+    :return: list of variable names
+    :rtype: list
+    """
+    if kind == 'tuple':
+        return [tuple(name) for name in encoded.tolist()]
+    elif kind == 'scalar':
+        return encoded.tolist()
+    return list(encoded)
+
+
+def _load_arrays(path, mmap=False):
+    """
+    Load all arrays from an .npz file. Unlike numpy.load, which ignores mmap_mode for .npz files, this function can
+    memory-map the arrays, which is possible because numpy.savez stores them uncompressed.
+    
+    :param path: file name of the .npz file
+    :param mmap: if True, memory-map arrays copy-on-write
+    :type mmap: bool
+    :return: dict mapping names to arrays
+    :rtype: dict
+    """
+    # object arrays (i.e., unusual variable names) are pickled, so they are only allowed for models that stored their
+    # names that way, and such files should only be loaded from trusted sources
+    with np.load(path) as data:
+        allow_pickle = 'var_name_kind' in data.files and str(data['var_name_kind']) == 'object'
+
+    with np.load(path, allow_pickle=allow_pickle) as data:
+        if not mmap:
+            return dict((name, data[name]) for name in data.files)
+
+        arrays = dict()
+        with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+            for info in archive.infolist():
+                name = info.filename[:-len('.npy')]
+
+                # skip the zip local file header to reach the .npy data
+                f.seek(info.header_offset)
+                header = f.read(30)
+                name_length, extra_length = struct.unpack('<HH', header[26:30])
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+                if info.compress_type != zipfile.ZIP_STORED or dtype.hasobject or np.prod(shape) == 0:
+                    arrays[name] = data[name]
+                else:
+                    # view as a plain ndarray, which still reads lazily from the map but indexes faster
+                    arrays[name] = np.memmap(f, dtype=dtype, mode='c', offset=f.tell(), shape=shape,
+                                             order='F' if fortran_order else 'C').view(np.ndarray)
+        return arrays
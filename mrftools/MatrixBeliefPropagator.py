@@ -1,8 +1,15 @@
 """BeliefPropagator class."""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from scipy.sparse import csr_matrix
 
 from .Inference import Inference
 
+logger = logging.getLogger(__name__)
+
 
 class MatrixBeliefPropagator(Inference):
     """
@@ -27,23 +34,66 @@ class MatrixBeliefPropagator(Inference):
 
         self.previously_initialized = False
         self.message_mat = None
+        self.message_version = 0  # incremented whenever message_mat changes
         self.initialize_messages()
 
-        self.belief_mat = np.zeros((self.mn.max_states, len(self.mn.variables)))
+        self.belief_mat = np.zeros((self.mn.max_states, self.mn.unary_mat.shape[1]))
         self.pair_belief_tensor = np.zeros((self.mn.max_states, self.mn.max_states, self.mn.num_edges))
 
         self.max_iter = 300  # default maximum iterations
+        self.num_iterations = 0  # number of iterations the last run of inference performed
+
+        # instrumentation callback. See set_callback
+        self.callback = None
+        self.diagnostic_interval = 0
+
+        # convergence checking policy. See set_convergence_policy
+        self.convergence_interval = 1
+        self.convergence_norm = 'sum'
+        self.residuals = None  # per-message max-norm changes from the last checked update when using the 'max' norm
+        self._change_buffer = None  # preallocated scratch space for computing message changes
+
+        # message damping. See set_damping
+        self.damping = 0.0
+        self.adaptive_damping = False
+        self.min_message_step = 0.1
+        self.message_step = 1.0  # fraction of each message update to apply; a vector per message if adaptive
+        self._previous_delta = None
+
+        # thread-parallel message updates. See set_num_threads
+        self.num_threads = 1
+        self._thread_pool = None
 
         # the augmented_mat is used to condition variables or for loss-augmented inference for max-margin learning
-        self.augmented_mat = np.zeros((self.mn.max_states, len(self.mn.variables)))
+        self.augmented_mat = np.zeros((self.mn.max_states, self.mn.unary_mat.shape[1]))
+        self.augmented_version = 0  # incremented whenever augmented_mat changes
+
+        # the messages, potential version, and augmented version that belief_mat and pair_belief_tensor were computed
+        # from. See compute_beliefs and compute_pairwise_beliefs
+        self._belief_state = None
+        self._pair_belief_state = None
+        # quantities derived from the beliefs, stored as name -> (state, value). See _memoize
+        self._memoized_values = dict()
         self.fully_conditioned = False  # true if every variable has been conditioned
 
         # conditioned stores the indices of variables that have been conditioned, initialized to all False
-        self.conditioned = np.zeros(len(self.mn.variables), dtype=bool)
+        self.conditioned = np.zeros(self.mn.unary_mat.shape[1], dtype=bool)
 
         # condition variables so they can't be in states greater than their cardinality
         self.disallow_impossible_states()
 
+        # the message matrix, tolerance, and potential version from the last run of inference that converged. Used to
+        # skip inference when neither the messages nor the potentials have changed since.
+        self.converged_messages = None
+        self.converged_tolerance = None
+        self.potential_version = None
+
+        self.message_store = None  # MessageStore shared with other propagators to warm-start inference
+
+        self._incoming_map = None  # transposed message_to_map in CSR form, built when infer_incremental first needs it
+        self._outgoing_map = None  # CSR matrix mapping each variable to the messages it sends
+        self.num_updates = None  # number of single-message updates computed by the last call of infer_incremental
+
     def set_max_iter(self, max_iter):
         """
         Set the maximum iterations of belief propagation to run before early stopping
@@ -52,6 +102,137 @@ class MatrixBeliefPropagator(Inference):
         """
         self.max_iter = max_iter
 
+    def set_callback(self, callback, diagnostic_interval=0):
+        """
+        Set a function that infer calls after every iteration with a dict of metrics. The dict contains the
+        'iteration' number, the 'change' in messages (np.inf on iterations that skip convergence checks), and the
+        wall 'time' in seconds the iteration took. Every diagnostic_interval iterations, it also contains the
+        'energy_functional', 'inconsistency', and 'dual_objective', which require extra computation.
+        An InferenceRecord's callback method stores these metrics in arrays.
+
+        :param callback: function that receives the metric dict, or None to disable instrumentation
+        :param diagnostic_interval: number of iterations between diagnostic computations, or 0 to never compute them
+        :type diagnostic_interval: int
+        :return: None
+        """
+        self.callback = callback
+        self.diagnostic_interval = diagnostic_interval
+
+    def compute_diagnostics(self):
+        """
+        Compute diagnostic quantities of the current messages and beliefs.
+
+        :return: dict containing the energy functional, the inconsistency, and the dual objective
+        :rtype: dict
+        """
+        energy_func = self.compute_energy_functional()
+        disagreement = self.compute_inconsistency()
+        dual_obj = self.compute_dual_objective()
+
+        return {'energy_functional': energy_func, 'inconsistency': disagreement, 'dual_objective': dual_obj}
+
+    def set_message_store(self, message_store):
+        """
+        Share converged messages with other propagators through a MessageStore. If the store holds messages for a
+        model with the same structure, they are loaded to warm-start inference, and whenever inference converges, the
+        messages are saved into the store.
+
+        :param message_store: store of messages, or None to stop sharing messages
+        :type message_store: MessageStore
+        :return: None
+        """
+        self.message_store = message_store
+
+        if message_store is not None:
+            messages = message_store.load(self.mn)
+            if messages is not None:
+                self.set_messages(messages)
+
+    def set_convergence_policy(self, interval=1, norm='sum'):
+        """
+        Configure how infer measures convergence.
+
+        :param interval: number of iterations between convergence checks. Iterations in between skip computing the
+                            change in messages entirely.
+        :type interval: int
+        :param norm: how to summarize the change in messages. Options are 'sum', 'mean', and 'max'.
+                        'sum' is the total absolute change of all message entries (the default).
+                        'mean' divides the total by the number of directed messages, which is twice the number of
+                                edges, so the same tolerance gives consistent stopping behavior for models of
+                                different sizes.
+                        'max' is the largest absolute change in any message entry, and stores the vector of each
+                                message's max-norm change in self.residuals. The vector is allocated once and
+                                overwritten in place by each checked update.
+        :type norm: str
+        :return: None
+        """
+        assert interval >= 1, "Convergence interval must be at least 1"
+        assert norm in ('sum', 'mean', 'max'), "Unknown convergence norm %s" % repr(norm)
+        self.convergence_interval = interval
+        self.convergence_norm = norm
+        if norm == 'max':
+            self._residual_buffer()
+
+    def _residual_buffer(self):
+        """
+        Get the preallocated vector of per-message residuals, allocating it if the number of messages changed.
+
+        :return: vector with an entry for each directed message
+        :rtype: ndarray
+        """
+        num_messages = 2 * self.mn.num_edges
+        if self.residuals is None or self.residuals.shape != (num_messages,):
+            self.residuals = np.empty(num_messages)
+        return self.residuals
+
+    def set_damping(self, damping=0.5, adaptive=False, min_step=0.1):
+        """
+        Damp (or over-relax) message updates. Each iteration, every log message becomes
+        damping * (old message) + (1 - damping) * (updated message). Positive damping slows updates, which stops the
+        oscillation that keeps strongly coupled models from converging. Negative damping over-relaxes, taking larger
+        steps for models that converge slowly.
+
+        :param damping: damping factor less than 1. 0 applies the plain belief propagation update.
+        :type damping: float
+        :param adaptive: if True, each message's step size is halved (down to min_step) whenever its update reverses
+                            direction from the previous iteration, and grows back slowly toward 1 - damping otherwise
+        :type adaptive: bool
+        :param min_step: smallest step size the adaptive schedule can reach
+        :type min_step: float
+        :return: None
+        """
+        assert damping < 1, "Damping must be less than 1"
+        self.damping = damping
+        self.adaptive_damping = adaptive
+        self.min_message_step = min_step
+        self._previous_delta = None
+
+        if adaptive:
+            self.message_step = (1 - damping) * np.ones(2 * self.mn.num_edges)
+        else:
+            self.message_step = 1 - damping
+
+    def set_num_threads(self, num_threads=1):
+        """
+        Compute message updates on a pool of threads. The messages are partitioned into num_threads contiguous blocks,
+        and each thread computes the updated messages of one block, damps them, and measures their change. The changes
+        of the blocks are combined once all blocks are done. NumPy releases the global interpreter lock during the array
+        operations of the update, so the blocks run on multiple cores within a single call of infer. Each update waits
+        for its slowest block, and handing blocks to threads has a fixed cost, so this only pays off for large models.
+
+        :param num_threads: number of threads. 1 computes all messages in the calling thread (the default).
+        :type num_threads: int
+        :return: None
+        """
+        assert num_threads >= 1, "Number of threads must be at least 1"
+
+        # stop the worker threads of the previous pool, so repeatedly changing the number of threads does not leak them
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=True)
+
+        self.num_threads = num_threads
+        self._thread_pool = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+
     def initialize_messages(self):
         """
         Initialize messages to default initialization (set to zeros).
@@ -59,6 +240,9 @@ class MatrixBeliefPropagator(Inference):
         :return: None
         """
         self.message_mat = np.zeros((self.mn.max_states, 2 * self.mn.num_edges))
+        self.message_version += 1
+        self._previous_delta = None
+        self._incremental_snapshot = None
 
     def augment_loss(self, var, state):
         """
@@ -73,6 +257,9 @@ class MatrixBeliefPropagator(Inference):
         i = self.mn.var_index[var]
         self.augmented_mat[:, i] = 1
         self.augmented_mat[state, i] = 0
+        self.augmented_version += 1
+        self.converged_messages = None
+        self._mark_augmented(i)
 
     def condition(self, var, state):
         """
@@ -87,6 +274,9 @@ class MatrixBeliefPropagator(Inference):
         i = self.mn.var_index[var]
         self.augmented_mat[:, i] = -np.inf
         self.augmented_mat[state, i] = 0
+        self.augmented_version += 1
+        self.converged_messages = None
+        self._mark_augmented(i)
         if isinstance(state, int):
             # only if the variable is fully conditioned to be in a single state, mark that the variable is conditioned
             self.conditioned[i] = True
@@ -103,10 +293,101 @@ class MatrixBeliefPropagator(Inference):
 
         :return: None
         """
-        for var, num_states in self.mn.num_states.items():
-            self.condition(var, range(num_states))
+        impossible = np.arange(self.mn.max_states)[:, np.newaxis] >= self.mn.state_counts
+        self.augmented_mat = np.where(impossible, -np.inf, 0.0)
+        self.augmented_version += 1
+        self.converged_messages = None
+        self._incremental_snapshot = None
+
+    def _mark_augmented(self, i):
+        """
+        Record that the augmented potential of a variable changed, so infer_incremental updates the messages it sends.
+
+        :param i: index of the variable
+        :type i: int
+        :return: None
+        """
+        if self._incremental_snapshot is not None:
+            self._incremental_snapshot[1].append(i)
+
+    def _current_state(self):
+        """
+        Identify the inputs beliefs are computed from.
+
+        :return: tuple of the message matrix, the message version, the potential version of the model, and the
+                    augmented version
+        :rtype: tuple
+        """
+        return self.message_mat, self.message_version, self.mn.potential_version, self.augmented_version
+
+    def _is_fresh(self, state):
+        """
+        Check whether beliefs computed from a state are still fresh.
+
+        :param state: tuple returned by _current_state when the beliefs were computed, or None if they never were
+        :type state: tuple
+        :return: True if the messages, potentials, and augmented_mat are unchanged since then
+        :rtype: bool
+        """
+        return state is not None and state[0] is self.message_mat and \
+            state[1:] == (self.message_version, self.mn.potential_version, self.augmented_version)
+
+    def _memoize(self, name, compute):
+        """
+        Return a quantity derived from the beliefs, computing it only if the messages, potentials, or augmented_mat
+        changed since it was last computed.
+
+        :param name: key identifying the quantity
+        :type name: str
+        :param compute: function with no arguments that computes the quantity
+        :type compute: function
+        :return: the value of the quantity for the current messages, potentials, and augmented_mat
+        """
+        stored = self._memoized_values.get(name)
+        if stored is None or not self._is_fresh(stored[0]):
+            stored = (self._current_state(), compute())
+            self._memoized_values[name] = stored
+        return stored[1]
+
+    def invalidate_beliefs(self):
+        """
+        Mark the stored beliefs and the quantities derived from them as stale, so they are recomputed the next time
+        they are requested, make the next call of infer run even if the messages had converged, and make the next call
+        of infer_incremental run full inference. Only needed after modifying message_mat or the model potentials in
+        place.
+
+        :return: None
+        """
+        self._belief_state = None
+        self._pair_belief_state = None
+        self._memoized_values.clear()
+        self._incremental_snapshot = None
+        self.converged_messages = None
 
     def compute_beliefs(self):
+        """
+        Compute unary log beliefs based on current messages and store them in belief_mat. Does nothing if belief_mat
+        was already computed from the current messages, potentials, and augmented_mat.
+
+        :return: None
+        """
+        if not self._is_fresh(self._belief_state):
+            self._compute_beliefs()
+            self._belief_state = self._current_state()
+
+    def compute_pairwise_beliefs(self):
+        """
+        Compute pairwise log beliefs based on current messages, and stores them in pair_belief_tensor. Does nothing if
+        pair_belief_tensor was already computed from the current messages, potentials, and augmented_mat.
+
+        :return: None
+        """
+        if not self._is_fresh(self._pair_belief_state):
+            self.compute_beliefs()
+            self._compute_pairwise_beliefs()
+            self._pair_belief_state = self._current_state()
+
+    def _compute_beliefs(self):
         """
         Compute unary log beliefs based on current messages and store them in belief_mat
         
@@ -114,13 +395,14 @@ class MatrixBeliefPropagator(Inference):
         """
         if not self.fully_conditioned:
             self.belief_mat = self.mn.unary_mat + self.augmented_mat
-            self.belief_mat += sparse_dot(self.message_mat, self.mn.message_to_map)
+            self.belief_mat += self.mn.sum_messages(self.message_mat)
 
             self.belief_mat -= logsumexp(self.belief_mat, 0)
 
-    def compute_pairwise_beliefs(self):
+    def _compute_pairwise_beliefs(self):
         """
-        Compute pairwise log beliefs based on current messages, and stores them in pair_belief_tensor
+        Compute pairwise log beliefs based on current messages and the current unary beliefs, and stores them in
+        pair_belief_tensor
 
         :return: None
         """
@@ -140,30 +422,258 @@ class MatrixBeliefPropagator(Inference):
 
             self.pair_belief_tensor = beliefs
 
-    def update_messages(self):
+    def update_messages(self, compute_change=True):
         """
         Update all messages between variables and store them in message_mat 
 
+        :param compute_change: Boolean value of whether to measure the change in messages. If False, the change is not
+                                computed and np.inf is returned.
         :return: the float change in messages from previous iteration.
         """
         self.compute_beliefs()
 
+        return self._update_message_blocks(compute_change, self.belief_mat)
+
+    def _reversed_messages(self, start, stop):
+        """
+        Gather the messages that travel in the opposite direction of a contiguous block of messages.
+
+        :param start: index of the first message of the block
+        :type start: int
+        :param stop: index after the last message of the block
+        :type stop: int
+        :return: (max_states, stop - start) matrix whose columns are the reverse of each message in the block. It is
+                    a view of message_mat if the block does not contain both forward and backward messages.
+        :rtype: ndarray
+        """
+        num_edges = self.mn.num_edges
+
+        # forward message i and backward message i + num_edges are the reverse of each other
+        if stop <= num_edges:
+            return self.message_mat[:, start + num_edges:stop + num_edges]
+        if start >= num_edges:
+            return self.message_mat[:, start - num_edges:stop - num_edges]
+        return np.hstack((self.message_mat[:, start + num_edges:], self.message_mat[:, :stop - num_edges]))
+
+    def _compute_message_block(self, start, stop, beliefs):
+        """
+        Compute updated values of a contiguous block of messages, without storing them. Used by update_messages.
+        Subclasses that change the message update rule override this method to match.
+
+        :param start: index of the first message of the block
+        :type start: int
+        :param stop: index after the last message of the block
+        :type stop: int
+        :param beliefs: unary log beliefs of all variables
+        :type beliefs: ndarray
+        :return: (max_states, stop - start) matrix of updated messages
+        :rtype: ndarray
+        """
         # Using the beliefs as the sum of all incoming log messages, subtract the outgoing messages and add the edge
         # potential.
-        adjusted_message_prod = self.mn.edge_pot_tensor + self.belief_mat[:, self.mn.message_from] \
-                                - np.hstack((self.message_mat[:, self.mn.num_edges:],
-                                             self.message_mat[:, :self.mn.num_edges]))
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, start:stop] \
+                                + beliefs[:, self.mn.message_from[start:stop]] \
+                                - self._reversed_messages(start, stop)
+
+        messages = logsumexp(adjusted_message_prod, 1).reshape((self.mn.max_states, stop - start))
+        return np.nan_to_num(messages - messages.max(0))
+
+    def _update_message_blocks(self, compute_change, *arrays):
+        """
+        Compute all messages with _compute_message_block and store them. Without a thread pool, the messages are
+        computed as a single block. Otherwise, each thread computes, damps, and measures the change of one block, and
+        their changes are combined according to the convergence policy. Adaptive damping adjusts step sizes based on
+        the change of all messages, so it is applied after every block is computed.
+
+        :param compute_change: Boolean value of whether to measure the change in messages
+        :param arrays: arrays computed once per update, such as the unary beliefs, passed to _compute_message_block
+        :return: the float change in messages, or np.inf if compute_change is False
+        """
+        num_messages = 2 * self.mn.num_edges
+
+        if self._thread_pool is None:
+            return self._store_messages(self._compute_message_block(0, num_messages, *arrays), compute_change)
 
-        messages = np.squeeze(logsumexp(adjusted_message_prod, 1))
-        messages = np.nan_to_num(messages - messages.max(0))
+        messages = np.empty((self.mn.max_states, num_messages))
+        store_blocks = not self.adaptive_damping
+        if store_blocks and compute_change and self.convergence_norm == 'max':
+            self._residual_buffer()
 
-        with np.errstate(over='ignore'):
-            change = np.sum(np.abs(messages - self.message_mat))
+        def update_block(start, stop):
+            """Compute one block of messages and, unless damping is adaptive, damp it and measure its change."""
+            messages[:, start:stop] = self._compute_message_block(start, stop, *arrays)
+            if store_blocks:
+                return self._store_message_block(messages, start, stop, compute_change)
+            return 0
+
+        bounds = np.linspace(0, num_messages, self.num_threads + 1).astype(int)
+        changes = list(self._thread_pool.map(update_block, bounds[:-1], bounds[1:]))
+
+        if not store_blocks:
+            return self._store_messages(messages, compute_change)
 
         self.message_mat = messages
+        self.message_version += 1
 
+        if not compute_change:
+            return np.inf
+        if self.convergence_norm == 'max':
+            return max(changes)
+
+        change = sum(changes)
+        if self.convergence_norm == 'mean' and num_messages > 0:
+            change /= num_messages
         return change
 
+    def _store_message_block(self, messages, start, stop, compute_change=True):
+        """
+        Apply damping to a block of newly computed messages and measure its change, as _store_messages does for all
+        messages. Blocks are updated concurrently, so this only writes to the block's columns of messages and of
+        residuals.
+
+        :param messages: new message matrix, whose block is overwritten with the damped messages if damping is enabled
+        :type messages: ndarray
+        :param start: index of the first message of the block
+        :type start: int
+        :param stop: index after the last message of the block
+        :type stop: int
+        :param compute_change: Boolean value of whether to measure the change in messages
+        :return: the total absolute change of the block, or its largest change when using the 'max' norm. 0 if
+                    compute_change is False or the block is empty.
+        :rtype: float
+        """
+        block = messages[:, start:stop]
+        previous = self.message_mat[:, start:stop]
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            delta = block - previous
+
+            if self.damping != 0:
+                delta *= self.message_step
+                np.add(previous, delta, out=block)
+                block[...] = np.nan_to_num(block)
+                block -= block.max(0)
+
+            if not compute_change or delta.size == 0:
+                return 0
+
+            np.abs(delta, out=delta)
+
+            if self.convergence_norm == 'max':
+                self.residuals[start:stop] = delta.max(0)
+                return self.residuals[start:stop].max()
+            return delta.sum()
+
+    def _sum_incoming(self, variables, weights=None):
+        """
+        Sum the messages received by a subset of variables, touching only the messages sent to them.
+
+        :param variables: array of variable indices
+        :type variables: ndarray
+        :param weights: optional array with a weight to multiply each message by before summing
+        :type weights: ndarray
+        :return: (max_states, len(variables)) matrix of summed incoming log messages
+        :rtype: ndarray
+        """
+        if self._incoming_map is None:
+            self._incoming_map = self.mn.message_sum_map.tocsr()
+
+        incoming_map = self._incoming_map[variables]
+        if weights is not None:
+            incoming_map = incoming_map.multiply(weights).tocsr()
+
+        return incoming_map.dot(self.message_mat.T).T
+
+    def _compute_messages(self, indices):
+        """
+        Compute updated values of a subset of messages from the current messages, without storing them. Used by
+        infer_incremental. Subclasses that change the message update rule override this method to match.
+
+        :param indices: array of message indices
+        :type indices: ndarray
+        :return: (max_states, len(indices)) matrix of updated messages
+        :rtype: ndarray
+        """
+        variables = self.mn.message_from[indices]
+        beliefs = self.mn.unary_mat[:, variables] + self.augmented_mat[:, variables] + self._sum_incoming(variables)
+        beliefs -= logsumexp(beliefs, 0)
+
+        reverse = (indices + self.mn.num_edges) % (2 * self.mn.num_edges)
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, indices] + beliefs - self.message_mat[:, reverse]
+
+        messages = logsumexp(adjusted_message_prod, 1).reshape((self.mn.max_states, len(indices)))
+        return np.nan_to_num(messages - messages.max(0))
+
+    def _store_messages(self, messages, compute_change=True):
+        """
+        Replace the message matrix with newly computed messages, applying damping if it is enabled, and measure how
+        much they changed according to the convergence policy. The change is computed in a preallocated buffer to
+        avoid allocating temporaries.
+
+        :param messages: new message matrix. It is overwritten with the damped messages if damping is enabled.
+        :type messages: ndarray
+        :param compute_change: Boolean value of whether to measure the change in messages
+        :return: the float change in messages, or np.inf if compute_change is False
+        """
+        change = np.inf
+        damped = self.damping != 0 or self.adaptive_damping
+
+        if compute_change or damped:
+            if self._change_buffer is None or self._change_buffer.shape != messages.shape:
+                self._change_buffer = np.empty(messages.shape)
+
+            with np.errstate(over='ignore', invalid='ignore'):
+                np.subtract(messages, self.message_mat, out=self._change_buffer)
+
+                if damped:
+                    self._damp_messages(messages, self._change_buffer)
+
+            if not compute_change:
+                self.message_mat = messages
+                self.message_version += 1
+                return change
+
+            with np.errstate(over='ignore', invalid='ignore'):
+                np.abs(self._change_buffer, out=self._change_buffer)
+
+                if self.convergence_norm == 'max':
+                    residuals = self._residual_buffer()
+                    np.max(self._change_buffer, 0, out=residuals)
+                    change = residuals.max() if residuals.size else 0
+                else:
+                    change = self._change_buffer.sum()
+                    if self.convergence_norm == 'mean' and messages.shape[1] > 0:
+                        change /= messages.shape[1]
+
+        self.message_mat = messages
+        self.message_version += 1
+
+        return change
+
+    def _damp_messages(self, messages, delta):
+        """
+        Overwrite messages with the damped step from the current messages, and scale delta to the step taken.
+
+        :param messages: updated message matrix, overwritten with the damped messages
+        :type messages: ndarray
+        :param delta: difference between the updated messages and the current messages, scaled in place
+        :type delta: ndarray
+        :return: None
+        """
+        if self.adaptive_damping:
+            if self._previous_delta is not None and self._previous_delta.shape == delta.shape:
+                # messages whose update reversed direction are oscillating, so shrink their steps
+                oscillating = np.sum(delta * self._previous_delta, 0) < 0
+                self.message_step = np.where(oscillating,
+                                             np.maximum(0.5 * self.message_step, self.min_message_step),
+                                             np.minimum(1.05 * self.message_step, 1 - self.damping))
+            self._previous_delta = delta.copy()
+
+        delta *= self.message_step
+        np.add(self.message_mat, delta, out=messages)
+        np.nan_to_num(messages, copy=False)
+        messages -= messages.max(0)
+
     def _compute_inconsistency_vector(self):
         """
         Compute the vector of inconsistencies between unary beliefs and pairwise beliefs
@@ -188,46 +698,219 @@ class MatrixBeliefPropagator(Inference):
 
         return disagreement
 
+    def potentials_stale(self):
+        """
+        Check whether the model potentials changed since inference last converged.
+
+        :return: True if the potentials were updated after the last converged run of inference
+        :rtype: bool
+        """
+        return self.potential_version != self.mn.potential_version
+
+    def is_converged(self, tolerance=1e-8):
+        """
+        Check whether the current messages are already converged to within tolerance for the current potentials, i.e.,
+        whether running inference again would leave them unchanged.
+
+        :param tolerance: the convergence tolerance inference would be run with
+        :return: True if the messages, potentials, and conditioning are unchanged since inference converged
+        :rtype: bool
+        """
+        return self.converged_messages is self.message_mat and self.converged_tolerance <= tolerance \
+            and not self.potentials_stale()
+
     def infer(self, tolerance=1e-8, display='iter'):
         """
-        Run belief propagation until messages change less than tolerance.
+        Run belief propagation until messages change less than tolerance. If the messages already converged for the
+        current potentials, this method returns immediately.
+
+        Progress is reported through this module's logger, so nothing is formatted or computed for display unless
+        the logger is enabled for the corresponding level. Metrics can also be collected with set_callback.
 
         :param tolerance: the minimum amount that the messages can change while message passing can be considered not
                             converged
-        :param display: string parameter indicating how much to display. Options are 'full' and 'iter'
-                        'full' prints the energy functional and dual objective each iteration,
+        :param display: string parameter indicating how much to log. Options are 'full', 'iter', 'final', and 'off'.
+                        'full' logs the energy functional and dual objective each iteration at DEBUG level,
                                 which requires extra computation
-                        'iter' prints just the change in messages each iteration
+                        'iter' logs just the change in messages each iteration at DEBUG level
+                        'final' logs only the number of iterations at INFO level, which 'full' and 'iter' also do
         :return: None
         """
+        log_iter = display in ('full', 'iter') and logger.isEnabledFor(logging.DEBUG)
+        log_final = display in ('full', 'iter', 'final') and logger.isEnabledFor(logging.INFO)
+
         change = np.inf
         iteration = 0
+        if self.is_converged(tolerance):
+            change = 0
         while change > tolerance and iteration < self.max_iter:
-            change = self.update_messages()
-            if display == "full":
-                energy_func = self.compute_energy_functional()
-                disagreement = self.compute_inconsistency()
-                dual_obj = self.compute_dual_objective()
-                print("Iteration %d, change in messages %f. Calibration disagreement: %f, "
-                      "energy functional: %f, dual obj: %f" % (iteration, change, disagreement, energy_func, dual_obj))
-            elif display == "iter":
-                print("Iteration %d, change in messages %f." % (iteration, change))
+            # only measure convergence every convergence_interval iterations and on the last allowed iteration
+            check = (iteration + 1) % self.convergence_interval == 0 or iteration + 1 == self.max_iter
+
+            if self.callback is not None:
+                start = time.time()
+                change = self.update_messages(compute_change=check)
+                metrics = {'iteration': iteration, 'change': change, 'time': time.time() - start}
+                if self.diagnostic_interval and iteration % self.diagnostic_interval == 0:
+                    metrics.update(self.compute_diagnostics())
+                self.callback(metrics)
+            else:
+                change = self.update_messages(compute_change=check)
+
+            if log_iter and display == 'full':
+                diagnostics = self.compute_diagnostics()
+                logger.debug("Iteration %d, change in messages %f. Calibration disagreement: %f, "
+                             "energy functional: %f, dual obj: %f", iteration, change, diagnostics['inconsistency'],
+                             diagnostics['energy_functional'], diagnostics['dual_objective'])
+            elif log_iter and check:
+                logger.debug("Iteration %d, change in messages %f.", iteration, change)
             iteration += 1
-        if display == 'final' or display == 'full' or display == 'iter':
-            print("Belief propagation finished in %d iterations." % iteration)
 
-    def load_beliefs(self):
+        self.num_iterations = iteration
+        if log_final:
+            logger.info("Belief propagation finished in %d iterations.", iteration)
+
+        if change <= tolerance:
+            self.converged_messages = self.message_mat
+            self.converged_tolerance = tolerance
+            self.potential_version = self.mn.potential_version
+            if self.message_store is not None:
+                self.message_store.save(self.mn, self.message_mat)
+        else:
+            self.converged_messages = None
+
+    def _supports_incremental(self):
+        """
+        Check whether _compute_messages matches the update rule of this class, i.e., whether no class between this
+        object's class and the one that defines _compute_messages overrides update_messages.
+
+        :return: True if infer_incremental can update messages selectively
+        :rtype: bool
+        """
+        for klass in type(self).__mro__:
+            if '_compute_messages' in vars(klass):
+                return True
+            if 'update_messages' in vars(klass):
+                return False
+        return False
+
+    def _save_incremental_snapshot(self):
+        """
+        Record the potential version of the model that the current messages converged for, and start recording the
+        variables whose augmented potentials change, so infer_incremental can find what changed.
+
+        :return: None
+        """
+        self._incremental_snapshot = (self.mn.potential_version, [])
+
+    def _changed_messages(self):
+        """
+        Find the messages that directly depend on a potential that changed since the snapshot was saved: the messages
+        sent by variables whose unary potentials or conditioning changed, and the messages in both directions along
+        edges whose potentials changed. The changes are looked up in the model's log of potential changes and the
+        variables recorded since the snapshot, so the cost does not depend on the size of the model.
+
+        :return: sorted array of message indices, or None if the model cannot tell which potentials changed
+        :rtype: ndarray
+        """
+        version, augmented_vars = self._incremental_snapshot
+        changes = self.mn.potential_changes_since(version)
+        if changes is None:
+            return None
+
+        if self._outgoing_map is None:
+            self._outgoing_map = csr_matrix((np.ones(2 * self.mn.num_edges),
+                                             (self.mn.message_from, np.arange(2 * self.mn.num_edges))),
+                                            (self.mn.unary_mat.shape[1], 2 * self.mn.num_edges))
+
+        changed_vars, changed_edges = changes
+        changed_vars = np.union1d(changed_vars, np.array(augmented_vars, dtype=np.intp))
+        return np.union1d(self._outgoing_map[changed_vars].indices,
+                          np.concatenate((changed_edges, changed_edges + self.mn.num_edges)))
+
+    def infer_incremental(self, tolerance=1e-8, display='iter'):
+        """
+        Rerun inference after a few potentials changed, e.g., after conditioning some variables, by updating only the
+        messages affected by the change. The messages that depend directly on a changed unary potential, edge
+        potential, or conditioned variable are updated first. Every message that changes by more than the tolerance
+        marks the messages sent by its receiver for updating, so updates propagate outward from the change and stop
+        where their effect falls below the tolerance. The cost therefore scales with the size of the affected region
+        rather than the size of the model.
+
+        The first call, and any call after the messages were reinitialized, runs full inference with infer. So does
+        any call after the model's matrices were rebuilt or its potentials were set more than POTENTIAL_LOG_LENGTH
+        times since the last call, because the model no longer knows which potentials changed. Damping is not applied
+        to incremental updates. Classes whose message update rule has no selective counterpart (_compute_messages)
+        always run full inference.
+
+        :param tolerance: largest change in any entry of a message that does not cause its neighbors to be updated
+        :param display: string parameter indicating how much to log. Options are as in infer.
+        :return: None
+        """
+        active = None
+        if self._incremental_snapshot is not None and not self.fully_conditioned and self._supports_incremental():
+            active = self._changed_messages()
+
+        if active is None:
+            self.infer(tolerance, display)
+            self.num_updates = self.num_iterations * 2 * self.mn.num_edges
+            if self.converged_messages is not None:
+                self._save_incremental_snapshot()
+            return
+
+        self.converged_messages = None
+
+        # updates are written into message_mat in place, so copy it once to leave arrays shared with others untouched
+        self.message_mat = self.message_mat.copy()
+
+        iteration = 0
+        self.num_updates = 0
+        while active.size and iteration < self.max_iter:
+            messages = self._compute_messages(active)
+            self.num_updates += active.size
+
+            changed = np.abs(messages - self.message_mat[:, active]).max(0) > tolerance
+
+            # the message version marks the beliefs computed before this in-place update as stale
+            self.message_mat[:, active[changed]] = messages[:, changed]
+            self.message_version += 1
+
+            active = np.unique(self._outgoing_map[self.mn.message_to[active[changed]]].indices)
+            iteration += 1
+
+        self.num_iterations = iteration
+        if display in ('full', 'iter', 'final') and logger.isEnabledFor(logging.INFO):
+            logger.info("Incremental belief propagation finished in %d iterations with %d message updates.",
+                        iteration, self.num_updates)
+
+        if active.size == 0:
+            self.converged_messages = self.message_mat
+            self.converged_tolerance = tolerance
+            self.potential_version = self.mn.potential_version
+            self._save_incremental_snapshot()
+            if self.message_store is not None:
+                self.message_store.save(self.mn, self.message_mat)
+        else:
+            self._incremental_snapshot = None
+
+    def load_beliefs(self, pairwise=True):
         """
         Update the belief dictionaries var_beliefs and pair_beliefs using the current messages.
 
+        :param pairwise: if False, only update var_beliefs, which avoids computing pairwise beliefs
+        :type pairwise: bool
         :return: None
         """
         self.compute_beliefs()
-        self.compute_pairwise_beliefs()
 
         for (var, i) in self.mn.var_index.items():
             self.var_beliefs[var] = self.belief_mat[:len(self.mn.unary_potentials[var]), i]
 
+        if not pairwise:
+            return
+
+        self.compute_pairwise_beliefs()
+
         for edge, i in self.mn.message_index.items():
             (var, neighbor) = edge
 
@@ -238,13 +921,63 @@ class MatrixBeliefPropagator(Inference):
 
             self.pair_beliefs[(neighbor, var)] = belief.T
 
+    def decode(self):
+        """
+        Find the most likely state of each variable under the current beliefs, which is the MAP state for max-product
+        inference. Unlike load_beliefs, this does not compute pairwise beliefs or build belief dictionaries.
+
+        :return: integer array of the state index of each variable, in the order of the MarkovNet's var_index
+        :rtype: ndarray
+        """
+        self.compute_beliefs()
+        return self.belief_mat.argmax(0)
+
+    @classmethod
+    def predict_batch(cls, models, weights=None, tolerance=1e-8, max_iter=None):
+        """
+        Run inference and decoding for each of a list of models, e.g., to label many images with learned weights.
+
+        :param models: list of MarkovNet objects
+        :type models: list
+        :param weights: weight vector to set on every model before inference, or None to use their current potentials.
+                        Requires the models to be LogLinearModel objects.
+        :type weights: ndarray
+        :param tolerance: convergence tolerance of inference
+        :type tolerance: float
+        :param max_iter: maximum iterations of inference, or None to use the default
+        :type max_iter: int
+        :return: list of integer arrays of the decoded state of each variable, in the order of each model's var_index
+        :rtype: list
+        """
+        predictions = []
+        for model in models:
+            if weights is not None:
+                model.set_weights(weights)
+
+            bp = cls(model)
+            if max_iter is not None:
+                bp.set_max_iter(max_iter)
+            bp.infer(tolerance=tolerance, display='off')
+            predictions.append(bp.decode())
+
+        return predictions
+
     def compute_bethe_entropy(self):
         """
-        Compute Bethe entropy from current beliefs. 
-        This method assumes that the beliefs have been computed and are fresh.
-        
+        Compute Bethe entropy from current beliefs. The value is reused until the messages or potentials change.
+
         :return: computed Bethe entropy
         """
+        return self._memoize('entropy', self._compute_bethe_entropy)
+
+    def _compute_bethe_entropy(self):
+        """
+        Compute Bethe entropy from current beliefs.
+
+        :return: computed Bethe entropy
+        """
+        self.compute_pairwise_beliefs()
+
         if self.fully_conditioned:
             entropy = 0
         else:
@@ -255,10 +988,20 @@ class MatrixBeliefPropagator(Inference):
 
     def compute_energy(self):
         """
-        Compute the log-linear energy. Assume that the beliefs have been computed and are fresh.
+        Compute the log-linear energy. The value is reused until the messages or potentials change.
 
         :return: computed energy
         """
+        return self._memoize('energy', self._compute_energy)
+
+    def _compute_energy(self):
+        """
+        Compute the log-linear energy from current beliefs.
+
+        :return: computed energy
+        """
+        self.compute_pairwise_beliefs()
+
         energy = np.sum(
             np.nan_to_num(self.mn.edge_pot_tensor[:, :, self.mn.num_edges:]) * np.exp(self.pair_belief_tensor)) + \
                  np.sum(np.nan_to_num(self.mn.unary_mat) * np.exp(self.belief_mat))
@@ -268,18 +1011,34 @@ class MatrixBeliefPropagator(Inference):
     def get_feature_expectations(self):
         """
         Computes the feature expectations under the currently estimated marginal probabilities. Only works when the 
-        model is a LogLinearModel class with features for edges. 
+        model is a LogLinearModel class with features for edges. Sparse feature matrices are multiplied in sparse form,
+        so the cost scales with the number of nonzero features.
+
+        The expectations are reused until the messages or potentials change, so this method returns a copy.
 
         :return: vector of the marginals in order of the flattened unary features first, then the flattened pairwise 
                     features
         """
+        return self._memoize('feature_expectations', self._compute_feature_expectations).copy()
+
+    def _compute_feature_expectations(self):
+        """
+        Compute the feature expectations under the current beliefs.
+
+        :return: vector of the marginals in order of the flattened unary features first, then the flattened pairwise
+                    features
+        """
         self.compute_beliefs()
-        self.compute_pairwise_beliefs()
 
         summed_features = self.mn.unary_feature_mat.dot(np.exp(self.belief_mat).T)
 
-        summed_pair_features = self.mn.edge_feature_mat.dot(np.exp(self.pair_belief_tensor).reshape(
-            (self.mn.max_states ** 2, self.mn.num_edges)).T)
+        if self.mn.edge_feature_mat.shape[0] == 0:
+            # without edge features, the pairwise beliefs are not needed
+            summed_pair_features = np.zeros((0, self.mn.max_states ** 2))
+        else:
+            self.compute_pairwise_beliefs()
+            summed_pair_features = self.mn.edge_feature_mat.dot(np.exp(self.pair_belief_tensor).reshape(
+                (self.mn.max_states ** 2, self.mn.num_edges)).T)
 
         marginals = np.append(summed_features.reshape(-1), summed_pair_features.reshape(-1))
 
@@ -291,8 +1050,6 @@ class MatrixBeliefPropagator(Inference):
 
         :return: computed energy functional
         """
-        self.compute_beliefs()
-        self.compute_pairwise_beliefs()
         return self.compute_energy() + self.compute_bethe_entropy()
 
     def compute_dual_objective(self):
@@ -301,14 +1058,14 @@ class MatrixBeliefPropagator(Inference):
 
         :return: Lagrangian objective function
         """
-        objective = self.compute_energy_functional() + \
-                    np.sum(self.message_mat * self._compute_inconsistency_vector())
-
-        return objective
+        return self._memoize('dual_objective', lambda: self.compute_energy_functional() +
+                             np.sum(self.message_mat * self._compute_inconsistency_vector()))
 
     def set_messages(self, messages):
         """
         Set the message vector. Useful for warm-starting inference if a previously computed message matrix is available.
+        Beliefs and quantities memoized from the previous messages are recomputed when next requested, and the next
+        call of infer_incremental runs full inference, since the new messages did not converge for its snapshot.
         
         :param messages: message matrix
         :type messages: ndarray
@@ -316,6 +1073,8 @@ class MatrixBeliefPropagator(Inference):
         """
         assert (np.all(self.message_mat.shape == messages.shape))
         self.message_mat = messages
+        self.message_version += 1
+        self._incremental_snapshot = None
 
 
 def logsumexp(matrix, dim=None):
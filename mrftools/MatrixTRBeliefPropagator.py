@@ -1,7 +1,7 @@
 """Class to do tree-reweighted belief propagation with matrix-based computation."""
 import numpy as np
 
-from .MatrixBeliefPropagator import MatrixBeliefPropagator, logsumexp, sparse_dot
+from .MatrixBeliefPropagator import MatrixBeliefPropagator, logsumexp
 
 
 class MatrixTRBeliefPropagator(MatrixBeliefPropagator):
@@ -49,9 +49,12 @@ class MatrixTRBeliefPropagator(MatrixBeliefPropagator):
             else:
                 raise KeyError('Edge %s was not assigned a probability.' % repr(edge))
 
-        self.expected_degrees = sparse_dot(self.tree_probabilities.T, self.mn.message_to_map).T
+        self.expected_degrees = self.mn.sum_messages(self.tree_probabilities)
+        self.invalidate_beliefs()
+
+    def _compute_bethe_entropy(self):
+        self.compute_pairwise_beliefs()
 
-    def compute_bethe_entropy(self):
         if self.fully_conditioned:
             entropy = 0
         else:
@@ -61,33 +64,41 @@ class MatrixTRBeliefPropagator(MatrixBeliefPropagator):
 
         return entropy
 
-    def update_messages(self):
+    def update_messages(self, compute_change=True):
         self.compute_beliefs()
 
-        adjusted_message_prod = self.belief_mat[:, self.mn.message_from] \
-                                - np.hstack((self.message_mat[:, self.mn.num_edges:],
-                                             self.message_mat[:, :self.mn.num_edges]))
+        return self._update_message_blocks(compute_change, self.belief_mat)
+
+    def _compute_message_block(self, start, stop, beliefs):
+        adjusted_message_prod = beliefs[:, self.mn.message_from[start:stop]] - self._reversed_messages(start, stop)
 
-        messages = np.squeeze(logsumexp(self.mn.edge_pot_tensor / self.tree_probabilities + adjusted_message_prod, 1))
-        messages = np.nan_to_num(messages - messages.max(0))
+        messages = logsumexp(self.mn.edge_pot_tensor[:, :, start:stop] / self.tree_probabilities[start:stop]
+                             + adjusted_message_prod, 1).reshape((self.mn.max_states, stop - start))
+        return np.nan_to_num(messages - messages.max(0))
 
-        with np.errstate(over='ignore'):
-            change = np.sum(np.abs(messages - self.message_mat))
+    def _compute_messages(self, indices):
+        variables = self.mn.message_from[indices]
+        beliefs = self.mn.unary_mat[:, variables] + self.augmented_mat[:, variables] + \
+            self._sum_incoming(variables, self.tree_probabilities)
+        beliefs -= logsumexp(beliefs, 0)
 
-        self.message_mat = messages
+        reverse = (indices + self.mn.num_edges) % (2 * self.mn.num_edges)
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, indices] / self.tree_probabilities[indices] + beliefs \
+            - self.message_mat[:, reverse]
 
-        return change
+        messages = logsumexp(adjusted_message_prod, 1).reshape((self.mn.max_states, len(indices)))
+        return np.nan_to_num(messages - messages.max(0))
 
-    def compute_beliefs(self):
+    def _compute_beliefs(self):
         if not self.fully_conditioned:
             self.belief_mat = self.mn.unary_mat + self.augmented_mat
-            self.belief_mat += sparse_dot(self.message_mat * self.tree_probabilities, self.mn.message_to_map)
+            self.belief_mat += self.mn.sum_messages(self.message_mat * self.tree_probabilities)
 
             log_z = logsumexp(self.belief_mat, 0)
 
             self.belief_mat = self.belief_mat - log_z
 
-    def compute_pairwise_beliefs(self):
+    def _compute_pairwise_beliefs(self):
         if not self.fully_conditioned:
             adjusted_message_prod = self.belief_mat[:, self.mn.message_from] \
                                     - np.hstack((self.message_mat[:, self.mn.num_edges:],
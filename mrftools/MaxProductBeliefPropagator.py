@@ -1,7 +1,7 @@
 """Class to run max-product belief propagation."""
 import numpy as np
 
-from .MatrixBeliefPropagator import MatrixBeliefPropagator, sparse_dot, logsumexp
+from .MatrixBeliefPropagator import MatrixBeliefPropagator, logsumexp
 
 
 class MaxProductBeliefPropagator(MatrixBeliefPropagator):
@@ -17,16 +17,16 @@ class MaxProductBeliefPropagator(MatrixBeliefPropagator):
         """
         super(MaxProductBeliefPropagator, self).__init__(markov_net)
 
-    def compute_beliefs(self):
+    def _compute_beliefs(self):
         if not self.fully_conditioned:
             max_marginals = self.mn.unary_mat + self.augmented_mat
-            max_marginals += sparse_dot(self.message_mat, self.mn.message_to_map)
+            max_marginals += self.mn.sum_messages(self.message_mat)
 
             states = max_marginals.argmax(0)
             self.belief_mat = -np.inf * np.ones(max_marginals.shape)
             self.belief_mat[states, range(self.belief_mat.shape[1])] = 0
 
-    def compute_pairwise_beliefs(self):
+    def _compute_pairwise_beliefs(self):
         if not self.fully_conditioned:
             adjusted_message_prod = self.belief_mat[:, self.mn.message_from] \
                                     - np.hstack((self.message_mat[:, self.mn.num_edges:],
@@ -41,22 +41,28 @@ class MaxProductBeliefPropagator(MatrixBeliefPropagator):
 
             self.pair_belief_tensor = np.where(max_marginals == max_marginals.max((0, 1)), 0, -np.inf)
 
-    def update_messages(self):
+    def update_messages(self, compute_change=True):
         belief_mat = self.mn.unary_mat + self.augmented_mat
-        belief_mat += sparse_dot(self.message_mat, self.mn.message_to_map)
+        belief_mat += self.mn.sum_messages(self.message_mat)
 
         belief_mat -= logsumexp(belief_mat, 0)
 
-        adjusted_message_prod = self.mn.edge_pot_tensor - np.hstack((self.message_mat[:, self.mn.num_edges:],
-                                                                     self.message_mat[:, :self.mn.num_edges]))
-        adjusted_message_prod += belief_mat[:, self.mn.message_from]
+        return self._update_message_blocks(compute_change, belief_mat)
 
-        messages = np.squeeze(adjusted_message_prod.max(1))
-        messages = np.nan_to_num(messages - messages.max(0))
+    def _compute_message_block(self, start, stop, beliefs):
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, start:stop] - self._reversed_messages(start, stop)
+        adjusted_message_prod += beliefs[:, self.mn.message_from[start:stop]]
 
-        with np.errstate(over='ignore'):
-            change = np.sum(np.abs(messages - self.message_mat))
+        messages = adjusted_message_prod.max(1)
+        return np.nan_to_num(messages - messages.max(0))
 
-        self.message_mat = messages
+    def _compute_messages(self, indices):
+        variables = self.mn.message_from[indices]
+        belief_mat = self.mn.unary_mat[:, variables] + self.augmented_mat[:, variables] + self._sum_incoming(variables)
+        belief_mat -= logsumexp(belief_mat, 0)
+
+        reverse = (indices + self.mn.num_edges) % (2 * self.mn.num_edges)
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, indices] + belief_mat - self.message_mat[:, reverse]
 
-        return change
+        messages = adjusted_message_prod.max(1)
+        return np.nan_to_num(messages - messages.max(0))
@@ -1,7 +1,6 @@
 """Class to run max-product linear programming for linear-programming MAP inference."""
 import numpy as np
 
-from .MatrixBeliefPropagator import sparse_dot
 from .MaxProductBeliefPropagator import MaxProductBeliefPropagator
 
 
@@ -18,26 +17,21 @@ class MaxProductLinearProgramming(MaxProductBeliefPropagator):
         """
         super(MaxProductLinearProgramming, self).__init__(markov_net)
 
-    def update_messages(self):
-        message_sum = sparse_dot(self.message_mat, self.mn.message_to_map)
+    def update_messages(self, compute_change=True):
+        message_sum = self.mn.sum_messages(self.message_mat)
 
         max_marginals = self.mn.unary_mat + self.augmented_mat
         max_marginals += message_sum
 
-        adjusted_message_prod = self.mn.edge_pot_tensor - np.hstack((self.message_mat[:, self.mn.num_edges:],
-                                                                     self.message_mat[:, :self.mn.num_edges]))
-        adjusted_message_prod += max_marginals[:, self.mn.message_from]
+        return self._update_message_blocks(compute_change, max_marginals, message_sum)
 
-        incoming_messages = np.squeeze(adjusted_message_prod.max(1))
+    def _compute_message_block(self, start, stop, max_marginals, message_sum):
+        adjusted_message_prod = self.mn.edge_pot_tensor[:, :, start:stop] - self._reversed_messages(start, stop)
+        adjusted_message_prod += max_marginals[:, self.mn.message_from[start:stop]]
 
-        outgoing_messages = message_sum[:, self.mn.message_to] - self.message_mat
-        messages = 0.5 * np.nan_to_num(incoming_messages - np.nan_to_num(outgoing_messages))
-
-        messages = np.nan_to_num(messages - messages.max(0))
+        incoming_messages = adjusted_message_prod.max(1)
 
-        with np.errstate(over='ignore'):
-            change = np.sum(np.abs(messages - self.message_mat))
-
-        self.message_mat = messages
+        outgoing_messages = message_sum[:, self.mn.message_to[start:stop]] - self.message_mat[:, start:stop]
+        messages = 0.5 * np.nan_to_num(incoming_messages - np.nan_to_num(outgoing_messages))
 
-        return change
+        return np.nan_to_num(messages - messages.max(0))
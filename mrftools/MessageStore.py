@@ -0,0 +1,94 @@
+"""Class for storing converged messages to warm-start inference on models with the same structure."""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class MessageStore(object):
+    """
+    Least-recently-used store of converged message matrices keyed by the structure of the model they were computed
+    for. Sequences of models with identical structure, such as the frames of a video or near-duplicate images, can
+    share a store through MatrixBeliefPropagator.set_message_store, so inference on each new model starts from the
+    messages that converged for the previous one.
+
+    Messages are copied when they are saved and when they are loaded, so stored messages are never modified by
+    inference.
+    """
+    def __init__(self, capacity=16):
+        """
+        Initialize an empty message store.
+
+        :param capacity: maximum number of model structures to keep messages for. When a new structure is saved into a
+                            full store, the least recently used structure is evicted.
+        :type capacity: int
+        """
+        assert capacity >= 1, "Message store capacity must be at least 1"
+        self.capacity = capacity
+        self.messages = OrderedDict()
+
+    @staticmethod
+    def fingerprint(markov_net):
+        """
+        Compute a key identifying the structure of a model in matrix mode. Models with the same key have the same
+        message layout, so their messages are interchangeable.
+
+        :param markov_net: MarkovNet whose matrices have been created
+        :type markov_net: MarkovNet
+        :return: tuple of the number of edges, the maximum number of states, and a digest of the message index arrays
+                    and variable cardinalities
+        :rtype: tuple
+        """
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(markov_net.message_from, dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(markov_net.message_to, dtype=np.int64).tobytes())
+        digest.update(np.array([markov_net.num_states[var] for var in markov_net.var_list], dtype=np.int64).tobytes())
+
+        return markov_net.num_edges, markov_net.max_states, digest.hexdigest()
+
+    def save(self, markov_net, message_mat):
+        """
+        Store a copy of the messages computed for a model, replacing any messages stored for its structure.
+
+        :param markov_net: model the messages were computed for
+        :type markov_net: MarkovNet
+        :param message_mat: message matrix
+        :type message_mat: ndarray
+        :return: None
+        """
+        key = self.fingerprint(markov_net)
+        self.messages.pop(key, None)
+        self.messages[key] = np.array(message_mat, copy=True)
+
+        while len(self.messages) > self.capacity:
+            self.messages.popitem(last=False)
+
+    def load(self, markov_net):
+        """
+        Get a copy of the most recently saved messages for the structure of a model.
+
+        :param markov_net: model to find messages for
+        :type markov_net: MarkovNet
+        :return: message matrix, or None if no messages are stored for the structure
+        :rtype: ndarray
+        """
+        key = self.fingerprint(markov_net)
+        if key not in self.messages:
+            return None
+
+        self.messages.move_to_end(key)
+        return self.messages[key].copy()
+
+    def clear(self):
+        """
+        Remove all stored messages.
+
+        :return: None
+        """
+        self.messages.clear()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __contains__(self, markov_net):
+        return self.fingerprint(markov_net) in self.messages
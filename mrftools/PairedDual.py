@@ -36,10 +36,16 @@ class PairedDual(Learner):
         """
         for bp in self.belief_propagators + self.conditioned_belief_propagators:
             bp.set_max_iter(self.bp_iter)
-            for i in range(self.warm_up):
-                bp.update_messages()
+            if self.resume_state is None:
+                # messages restored from a checkpoint are already warmed up
+                for i in range(self.warm_up):
+                    bp.update_messages()
 
         self.start_time = time.time()
-        new_weights = optimizer(self.dual_obj, self.subgrad_grad, weights, args=opt_args, callback=callback)
+        self.clear_cache()
+        func, grad = self.cached_functions(self.dual_obj)
+        opt_args, callback = self._checkpointing(opt_args, callback)
+        new_weights = optimizer(func, grad, weights, args=opt_args, callback=callback)
+        self._finish_learning()
 
         return new_weights
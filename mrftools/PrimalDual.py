@@ -39,6 +39,10 @@ class PrimalDual(PairedDual):
             bp.set_max_iter(self.dual_bp_iter)
 
         self.start_time = time.time()
-        res = optimizer(self.dual_obj, self.subgrad_grad, weights, args=opt_args, callback=callback)
+        self.clear_cache()
+        func, grad = self.cached_functions(self.dual_obj)
+        opt_args, callback = self._checkpointing(opt_args, callback)
+        res = optimizer(func, grad, weights, args=opt_args, callback=callback)
         new_weights = res
+        self._finish_learning()
         return new_weights
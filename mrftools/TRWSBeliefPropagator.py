@@ -0,0 +1,342 @@
+"""Class to run sequential tree-reweighted message passing (TRW-S) for MAP inference."""
+import logging
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .MatrixBeliefPropagator import MatrixBeliefPropagator
+
+logger = logging.getLogger(__name__)
+
+
+class TRWSBeliefPropagator(MatrixBeliefPropagator):
+    """
+    Class to find the most likely state with sequential tree-reweighted max-product message passing (TRW-S). Variables
+    are processed in a fixed order with alternating forward and backward passes. Each pass only updates the messages
+    sent in its direction, which makes the bound on the MAP score monotone for edge appearance probabilities that come
+    from monotonic chains in the order.
+
+    Variables that are not adjacent and have the same number of predecessors along chains in the order (wavefronts)
+    are updated together with matrix operations, which gives exactly the same result as updating them one at a time.
+    For grid models in row-major order, the wavefronts are the anti-diagonals, so each step updates every row at once.
+
+    The messages M use the reparameterization of Kolmogorov (2006): the belief of variable s is
+    theta_s + sum_u M_us, and the message to a later variable t is
+    M_st(x_t) = max_{x_s} rho_st * belief_s(x_s) - M_ts(x_s) + theta_st(x_s, x_t).
+    After each sweep, the upper bound on the log score of the MAP state (the lower bound on its energy in the
+    minimization form of TRW-S) is appended to bounds, and inference stops when a sweep decreases it by less than the
+    tolerance relative to its magnitude. On frustrated loopy models the bound keeps decreasing slowly for hundreds of
+    sweeps after the decoded state stops improving, so the default tolerance is looser than that of the other
+    propagators.
+    """
+    def __init__(self, markov_net, tree_probabilities=None, order=None):
+        """
+        Initialize a TRW-S object.
+
+        :param markov_net: Markov net to perform inference on.
+        :type markov_net: MarkovNet
+        :param tree_probabilities: Edge appearance probabilities, provided as a dict with a key-value pair for each
+                                    edge. If this parameter is not provided, the tree probabilities stored in the
+                                    Markov net object are used. If it has none, each variable's weight is split evenly
+                                    among the monotonic chains through it.
+        :type tree_probabilities: dict
+        :param order: list of all variables in the order to process them. By default, variables are sorted by name,
+                        or left in the Markov net's internal order if their names cannot be sorted.
+        :type order: list
+        """
+        super(TRWSBeliefPropagator, self).__init__(markov_net)
+
+        if order is None:
+            try:
+                order = sorted(self.mn.var_list)
+            except TypeError:
+                order = self.mn.var_list
+
+        self.bounds = []
+        self.labels = None
+        self._set_order(order)
+
+        if tree_probabilities:
+            self._set_tree_probabilities(tree_probabilities)
+        elif markov_net.tree_probabilities:
+            self._set_tree_probabilities(markov_net.tree_probabilities)
+        else:
+            self.tree_probabilities = 1.0 / self.chain_counts[self.mn.message_from]
+
+    def _set_order(self, order):
+        """
+        Store the processing order and precompute the wavefronts of the forward and backward passes and the
+        decomposition of the graph into monotonic chains.
+
+        :param order: list of all variables in the order to process them
+        :type order: list
+        :return: None
+        """
+        num_vars = len(self.mn.var_list)
+        assert len(order) == num_vars, "The order must contain every variable exactly once"
+        rank = np.zeros(num_vars, dtype=np.intp)
+        rank[[self.mn.var_index[var] for var in order]] = np.arange(num_vars)
+        self.order = list(order)
+
+        message_from = self.mn.message_from
+        message_to = self.mn.message_to
+        forward = rank[message_from] < rank[message_to]
+
+        # messages each variable receives from earlier and later neighbors, grouped by receiving variable
+        earlier_in = [[] for _ in range(num_vars)]
+        later_in = [[] for _ in range(num_vars)]
+        for message in np.argsort(rank[message_from], kind='stable'):
+            if forward[message]:
+                earlier_in[message_to[message]].append(message)
+            else:
+                later_in[message_to[message]].append(message)
+
+        # wavefront index of each variable for each pass: one more than that of its latest predecessor in the pass
+        by_rank = np.argsort(rank)
+        forward_level = np.zeros(num_vars, dtype=np.intp)
+        for var in by_rank:
+            if earlier_in[var]:
+                forward_level[var] = 1 + max(forward_level[message_from[m]] for m in earlier_in[var])
+        backward_level = np.zeros(num_vars, dtype=np.intp)
+        for var in by_rank[::-1]:
+            if later_in[var]:
+                backward_level[var] = 1 + max(backward_level[message_from[m]] for m in later_in[var])
+
+        # decompose the graph into monotonic chains: the k-th message a variable sends to a later neighbor continues
+        # the chain of the k-th message it received from an earlier neighbor
+        reverse = (np.arange(2 * self.mn.num_edges) + self.mn.num_edges) % (2 * self.mn.num_edges)
+        self.chain_counts = np.ones(num_vars)
+        self.chain_predecessor = -np.ones(2 * self.mn.num_edges, dtype=np.intp)
+        chain_ends = []
+        for var in range(num_vars):
+            incoming = earlier_in[var]
+            outgoing = reverse[later_in[var]]
+            self.chain_counts[var] = max(len(incoming), len(outgoing), 1)
+            self.chain_predecessor[outgoing[:len(incoming)]] = incoming[:len(outgoing)]
+            chain_ends.extend(incoming[len(outgoing):])
+        self.chain_ends = np.array(chain_ends, dtype=np.intp)
+        self.isolated = np.array([var for var in range(num_vars) if not earlier_in[var] and not later_in[var]],
+                                 dtype=np.intp)
+
+        self.forward_schedule = self._make_schedule(forward_level, earlier_in, later_in, forward)
+        self.backward_schedule = self._make_schedule(backward_level, earlier_in, later_in, ~forward)
+
+    def _make_schedule(self, levels, earlier_in, later_in, sent):
+        """
+        Group variables into wavefronts and precompute the indexing each wavefront needs.
+
+        :param levels: wavefront index of each variable
+        :type levels: ndarray
+        :param earlier_in: list of the messages each variable receives from earlier neighbors
+        :type earlier_in: list
+        :param later_in: list of the messages each variable receives from later neighbors
+        :type later_in: list
+        :param sent: Boolean array indicating which messages the pass updates
+        :type sent: ndarray
+        :return: list of dicts, one for each wavefront in processing order
+        :rtype: list
+        """
+        schedule = []
+        position = np.zeros(len(levels), dtype=np.intp)
+        num_levels = levels.max() + 1 if len(levels) else 0
+
+        variables_by_level = np.argsort(levels, kind='stable')
+        variable_splits = np.cumsum(np.bincount(levels, minlength=num_levels))[:-1]
+
+        sent = np.flatnonzero(sent)
+        sent_levels = levels[self.mn.message_from[sent]]
+        sent_by_level = sent[np.argsort(sent_levels, kind='stable')]
+        sent_splits = np.cumsum(np.bincount(sent_levels, minlength=num_levels))[:-1]
+
+        for variables, out in zip(np.split(variables_by_level, variable_splits), np.split(sent_by_level, sent_splits)):
+            position[variables] = np.arange(len(variables))
+            step = {'variables': variables}
+
+            for name, incoming in [('earlier', earlier_in), ('later', later_in)]:
+                messages = np.array([m for var in variables for m in incoming[var]], dtype=np.intp)
+                targets = position[self.mn.message_to[messages]]
+                step[name] = messages
+                step[name + '_sum'] = csr_matrix((np.ones(len(messages)), (targets, np.arange(len(messages)))),
+                                                 (len(variables), len(messages)))
+
+            step['out'] = out
+            step['reverse'] = self._reverse(out)
+            step['source'] = position[self.mn.message_from[out]]
+            schedule.append(step)
+
+        return schedule
+
+    def _set_tree_probabilities(self, tree_probabilities):
+        """
+        Store the provided tree probabilities as an array in order of the MarkovNet's internal message storage.
+
+        :param tree_probabilities: dict containing tree probabilities for all edges
+        :type tree_probabilities: dict
+        :return: None
+        """
+        self.tree_probabilities = np.zeros(2 * self.mn.num_edges)
+
+        for edge, i in self.mn.message_index.items():
+            reversed_edge = edge[::-1]
+            if edge in tree_probabilities:
+                probability = tree_probabilities[edge]
+            elif reversed_edge in tree_probabilities:
+                probability = tree_probabilities[reversed_edge]
+            else:
+                raise KeyError('Edge %s was not assigned a probability.' % repr(edge))
+            self.tree_probabilities[i] = probability
+            self.tree_probabilities[i + self.mn.num_edges] = probability
+
+    def _reverse(self, messages):
+        """Return the indices of the messages sent in the opposite direction on the same edges."""
+        return (messages + self.mn.num_edges) % (2 * self.mn.num_edges)
+
+    @staticmethod
+    def _sum_incoming(step, name, columns):
+        """
+        Sum columns corresponding to the earlier or later incoming messages of a wavefront by receiving variable.
+
+        :param step: wavefront from a schedule
+        :type step: dict
+        :param name: 'earlier' or 'later'
+        :type name: str
+        :param columns: matrix with a column for each of the wavefront's incoming messages of that kind
+        :type columns: ndarray
+        :return: matrix with a column for each variable in the wavefront
+        :rtype: ndarray
+        """
+        return step[name + '_sum'].dot(columns.T).T
+
+    def _pass(self, messages, schedule):
+        """
+        Run one pass of sequential message updates in place.
+
+        :param messages: message matrix to update
+        :type messages: ndarray
+        :param schedule: list of wavefronts to process in order
+        :type schedule: list
+        :return: None
+        """
+        unary_mat = self.mn.unary_mat + self.augmented_mat
+        for step in schedule:
+            out = step['out']
+            if len(out) == 0:
+                continue
+
+            beliefs = unary_mat[:, step['variables']] \
+                + self._sum_incoming(step, 'earlier', messages[:, step['earlier']]) \
+                + self._sum_incoming(step, 'later', messages[:, step['later']])
+
+            adjusted = self.tree_probabilities[out] * beliefs[:, step['source']] - messages[:, step['reverse']]
+            new_messages = (self.mn.edge_pot_tensor[:, :, out] + adjusted[np.newaxis, :, :]).max(1)
+
+            messages[:, out] = np.nan_to_num(new_messages - new_messages.max(0))
+
+    def compute_bound(self):
+        """
+        Compute the upper bound on the log score of the MAP state given by the current messages. The messages
+        reparameterize the model into variable terms (the beliefs) and edge terms. Splitting each belief evenly among
+        the monotonic chains through its variable decomposes the reparameterized model into chains, and the sum of the
+        chains' maximum scores, computed by dynamic programming, bounds the maximum score of the model.
+
+        :return: upper bound on the log score of any state
+        :rtype: float
+        """
+        with np.errstate(invalid='ignore'):
+            beliefs = self.mn.unary_mat + self.augmented_mat + self.mn.sum_messages(self.message_mat)
+            shares = beliefs / self.chain_counts
+
+            # chain_values[:, m] is the best score of the chain up to and including message m's edge, for each state
+            # of the variable receiving message m
+            chain_values = np.zeros(self.message_mat.shape)
+            for step in self.forward_schedule:
+                out = step['out']
+                if len(out) == 0:
+                    continue
+                values = shares[:, step['variables'][step['source']]]
+                predecessors = self.chain_predecessor[out]
+                continued = predecessors >= 0
+                values[:, continued] += chain_values[:, predecessors[continued]]
+
+                values -= self.message_mat[:, step['reverse']]
+                chain_values[:, out] = (self.mn.edge_pot_tensor[:, :, out] + values[np.newaxis, :, :]).max(1) \
+                                       - self.message_mat[:, out]
+
+            ends = self.chain_ends
+            bound = np.sum((chain_values[:, ends] + shares[:, self.mn.message_to[ends]]).max(0))
+            bound += np.sum(shares[:, self.isolated].max(0))
+
+        return bound
+
+    def update_messages(self, compute_change=True):
+        """
+        Run one forward and one backward pass of TRW-S and record the bound. Since the bound can stop improving long
+        before the messages stop changing, convergence is measured by the decrease of the bound. The decrease is
+        divided by the magnitude of the bound (or 1, if it is smaller), so the same tolerance works for models of any
+        size.
+
+        :param compute_change: ignored, since the bound is computed every sweep
+        :return: the float relative decrease of the bound during the sweep, or np.inf after the first sweep of inference
+        """
+        messages = self.message_mat.copy()
+        self._pass(messages, self.forward_schedule)
+        self._pass(messages, self.backward_schedule)
+
+        self._store_messages(messages, compute_change=False)
+
+        bound = self.compute_bound()
+        change = (self.bounds[-1] - bound) / max(abs(bound), 1.0) if self.bounds else np.inf
+        self.bounds.append(bound)
+        logger.debug("TRW-S bound %f", bound)
+
+        return change
+
+    def infer(self, tolerance=1e-5, display='iter'):
+        """
+        Run TRW-S sweeps until the bound decreases by less than tolerance relative to its magnitude, or until max_iter
+        sweeps have run.
+
+        :param tolerance: smallest relative decrease of the bound for which sweeps continue
+        :type tolerance: float
+        :param display: string parameter indicating how much to log. Options are 'full', 'iter', 'final', and 'off',
+                        as in MatrixBeliefPropagator.infer
+        :type display: str
+        :return: None
+        """
+        self.bounds = []
+        super(TRWSBeliefPropagator, self).infer(tolerance, display)
+
+    def decode(self):
+        """
+        Choose the state of each variable in order, maximizing its unary potential plus its edge potentials with the
+        already chosen states of earlier neighbors and the messages from later neighbors.
+
+        :return: array of the chosen state index of each variable, in order of the MarkovNet's internal indices
+        :rtype: ndarray
+        """
+        labels = np.zeros(len(self.mn.var_list), dtype=np.intp)
+        unary_mat = self.mn.unary_mat + self.augmented_mat
+
+        for step in self.forward_schedule:
+            earlier = step['earlier']
+            scores = unary_mat[:, step['variables']] \
+                + self._sum_incoming(step, 'later', self.message_mat[:, step['later']])
+            if len(earlier):
+                pair_scores = self.mn.edge_pot_tensor[:, labels[self.mn.message_from[earlier]], earlier]
+                scores += self._sum_incoming(step, 'earlier', pair_scores)
+            labels[step['variables']] = scores.argmax(0)
+
+        return labels
+
+    def _compute_beliefs(self):
+        if not self.fully_conditioned:
+            self.labels = self.decode()
+            self.belief_mat = -np.inf * np.ones((self.mn.max_states, len(self.labels)))
+            self.belief_mat[self.labels, np.arange(len(self.labels))] = 0
+
+    def _compute_pairwise_beliefs(self):
+        if not self.fully_conditioned:
+            num_edges = self.mn.num_edges
+            self.pair_belief_tensor = -np.inf * np.ones((self.mn.max_states, self.mn.max_states, num_edges))
+            self.pair_belief_tensor[self.labels[self.mn.message_from[:num_edges]],
+                                    self.labels[self.mn.message_to[:num_edges]], np.arange(num_edges)] = 0
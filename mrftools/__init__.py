@@ -4,9 +4,13 @@ from .BruteForce import BruteForce
 from .ConvexBeliefPropagator import ConvexBeliefPropagator
 from .EM import EM
 from .GibbsSampler import GibbsSampler
+from .GraphCutInference import GraphCutInference
+from .GridBeliefPropagator import GridBeliefPropagator
 from .ImageLoader import ImageLoader
 from .Inference import Inference
+from .InferenceRecord import InferenceRecord
 from .Learner import Learner
+from .LearnerProfile import LearnerProfile
 from .LogLinearModel import LogLinearModel
 from .MarkovNet import MarkovNet
 from .MatrixBeliefPropagator import MatrixBeliefPropagator
@@ -15,8 +19,10 @@ from .MaxProductBeliefPropagator import *
 from .MaxProductBeliefPropagator import MaxProductBeliefPropagator
 from .MaxProductLinearProgramming import *
 from .MaxProductLinearProgramming import MaxProductLinearProgramming
+from .MessageStore import MessageStore
 from .PairedDual import PairedDual
 from .PrimalDual import PrimalDual
+from .TRWSBeliefPropagator import TRWSBeliefPropagator
 from .TreeReweightedBeliefPropagator import TreeReweightedBeliefPropagator
 from .opt import *
 from .util import *
@@ -1,9 +1,9 @@
 """Optimization utility class containing various optimizers and utility objects for callback functions"""
+import queue
+import threading
 import time
 
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
 
 
 def sgd(func, grad, x, args={}, callback=None):
@@ -12,13 +12,16 @@ def sgd(func, grad, x, args={}, callback=None):
     :param func: function to be minimized (used here only to update the gradient)
     :param grad: gradient function that returns the gradient of the function to be minimized
     :param x: vector initial value of value being optimized over
-    :param args: arguments with optimizer options and for the func and grad functions
+    :param args: arguments with optimizer options and for the func and grad functions. If args contains a dict under
+                    'state', the iteration counter is read from it at the start and written to it every iteration,
+                    which allows checkpointing and resuming.
     :param callback: function to be called with the current iterate each iteration
     :return: optimized solution
     """
-    t = 1
     if not args:
         args = {}
+    state = _optimizer_state(args, t=1)
+    t = state['t']
     tolerance = args.get('tolerance', 1e-8)
     max_iter = args.get('max_iter', 10000)
     change = np.inf
@@ -29,6 +32,7 @@ def sgd(func, grad, x, args={}, callback=None):
         x = x - 0.5 * g / t
         change = np.sum(np.abs(x - old_x))
         t += 1
+        state['t'] = t
         if callback:
             callback(x)
 
@@ -42,12 +46,12 @@ def ada_grad(func, grad, x, args={}, callback=None):
     :param func: function to be minimized (used here only to update the gradient)
     :param grad: gradient function that returns the gradient of the function to be minimized
     :param x: vector initial value of value being optimized over
-    :param args: arguments with optimizer options and for the func and grad functions
+    :param args: arguments with optimizer options and for the func and grad functions. If args contains a dict under
+                    'state', the iteration counter and squared gradient sum are read from it at the start and written to
+                    it every iteration, which allows checkpointing and resuming.
     :param callback: function to be called with the current iterate each iteration
     :return: optimized solution
     """
-
-    t = 1
     if not args:
         args = {}
     x_tol = args.get('x_tol', 1e-6)
@@ -59,7 +63,9 @@ def ada_grad(func, grad, x, args={}, callback=None):
     grad_norm = np.inf
     x_change = np.inf
 
-    grad_sum = 0
+    state = _optimizer_state(args, t=1, grad_sum=0)
+    t = state['t']
+    grad_sum = state['grad_sum']
     while grad_norm > g_tol and x_change > x_tol and t < max_iter:
         if callback:
             callback(x)
@@ -75,6 +81,8 @@ def ada_grad(func, grad, x, args={}, callback=None):
         # grad_norm = np.sqrt(g.dot(g))
 
         t += 1
+        state['t'] = t
+        state['grad_sum'] = grad_sum
 
     if callback:
         callback(x)
@@ -88,13 +96,12 @@ def rms_prop(func, grad, x, args={}, callback=None):
     :param func: function to be minimized (used here only to update the gradient)
     :param grad: gradient function that returns the gradient of the function to be minimized
     :param x: vector initial value of value being optimized over
-    :param args: arguments with optimizer options and for the func and grad functions
+    :param args: arguments with optimizer options and for the func and grad functions. If args contains a dict under
+                    'state', the iteration counter and squared gradient average are read from it at the start and 
+                    written to it every iteration, which allows checkpointing and resuming.
     :param callback: function to be called with the current iterate each iteration
     :return: optimized solution
     """
-
-    t = 1
-
     if not args:
         args = {}
     x_tol = args.get('x_tol', 0.02)
@@ -107,8 +114,9 @@ def rms_prop(func, grad, x, args={}, callback=None):
     grad_norm = np.inf
     x_change = np.inf
 
-    avg_sq_grad = np.zeros(len(x))
-    grad_sum = 0
+    state = _optimizer_state(args, t=1, avg_sq_grad=np.zeros(len(x)))
+    t = state['t']
+    avg_sq_grad = state['avg_sq_grad']
     while grad_norm > g_tol and x_change > x_tol and t < max_iter:
         if callback:
             callback(x)
@@ -124,6 +132,8 @@ def rms_prop(func, grad, x, args={}, callback=None):
         # grad_norm = np.sqrt(g.dot(g))
 
         t += 1
+        state['t'] = t
+        state['avg_sq_grad'] = avg_sq_grad
 
     if callback:
         callback(x)
@@ -136,12 +146,12 @@ def adam(func, grad, x, args={}, callback=None):
     :param func: function to be minimized (used here only to update the gradient)
     :param grad: gradient function that returns the gradient of the function to be minimized
     :param x: vector initial value of value being optimized over
-    :param args: arguments with optimizer options and for the func and grad functions
+    :param args: arguments with optimizer options and for the func and grad functions. If args contains a dict under
+                    'state', the iteration counter and moment estimates are read from it at the start and written to it
+                    every iteration, which allows checkpointing and resuming.
     :param callback: function to be called with the current iterate each iteration
     :return: optimized solution
     """
-
-    t = 1
     if not args:
         args = {}
     x_tol = args.get('x_tol', 1e-3)
@@ -155,8 +165,10 @@ def adam(func, grad, x, args={}, callback=None):
     grad_norm = np.inf
     x_change = np.inf
 
-    m = np.zeros(len(x))
-    v = np.zeros(len(x))
+    state = _optimizer_state(args, t=1, m=np.zeros(len(x)), v=np.zeros(len(x)))
+    t = state['t']
+    m = state['m']
+    v = state['v']
 
     while grad_norm > g_tol and x_change > x_tol and t < max_iter:
         if callback:
@@ -175,6 +187,7 @@ def adam(func, grad, x, args={}, callback=None):
         x_change = np.sqrt(change.dot(change))
 
         t += 1
+        state.update(t=t, m=m, v=v)
     if callback:
         callback(x)
     return x
@@ -182,7 +195,8 @@ def adam(func, grad, x, args={}, callback=None):
 
 def lbfgs(func, grad, x, args={}, callback=None):
     """
-    Adapter for scipy's standard minimize function, which defaults to using the LBFGS-B optimizer
+    Adapter for scipy's standard minimize function, which defaults to using the LBFGS-B optimizer. Its internal
+    state cannot be checkpointed, so resuming restarts the optimizer from the checkpointed solution.
     
     :param func: function to be minimized (used here only to update the gradient)
     :param grad: gradient function that returns the gradient of the function to be minimized
@@ -191,6 +205,9 @@ def lbfgs(func, grad, x, args={}, callback=None):
     :param callback: function to be called with the current iterate each iteration
     :return: optimized solution
     """
+    # scipy.optimize is slow to import, so only import it when this optimizer is used
+    from scipy.optimize import minimize
+
     if callback:
         res = minimize(fun=func, x0=x, args=args, jac=grad, callback=callback)
     else:
@@ -198,14 +215,100 @@ def lbfgs(func, grad, x, args={}, callback=None):
     return res.x
 
 
+def _optimizer_state(args, **initial_state):
+    """
+    Get the state dict an optimizer should read and update, filling in initial values for entries it does not have.
+    
+    :param args: optimizer arguments, which may contain a state dict under 'state' that persists outside the optimizer
+    :param initial_state: initial values of the optimizer's iteration counter and accumulators
+    :return: state dict
+    :rtype: dict
+    """
+    state = args.get('state')
+    if state is None:
+        return initial_state
+    for key, value in initial_state.items():
+        state.setdefault(key, value)
+    return state
+
+
 class WeightRecord(object):
     """
     Class used to store solutions during optimization. Used to generate a callback function that will store the 
     solution passed in. Useful for diagnostics, but in production, usually suboptimal solutions don't need to be saved.
+    
+    Records are appended into preallocated storage that doubles in size when full, so each append takes amortized
+    constant time. To bound memory, the record can keep only every k-th iterate, keep a uniform random sample 
+    (reservoir) of a fixed number of iterates, and store the weight vectors in a memory-mapped file instead of RAM.
     """
-    def __init__(self):
-        self.weight_record = np.array([])
-        self.time_record = np.array([])
+    def __init__(self, interval=1, max_records=None, path=None, seed=0):
+        """
+        Initialize an empty record.
+        
+        :param interval: only record every interval-th iterate
+        :type interval: int
+        :param max_records: if not None, keep a uniform random sample of at most this many of the recorded iterates
+        :type max_records: int
+        :param path: if not None, store the weight vectors in a memory-mapped file with this name
+        :type path: str
+        :param seed: seed of the random number generator used for sampling, which is separate from numpy's global 
+                        generator so that recording doesn't change the random choices of learning
+        """
+        assert interval > 0, "Recording interval must be positive"
+        assert max_records is None or max_records > 0, "Maximum number of records must be positive"
+        self.interval = interval
+        self.max_records = max_records
+        self.path = path
+        self.random = np.random.RandomState(seed)
+
+        self.num_calls = 0
+        self.size = 0
+        self._weights = None
+        self._times = np.zeros(0)
+        self._iterations = np.zeros(0, dtype=np.intp)
+
+    @property
+    def weight_record(self):
+        """
+        Recorded weight vectors, one per row, in the order they were visited. Empty if nothing was recorded.
+        
+        :rtype: ndarray
+        """
+        if self.size == 0:
+            return np.array([])
+        return self._weights[:self.size][self._order()]
+
+    @property
+    def time_record(self):
+        """
+        Timestamps of the recorded weight vectors. For compatibility, this is a length-1 vector for a single record and
+        a column vector otherwise.
+        
+        :rtype: ndarray
+        """
+        times = self._times[:self.size][self._order()]
+        if self.size > 1:
+            return times.reshape((self.size, 1))
+        return times
+
+    @property
+    def iteration_record(self):
+        """
+        Indices of the optimizer iterations (counting callback calls from 0) of the recorded weight vectors.
+        
+        :rtype: ndarray
+        """
+        return self._iterations[:self.size][self._order()]
+
+    def _order(self):
+        """
+        Get the permutation that sorts the records by iteration. Reservoir sampling stores records out of order.
+        
+        :return: index array, or a slice if the records are already in order
+        """
+        if self.max_records is None:
+            return slice(None)
+        return np.argsort(self._iterations[:self.size], kind='mergesort')
 
     def callback(self, x):
         """
@@ -214,18 +317,247 @@ class WeightRecord(object):
         :param x: vector to be saved into the weight record
         :return: 
         """
-        a = np.copy(x)
-        if self.weight_record.size == 0:
-            self.weight_record = a.reshape((1, a.size))
-            self.time_record = np.array([time.time()])
+        iteration = self.num_calls
+        self.num_calls += 1
+
+        if iteration % self.interval != 0:
+            return
+
+        if self.max_records is None or self.size < self.max_records:
+            slot = self.size
+            self._reserve(self.size + 1, x)
+            self.size += 1
+        else:
+            # reservoir sampling: the n-th candidate replaces a random record with probability max_records / n
+            slot = self.random.randint(iteration // self.interval + 1)
+            if slot >= self.max_records:
+                return
+
+        self._weights[slot, :] = x
+        self._times[slot] = time.time()
+        self._iterations[slot] = iteration
+
+    def _reserve(self, size, x):
+        """
+        Make sure the storage can hold size records, doubling its capacity if needed.
+        
+        :param size: number of records needed
+        :param x: vector being recorded, which determines the length and type of the storage
+        :return: None
+        """
+        capacity = len(self._times)
+        if size <= capacity:
+            return
+
+        capacity = max(2 * capacity, 16)
+        if self.max_records is not None:
+            capacity = min(capacity, self.max_records)
+
+        x = np.asarray(x)
+        if self.path is None:
+            weights = np.zeros((capacity, x.size), dtype=x.dtype)
+            if self._weights is not None:
+                weights[:self.size] = self._weights[:self.size]
+        elif self._weights is None:
+            weights = np.memmap(self.path, dtype=x.dtype, mode='w+', shape=(capacity, x.size))
+        else:
+            # rows are stored contiguously, so extending the file keeps the existing records in place
+            self._weights.flush()
+            dtype = self._weights.dtype
+            del self._weights
+            with open(self.path, 'r+b') as f:
+                f.truncate(capacity * x.size * dtype.itemsize)
+            weights = np.memmap(self.path, dtype=dtype, mode='r+', shape=(capacity, x.size))
+
+        self._weights = weights
+        self._times = np.concatenate((self._times, np.zeros(capacity - len(self._times))))
+        self._iterations = np.concatenate((self._iterations,
+                                           np.zeros(capacity - len(self._iterations), dtype=np.intp)))
+
+
+class ObjectiveMonitor(object):
+    """
+    Class to monitor optimization without re-evaluating the objective. Unlike ObjectivePlotter, which calls the 
+    objective (and for a Learner, runs inference over all examples) inside the callback, this monitor reuses the 
+    objective values and gradients the optimizer already computed. These come either from the cached evaluation of a 
+    Learner or from objective and gradient functions wrapped with wrap. The callback only queues references to these 
+    values; computing norms, storing the records, and writing to the sink happen on a background thread.
+    """
+    def __init__(self, learner=None, sink=None, interval=1):
+        """
+        Initialize the monitor and start its background thread.
+        
+        :param learner: Learner whose cached objective and gradient evaluations to monitor. If None, wrap the objective
+                        and gradient functions passed to the optimizer with wrap.
+        :param sink: file name to append tab-separated records to, or function to call with the dict of each record
+        :param interval: only record every interval-th iteration
+        :type interval: int
+        """
+        self.learner = learner
+        self.sink = sink
+        self.interval = interval
+        self.t = 0
+
+        self.iters = []
+        self.times = []
+        self.objectives = []
+        self.grad_norms = []
+        self.x_changes = []
+
+        self.last_value = None
+        self.last_grad = None
+        self._last_recorded_grad = None
+        self._last_x = None
+
+        self._queue = queue.Queue()
+        self._file = open(sink, 'a') if isinstance(sink, str) else None
+        self._thread = threading.Thread(target=self._consume)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wrap(self, func, grad):
+        """
+        Wrap objective and gradient functions so that the monitor sees the values they compute.
+        
+        :param func: objective function
+        :param grad: gradient function
+        :return: tuple of the wrapped objective and gradient functions
+        :rtype: tuple
+        """
+        def monitored_func(x, *args):
+            self.last_value = func(x, *args)
+            return self.last_value
+
+        def monitored_grad(x, *args):
+            self.last_grad = grad(x, *args)
+            return self.last_grad
+
+        return monitored_func, monitored_grad
+
+    def callback(self, x):
+        """
+        Queue a record of the most recent objective evaluation. Does nothing if there has been no new evaluation since
+        the last record.
+        
+        :param x: current iterate
+        :return: None
+        """
+        self.t += 1
+        if (self.t - 1) % self.interval != 0:
+            return
+
+        if self.learner is not None:
+            value, grad = self.learner.cached_value, self.learner.cached_gradient
         else:
-            self.weight_record = np.vstack((self.weight_record, a))
-            self.time_record = np.vstack((self.time_record, time.time()))
+            value, grad = self.last_value, self.last_grad
+
+        if grad is None or grad is self._last_recorded_grad:
+            return
+        self._last_recorded_grad = grad
+
+        # optimizers create new arrays for each iterate and gradient, so queueing references is safe
+        self._queue.put((self.t - 1, time.time(), value, grad, x))
+
+    def _consume(self):
+        """
+        Process queued records on the background thread until close is called.
+        
+        :return: None
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._record(*item)
+            finally:
+                self._queue.task_done()
+
+    def _record(self, iteration, timestamp, value, grad, x):
+        """
+        Store one record and write it to the sink.
+        
+        :param iteration: index of the callback call
+        :param timestamp: time of the callback call
+        :param value: most recent objective value
+        :param grad: most recent gradient
+        :param x: current iterate
+        :return: None
+        """
+        grad_norm = np.sqrt(grad.dot(grad))
+        x_change = np.sqrt((x - self._last_x).dot(x - self._last_x)) if self._last_x is not None else np.nan
+        self._last_x = x
+
+        self.iters.append(iteration)
+        self.times.append(timestamp)
+        self.objectives.append(value)
+        self.grad_norms.append(grad_norm)
+        self.x_changes.append(x_change)
+
+        if self._file is not None:
+            self._file.write("%d\t%f\t%e\t%e\t%e\n" % (iteration, timestamp,
+                                                          np.nan if value is None else value, grad_norm, x_change))
+            self._file.flush()
+        elif self.sink is not None:
+            self.sink({'iteration': iteration, 'time': timestamp, 'objective': value, 'grad_norm': grad_norm,
+                       'x_change': x_change})
+
+    def flush(self):
+        """
+        Wait until all queued records are processed.
+        
+        :return: None
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Process the remaining records, stop the background thread, and close the sink file.
+        
+        :return: None
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def plot(self):
+        """
+        Plot the recorded objective values and gradient norms. Call this from the main thread, e.g., after learning or
+        between learning runs, rather than from the optimizer loop.
+        
+        :return: None
+        """
+        self.flush()
+
+        import matplotlib.pyplot as plt
+
+        plt.clf()
+
+        plt.subplot(121)
+        plt.plot(self.iters, self.objectives)
+        plt.ylabel('Objective')
+        plt.xlabel('Iteration')
+
+        plt.subplot(122)
+        plt.semilogy(self.iters, self.grad_norms)
+        plt.ylabel('Gradient norm')
+        plt.xlabel('Iteration')
 
 
 class ObjectivePlotter(object):
     """
-    Class to generate a plot of the objective function during the callback
+    Class to generate a plot of the objective function during the callback. Each plotted point re-evaluates the 
+    objective, so use ObjectiveMonitor to monitor long training runs.
     """
     def __init__(self, func, grad=None):
         """
@@ -256,6 +588,8 @@ class ObjectivePlotter(object):
         elapsed_time = time.time() - self.timer
 
         if elapsed_time > self.interval:
+            import matplotlib.pyplot as plt
+
             self.objectives.append(self.func(x))
             self.iters.append(self.t)
 
@@ -1,9 +1,7 @@
 """Miscellaneous utility functions and classes"""
 import time
 
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.optimize import minimize
 from .ConvexBeliefPropagator import ConvexBeliefPropagator
 
 
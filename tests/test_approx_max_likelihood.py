@@ -1,5 +1,7 @@
 """Test class for approximate maximum likelihood learner"""
 import unittest
+import os
+import tempfile
 from mrftools import *
 
 
@@ -43,6 +45,49 @@ class TestApproxMaxLikelihood(unittest.TestCase):
             print(true_marg)
             assert np.argmax(learned_marg) == np.argmax(true_marg), "learned marginal decoding disagrees with truth"
 
+    def test_checkpoint_resume(self):
+        """Test that resuming from a checkpoint gives the same result as uninterrupted learning with a shared
+        inference object"""
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.npz')
+        model = create_model(0)
+
+        sampler = GibbsSampler(model)
+        sampler.init_states(0)
+        sampler.gibbs_sampling(100, 10)
+        data = sampler.samples
+
+        opt_args = {'max_iter': 12}
+
+        def make_learner():
+            """Create a learner with the sampled data."""
+            learner = ApproxMaxLikelihood(model)
+            learner.set_regularization(0, 0.01)
+            for example in data:
+                learner.add_data(example)
+            return learner
+
+        learner = make_learner()
+        expected = learner.learn(np.zeros(learner.weight_dim), opt_args=opt_args)
+
+        learner = make_learner()
+        learner.set_checkpointing(path, interval=4)
+
+        def interrupt(x):
+            if learner.checkpoint_iteration == 6:
+                raise KeyboardInterrupt()
+
+        try:
+            learner.learn(np.zeros(learner.weight_dim), callback=interrupt, opt_args=opt_args)
+        except KeyboardInterrupt:
+            pass
+
+        learner = make_learner()
+        assert len(learner.belief_propagators) == 1 < learner.num_examples
+        learner.set_checkpointing(path, interval=4)
+        resumed = learner.resume(opt_args=opt_args)
+
+        assert np.allclose(expected, resumed), "Resumed learning did not match uninterrupted learning"
+
 
 def set_up_learner(learner, model):
     """
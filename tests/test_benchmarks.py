@@ -0,0 +1,37 @@
+"""Test class for the benchmark suite"""
+import unittest
+import json
+from benchmarks.run_benchmarks import run, compare, measure_import
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Test class for the benchmark suite"""
+
+    def test_quick_run(self):
+        """Test that every benchmark runs on tiny configurations and produces JSON-serializable results."""
+        results = run(quick=True)
+
+        for name, records in results['benchmarks'].items():
+            assert len(records) > 0, "Benchmark %s produced no results" % name
+            for record in records:
+                assert record['time'] >= 0 and record['peak_memory'] >= 0
+
+        for record in results['benchmarks']['update_messages']:
+            assert record['iterations'] > 0, "Number of inference iterations was not recorded"
+
+        loaded = json.loads(json.dumps(results))
+
+        comparison = compare(results, loaded)
+        assert len(comparison) == sum(len(records) for records in results['benchmarks'].values()), \
+            "Comparison did not match every benchmark record with itself"
+        for name, config, old_time, new_time, ratio in comparison:
+            assert old_time == new_time
+
+    def test_lazy_imports(self):
+        """Test that importing mrftools does not load plotting, image, or scipy optimization modules"""
+        result = measure_import()
+        assert not result['loaded'], "Importing mrftools loaded %s" % ", ".join(result['loaded'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Test class for graph-cut MAP inference"""
+import itertools
+import numpy as np
+from mrftools import *
+import unittest
+
+
+class TestGraphCutInference(unittest.TestCase):
+    """Test class for graph-cut MAP inference"""
+    def create_grid_model(self, length, num_states, potts=True):
+        """Create a grid-structured MRF with Potts or random edge potentials."""
+        mn = MarkovNet()
+
+        np.random.seed(0)
+
+        for x in range(length):
+            for y in range(length):
+                mn.set_unary_factor((x, y), np.random.randn(num_states))
+
+        for x in range(length):
+            for y in range(length):
+                for neighbor in [(x + 1, y), (x, y + 1)]:
+                    if neighbor[0] < length and neighbor[1] < length:
+                        if potts:
+                            mn.set_edge_factor(((x, y), neighbor), np.random.rand() * np.eye(num_states))
+                        else:
+                            mn.set_edge_factor(((x, y), neighbor), np.random.randn(num_states, num_states))
+
+        mn.create_matrices()
+        return mn
+
+    def get_states(self, bp):
+        """Read the MAP states from the one-hot beliefs."""
+        bp.load_beliefs()
+        return dict((var, int(np.argmax(bp.var_beliefs[var]))) for var in bp.mn.variables)
+
+    def brute_force_score(self, mn):
+        """Find the best score by trying every state."""
+        variables = mn.var_list
+        return max(mn.evaluate_state(dict(zip(variables, states)))
+                   for states in itertools.product(*[range(mn.num_states[var]) for var in variables]))
+
+    def test_binary_exactness(self):
+        """Test that a single cut finds the true MAP state of a binary submodular model."""
+        mn = self.create_grid_model(3, 2)
+
+        gc = GraphCutInference(mn)
+        gc.infer()
+
+        assert np.allclose(mn.evaluate_state(self.get_states(gc)), self.brute_force_score(mn)), \
+            "Graph cut did not find the MAP state of a submodular model"
+
+    def test_local_optimality(self):
+        """Test that expansion and swap moves reach labelings no single-variable change can improve."""
+        mn = self.create_grid_model(4, 4)
+
+        for method in ['expansion', 'swap']:
+            gc = GraphCutInference(mn, method)
+            gc.infer()
+            states = self.get_states(gc)
+            score = mn.evaluate_state(states)
+
+            for var in mn.variables:
+                for state in range(mn.num_states[var]):
+                    changed = dict(states)
+                    changed[var] = state
+                    assert mn.evaluate_state(changed) <= score + 1e-8, \
+                        "Changing one variable improved the %s result" % method
+
+    def test_belief_format(self):
+        """Test that the beliefs are one-hot log beliefs consistent with each other, as with max-product."""
+        mn = self.create_grid_model(4, 3, potts=False)
+
+        gc = GraphCutInference(mn)
+        gc.infer()
+        gc.load_beliefs()
+
+        assert np.all(np.sum(gc.belief_mat == 0, 0) == 1), "Unary beliefs are not one-hot"
+        assert np.all(np.isneginf(gc.belief_mat[gc.belief_mat != 0])), "Unary beliefs are not in log space"
+
+        for var in mn.variables:
+            for neighbor in mn.get_neighbors(var):
+                pair_belief = np.sum(np.exp(gc.pair_beliefs[(var, neighbor)]), 1)
+                assert np.allclose(pair_belief, np.exp(gc.var_beliefs[var])), "Beliefs are inconsistent"
+
+        # moves are only accepted when they improve the score, so the result is at least as good as the unary argmax
+        unary_states = dict((var, int(np.argmax(mn.unary_potentials[var]))) for var in mn.variables)
+        assert mn.evaluate_state(self.get_states(gc)) >= mn.evaluate_state(unary_states)
+
+    def test_conditioning(self):
+        """Test that conditioned variables keep their conditioned states."""
+        mn = self.create_grid_model(4, 3)
+
+        gc = GraphCutInference(mn)
+        gc.infer()
+        states = self.get_states(gc)
+
+        conditioned_state = (states[(1, 1)] + 1) % 3
+        gc.condition((1, 1), conditioned_state)
+        gc.infer()
+
+        assert self.get_states(gc)[(1, 1)] == conditioned_state, "Conditioned variable changed state"
+
+    def test_better_than_max_product(self):
+        """Test that graph cuts find a labeling at least as good as max-product on a loopy Potts grid."""
+        mn = self.create_grid_model(12, 4)
+
+        gc = GraphCutInference(mn)
+        gc.infer()
+
+        bp = MaxProductBeliefPropagator(mn)
+        bp.set_max_iter(100)
+        bp.infer(display='off')
+
+        assert mn.evaluate_state(self.get_states(gc)) >= mn.evaluate_state(self.get_states(bp)) - 1e-8, \
+            "Graph cut found a worse labeling than max-product"
+        assert gc.num_iterations < 10, "Graph cut took too many sweeps"
+
+
+if __name__ == '__main__':
+    unittest.main()
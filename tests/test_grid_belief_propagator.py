@@ -0,0 +1,132 @@
+"""Test class for grid-specialized belief propagation"""
+import numpy as np
+from mrftools import *
+import unittest
+
+
+class TestGridBeliefPropagator(unittest.TestCase):
+    """Test class for grid-specialized belief propagation"""
+    def create_grid_model(self, width, height, num_states, num_features=3):
+        """Create a grid-structured log-linear model with random features and weights."""
+        model = LogLinearModel()
+
+        np.random.seed(0)
+
+        for x in range(width):
+            for y in range(height):
+                model.declare_variable((x, y), num_states)
+                model.set_unary_features((x, y), np.random.randn(num_features))
+                model.set_unary_factor((x, y), np.zeros(num_states))
+
+        for x in range(width):
+            for y in range(height):
+                for neighbor in [(x + 1, y), (x, y + 1)]:
+                    if neighbor[0] < width and neighbor[1] < height:
+                        model.set_edge_features(((x, y), neighbor), np.random.randn(num_features))
+                        model.set_edge_factor(((x, y), neighbor), np.eye(num_states))
+
+        model.create_matrices()
+        model.set_weights(np.random.randn(num_features * num_states + num_features * num_states ** 2))
+
+        return model
+
+    def test_matches_matrix_belief_propagator(self):
+        """Test that messages, beliefs, feature expectations, and objectives match the generic implementation."""
+        model = self.create_grid_model(5, 4, 3)
+
+        bp = MatrixBeliefPropagator(model)
+        grid_bp = GridBeliefPropagator(model)
+
+        for i in range(5):
+            change = bp.update_messages()
+            grid_change = grid_bp.update_messages()
+
+            assert np.allclose(change, grid_change), "Changes in messages differ in iteration %d" % i
+            assert np.allclose(bp.message_mat, grid_bp.message_mat), "Messages differ in iteration %d" % i
+
+        bp.infer(display='off')
+        grid_bp.infer(display='off')
+        assert bp.num_iterations == grid_bp.num_iterations
+
+        bp.load_beliefs()
+        grid_bp.load_beliefs()
+
+        for var in model.variables:
+            assert np.allclose(bp.var_beliefs[var], grid_bp.var_beliefs[var]), "Unary beliefs differ"
+        for edge in bp.pair_beliefs:
+            assert np.allclose(bp.pair_beliefs[edge], grid_bp.pair_beliefs[edge]), "Pairwise beliefs differ"
+
+        assert np.allclose(bp.get_feature_expectations(), grid_bp.get_feature_expectations())
+        assert np.allclose(bp.compute_energy_functional(), grid_bp.compute_energy_functional())
+        assert np.allclose(bp.compute_dual_objective(), grid_bp.compute_dual_objective())
+
+    def test_options(self):
+        """Test that damping, convergence norms, conditioning, and warm starts behave as in the generic class."""
+        model = self.create_grid_model(4, 6, 2)
+
+        for damping, adaptive, norm in [(0.5, False, 'max'), (0.3, True, 'mean'), (-0.2, False, 'sum')]:
+            bp = MatrixBeliefPropagator(model)
+            grid_bp = GridBeliefPropagator(model)
+
+            for inference in [bp, grid_bp]:
+                inference.set_damping(damping, adaptive)
+                inference.set_convergence_policy(norm=norm)
+                inference.condition((1, 2), 1)
+                inference.infer(display='off')
+
+            assert bp.num_iterations == grid_bp.num_iterations
+            assert np.allclose(bp.message_mat, grid_bp.message_mat)
+            if norm == 'max':
+                assert np.allclose(bp.residuals, grid_bp.residuals), "Residuals are not in message order"
+
+        grid_bp.load_beliefs()
+        assert np.allclose(np.exp(grid_bp.var_beliefs[(1, 2)]), [0, 1]), "Conditioning was ignored"
+
+        # warm starting from converged messages skips inference
+        warm_bp = GridBeliefPropagator(model)
+        warm_bp.condition((1, 2), 1)
+        warm_bp.set_messages(grid_bp.message_mat.copy())
+        warm_bp.set_damping(0.5)
+        warm_bp.infer(display='off')
+        assert warm_bp.num_iterations <= 2
+        assert np.allclose(warm_bp.message_mat, grid_bp.message_mat, atol=1e-6)
+
+    def test_learning(self):
+        """Test that the grid propagator is a drop-in inference type for learning."""
+        model = self.create_grid_model(4, 4, 2)
+        labels = dict(((x, y), int(x > 1)) for x in range(4) for y in range(4))
+        weights = np.zeros(3 * 2 + 3 * 4)
+
+        learner = Learner(MatrixBeliefPropagator)
+        learner.add_data(labels, model)
+        grid_learner = Learner(GridBeliefPropagator)
+        grid_learner.add_data(labels, model)
+
+        assert np.allclose(learner.subgrad_obj(weights + 0.1), grid_learner.subgrad_obj(weights + 0.1))
+        assert np.allclose(learner.subgrad_grad(weights + 0.1), grid_learner.subgrad_grad(weights + 0.1))
+
+    def test_requires_grid(self):
+        """Test that models that are not complete 4-connected grids are rejected."""
+        model = MarkovNet()
+        for var in range(3):
+            model.set_unary_factor(var, np.zeros(2))
+        model.set_edge_factor((0, 1), np.eye(2))
+        model.set_edge_factor((1, 2), np.eye(2))
+
+        self.assertRaises(AssertionError, GridBeliefPropagator, model)
+
+        model = MarkovNet()
+        for x in range(2):
+            for y in range(2):
+                model.set_unary_factor((x, y), np.zeros(2))
+        model.set_edge_factor(((0, 0), (1, 0)), np.eye(2))
+        model.set_edge_factor(((0, 0), (0, 1)), np.eye(2))
+        model.set_edge_factor(((1, 0), (1, 1)), np.eye(2))
+        model.set_edge_factor(((0, 1), (1, 1)), np.eye(2))
+        model.set_edge_factor(((0, 0), (1, 1)), np.eye(2))
+
+        self.assertRaises(AssertionError, GridBeliefPropagator, model)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 """Test class for Learner and its subclasses"""
 import unittest
+import itertools
+import os
+import tempfile
 import numpy as np
 from scipy.optimize import check_grad, approx_fprime
 import matplotlib.pyplot as plt
@@ -178,6 +181,247 @@ class TestLearner(unittest.TestCase):
             new_obj = learner.subgrad_obj(weight_record[i, :])
             assert new_obj >= 0, "Primal Dual objective was not non-negative"
 
+    def test_value_and_grad(self):
+        """Test that the cached combined evaluation matches the separate objective and gradient and infers only once"""
+        weights = np.random.randn(8 + 32)
+        learner = Learner(MatrixBeliefPropagator)
+        self.set_up_learner(learner, latent=True)
+
+        obj = learner.subgrad_obj(weights)
+        grad = learner.subgrad_grad(weights)
+
+        self.inference_count = 0
+        do_inference = learner.do_inference
+
+        def counting_inference(belief_propagators):
+            self.inference_count += 1
+            do_inference(belief_propagators)
+
+        learner.do_inference = counting_inference
+
+        cached_obj, cached_grad = learner.value_and_grad(weights)
+        assert np.allclose(obj, cached_obj), "Cached objective did not match subgrad_obj"
+        assert np.allclose(grad, cached_grad), "Cached gradient did not match subgrad_grad"
+
+        count = self.inference_count
+        func, grad_func = learner.cached_functions()
+        grad_func(weights)
+        func(weights)
+        assert self.inference_count == count, "Inference was rerun for a cached weight vector"
+
+        func(weights + 1.0)
+        assert self.inference_count > count, "Inference was not run for a new weight vector"
+
+    def test_batch_gradient_unbiased(self):
+        """Test that mini-batch gradients average to the full gradient over all possible batches"""
+        weights = np.random.randn(8 + 32)
+        learner = Learner(MatrixBeliefPropagator)
+        self.set_up_learner(learner, latent=True)
+
+        learner.subgrad_obj(weights)
+        full_grad = learner.subgrad_grad(weights)
+
+        learner.set_batch_size(2)
+        batches = list(itertools.combinations(range(learner.num_examples), 2))
+        batch_grad = np.zeros(len(weights))
+        for batch in batches:
+            learner.batch_indices = np.array(batch)
+            learner.subgrad_obj(weights)
+            batch_grad += learner.subgrad_grad(weights) / len(batches)
+
+        assert np.allclose(full_grad, batch_grad), "Mini-batch gradient was biased"
+
+    def test_stochastic_learning(self):
+        """Test that stochastic learning only runs inference on the mini-batch and still decreases the objective"""
+        weights = np.zeros(8 + 32)
+        learner = Learner(MatrixBeliefPropagator)
+        self.set_up_learner(learner, latent=True)
+        learner.set_batch_size(2)
+
+        self.max_inference_size = 0
+        do_inference = learner.do_inference
+
+        def recording_inference(belief_propagators):
+            self.max_inference_size = max(self.max_inference_size, len(belief_propagators))
+            do_inference(belief_propagators)
+
+        learner.do_inference = recording_inference
+
+        new_weights = learner.learn(weights, optimizer=adam, opt_args={'max_iter': 200})
+
+        assert self.max_inference_size == 2, "Inference ran on more examples than the batch size"
+
+        learner.do_inference = do_inference
+        assert learner.batch_indices is None, "Batch was not reset after learning"
+        assert learner.subgrad_obj(new_weights) < learner.subgrad_obj(weights), \
+            "Stochastic learning did not decrease the objective"
+
+    def test_adaptive_inference_tolerance(self):
+        """Test that the adaptive schedule starts loose, only tightens, and still learns"""
+        weights = np.zeros(8 + 32)
+        learner = Learner(MatrixBeliefPropagator)
+        self.set_up_learner(learner, latent=True)
+        learner.set_adaptive_inference_tolerance(initial_tolerance=1e-1, min_tolerance=1e-8, scale=1e-2)
+
+        tolerances = []
+        do_inference = learner.do_inference
+
+        def recording_inference(belief_propagators):
+            tolerances.append(learner.inference_tolerance)
+            do_inference(belief_propagators)
+
+        learner.do_inference = recording_inference
+        new_weights = learner.learn(weights)
+        learner.do_inference = do_inference
+
+        assert tolerances[0] == 1e-1, "Inference did not start with the initial tolerance"
+        assert np.all(np.diff(tolerances) <= 0), "Inference tolerance was loosened during learning"
+        assert tolerances[-1] < tolerances[0], "Inference tolerance was never tightened"
+        assert learner.subgrad_obj(new_weights) < learner.subgrad_obj(weights), \
+            "Learning with adaptive tolerance did not decrease the objective"
+
+    def test_profiling(self):
+        """Test that profiling attributes learning time to phases for each learner type and records a trace"""
+        for learner_type in [Learner, EM, PairedDual, PrimalDual]:
+            weights = np.zeros(8 + 32)
+            learner = learner_type(MatrixBeliefPropagator)
+            self.set_up_learner(learner, latent=True)
+            profile = learner.enable_profiling()
+
+            learner.learn(weights, opt_args={'max_iter': 10})
+            summary = profile.summary()
+
+            for phase in ['set_weights', 'inference', 'expectations', 'energy', 'gradient', 'optimizer']:
+                assert phase in summary['phases'], "%s did not profile phase %s" % (learner_type.__name__, phase)
+
+            assert summary['evaluations'] == len(profile.trace) > 0, "Trace did not have one entry per evaluation"
+            assert summary['max_inference_iterations'] > 0, "Inference iterations were not recorded"
+            assert sum(phase['time'] for phase in summary['phases'].values()) <= summary['learn_time'] + 1e-3, \
+                "Phase times exceeded the learning time"
+            assert len(profile.report().splitlines()) == len(summary['phases']) + 3
+
+            learner.enable_profiling(False)
+            learner.learn(weights, opt_args={'max_iter': 2})
+            assert learner.profile is None and profile.summary() == summary, "Disabled profiling recorded data"
+
+    def test_checkpoint_resume(self):
+        """Test that resuming from a checkpoint after an interruption gives the same result as uninterrupted learning"""
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.npz')
+
+        for learner_type, optimizer in [(Learner, adam), (Learner, ada_grad), (EM, ada_grad), (PairedDual, rms_prop)]:
+            opt_args = {'max_iter': 12}
+
+            learner = learner_type(MatrixBeliefPropagator)
+            self.set_up_learner(learner, latent=True)
+            if learner_type is Learner:
+                learner.set_batch_size(2)
+            np.random.seed(1)
+            expected = learner.learn(np.zeros(8 + 32), optimizer=optimizer, opt_args=opt_args)
+
+            learner = learner_type(MatrixBeliefPropagator)
+            self.set_up_learner(learner, latent=True)
+            if learner_type is Learner:
+                learner.set_batch_size(2)
+            learner.set_checkpointing(path, interval=4)
+            np.random.seed(1)
+
+            def interrupt(x):
+                if learner.checkpoint_iteration == 6:
+                    raise KeyboardInterrupt()
+
+            try:
+                learner.learn(np.zeros(8 + 32), optimizer=optimizer, callback=interrupt, opt_args=opt_args)
+            except KeyboardInterrupt:
+                pass
+
+            # resume with a new learner object, as a restarted job would
+            np.random.seed(2)
+            learner = learner_type(MatrixBeliefPropagator)
+            self.set_up_learner(learner, latent=True)
+            if learner_type is Learner:
+                learner.set_batch_size(2)
+            learner.set_checkpointing(path, interval=4)
+            resumed = learner.resume(optimizer=optimizer, opt_args=opt_args)
+
+            assert np.allclose(expected, resumed), "Resumed %s learning with %s did not match uninterrupted learning" \
+                                                   % (learner_type.__name__, optimizer.__name__)
+
+    def test_checkpoint_restores_beliefs(self):
+        """Test that beliefs read right after restoring a checkpoint are computed from the restored messages"""
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.npz')
+
+        learner = Learner(MatrixBeliefPropagator)
+        self.set_up_learner(learner, latent=True)
+        weights = learner.learn(np.zeros(8 + 32), opt_args={'max_iter': 5})
+        learner.save_checkpoint(path, weights)
+
+        learner = Learner(MatrixBeliefPropagator)
+        self.set_up_learner(learner, latent=True)
+        learner.set_weights(weights, learner.belief_propagators)
+
+        # compute and memoize beliefs and energies of the initial messages, and save incremental snapshots
+        for bp in learner.belief_propagators:
+            bp.compute_beliefs()
+            bp.compute_energy_functional()
+            bp.infer_incremental(display='off')
+            bp.initialize_messages()
+            bp.compute_beliefs()
+            bp.compute_energy_functional()
+
+        versions = [bp.message_version for bp in learner.belief_propagators]
+        learner.load_checkpoint(path)
+
+        for bp, version in zip(learner.belief_propagators, versions):
+            assert bp.message_version > version, "Restoring messages did not change the message version"
+            assert bp._incremental_snapshot is None, "Restoring messages kept the incremental inference snapshot"
+
+            fresh_bp = MatrixBeliefPropagator(bp.mn)
+            fresh_bp.set_messages(bp.message_mat.copy())
+            bp.compute_beliefs()
+            fresh_bp.compute_beliefs()
+
+            assert np.allclose(bp.belief_mat, fresh_bp.belief_mat), "Beliefs were stale after restoring messages"
+            assert np.allclose(bp.compute_energy_functional(), fresh_bp.compute_energy_functional()), \
+                "Energy functional was stale after restoring messages"
+
+        weights = learner.resume(opt_args={'max_iter': 2}, path=path)
+
+        for bp in learner.belief_propagators:
+            bp.load_beliefs()
+            fresh_bp = MatrixBeliefPropagator(bp.mn)
+            fresh_bp.set_messages(bp.message_mat.copy())
+            fresh_bp.load_beliefs()
+            for var in bp.mn.variables:
+                assert np.allclose(bp.var_beliefs[var], fresh_bp.var_beliefs[var]), "Beliefs were stale after resume"
+
+    def test_objective_monitor(self):
+        """Test that monitoring a learner records its objective without running extra inference"""
+        inference_counts = []
+        for monitored in [False, True]:
+            learner = Learner(MatrixBeliefPropagator)
+            self.set_up_learner(learner, latent=True)
+
+            self.inference_count = 0
+            do_inference = learner.do_inference
+
+            def counting_inference(belief_propagators):
+                self.inference_count += 1
+                do_inference(belief_propagators)
+
+            learner.do_inference = counting_inference
+
+            if monitored:
+                with ObjectiveMonitor(learner) as monitor:
+                    learner.learn(np.zeros(8 + 32), opt_args={'max_iter': 20}, callback=monitor.callback)
+                assert len(monitor.objectives) == 19, "Monitor did not record every evaluation"
+                assert np.all(np.array(monitor.grad_norms) > 0), "Monitor did not record gradient norms"
+            else:
+                learner.learn(np.zeros(8 + 32), opt_args={'max_iter': 20})
+
+            inference_counts.append(self.inference_count)
+
+        assert inference_counts[0] == inference_counts[1], "Monitoring ran extra inference"
+
     def test_overflow(self):
         """Initialize weights to a huge number and see if learner can escape it"""
         weights = 1000 * np.random.randn(8 + 32)
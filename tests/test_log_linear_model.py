@@ -1,6 +1,9 @@
 """Tests for the log-linear model objects"""
 import unittest
+import os
+import tempfile
 import numpy as np
+from scipy.sparse import csr_matrix, issparse
 from mrftools import *
 
 
@@ -173,6 +176,108 @@ class TestLogLinearModel(unittest.TestCase):
             assert np.allclose(bp_ind.pair_beliefs[edge], bp.pair_beliefs[edge]), "edge beliefs disagree: \n" +\
                 "indicator:\n" + repr(bp_ind.pair_beliefs[edge]) + "\noriginal:\n" + repr(bp.pair_beliefs[edge])
 
+    def test_sparse_features(self):
+        """Test that sparse feature vectors produce the same potentials and expectations as dense feature vectors"""
+        k = [4, 3, 6, 2, 5]
+        d = 10
+        dense_model = self.create_chain_model(k)
+        sparse_model = self.create_chain_model(k)
+
+        for i in range(len(k)):
+            features = np.random.randn(d) * (np.random.rand(d) < 0.3)
+            dense_model.set_unary_features(i, features)
+            sparse_model.set_unary_features(i, csr_matrix(features))
+
+        for edge in dense_model.edge_potentials:
+            features = np.random.randn(d) * (np.random.rand(d) < 0.3)
+            dense_model.set_edge_features(edge, features)
+            sparse_model.set_edge_features(edge, csr_matrix(features).T)
+
+        dense_model.create_matrices()
+        sparse_model.create_matrices()
+
+        assert not issparse(dense_model.unary_feature_mat), "Dense features were stored in a sparse matrix"
+        assert issparse(sparse_model.unary_feature_mat), "Sparse unary features were stored in a dense matrix"
+        assert issparse(sparse_model.edge_feature_mat), "Sparse edge features were stored in a dense matrix"
+
+        weights = np.random.randn(dense_model.weight_dim)
+        dense_model.set_weights(weights)
+        sparse_model.set_weights(weights)
+
+        assert np.allclose(dense_model.unary_mat, sparse_model.unary_mat), "Unary potentials disagree"
+        assert np.allclose(dense_model.edge_pot_tensor, sparse_model.edge_pot_tensor), "Edge potentials disagree"
+
+        dense_bp = MatrixBeliefPropagator(dense_model)
+        dense_bp.infer(display='off')
+        sparse_bp = MatrixBeliefPropagator(sparse_model)
+        sparse_bp.infer(display='off')
+
+        assert np.allclose(dense_bp.get_feature_expectations(), sparse_bp.get_feature_expectations()), \
+            "Feature expectations disagree between sparse and dense features"
+
+    def test_weight_caching(self):
+        """Test that setting the same weights again skips recomputing potentials and that new weights update them"""
+        k = [4, 3, 6, 2, 5]
+        model = self.create_chain_model(k)
+        model.create_matrices()
+
+        weights = np.random.randn(model.weight_dim)
+        model.set_weights(weights)
+        version = model.potential_version
+        unary_mat = model.unary_mat.copy()
+
+        model.set_weights(weights.copy())
+        assert model.potential_version == version, "Setting identical weights recomputed the potentials"
+
+        weights[0] += 1.0
+        model.set_weights(weights)
+        assert model.potential_version > version, "Setting new weights did not update the potential version"
+        assert not np.allclose(model.unary_mat, unary_mat), "Setting new weights did not change the potentials"
+
+        version = model.potential_version
+        model.set_unary_weight_matrix(np.zeros((model.max_unary_features, model.max_states)))
+        model.set_weights(weights)
+        assert model.potential_version > version, "Setting weights after changing weight matrix did not update"
+
+    def test_save_load(self):
+        """Test that saved and loaded log-linear models with dense or sparse features compute the same potentials"""
+        k = [4, 3, 6, 2, 5]
+        dense_model = self.create_chain_model(k)
+        sparse_model = self.create_chain_model(k)
+        for i in range(len(k)):
+            sparse_model.set_unary_features(i, csr_matrix(dense_model.unary_features[i]))
+        for edge in dense_model.edge_potentials:
+            features = np.random.randn(3)
+            dense_model.set_edge_features(edge, features)
+            sparse_model.set_edge_features(edge, csr_matrix(features))
+
+        directory = tempfile.mkdtemp()
+
+        for model in [dense_model, sparse_model]:
+            model.create_matrices()
+            weights = np.random.randn(model.weight_dim)
+            model.set_weights(weights)
+
+            path = os.path.join(directory, 'model.npz')
+            model.save(path)
+
+            for mmap in [False, True]:
+                loaded = LogLinearModel.load(path, mmap=mmap)
+
+                assert loaded.weight_dim == model.weight_dim, "Weight dimensionality changed"
+                assert issparse(loaded.unary_feature_mat) == issparse(model.unary_feature_mat)
+                assert np.array_equal(loaded.unary_weight_mat, model.unary_weight_mat), "Weights were not preserved"
+                assert np.array_equal(loaded.unary_mat, model.unary_mat), "Potentials were not preserved"
+
+                new_weights = np.random.randn(model.weight_dim)
+                model.set_weights(new_weights)
+                loaded.set_weights(new_weights)
+
+                assert np.allclose(loaded.unary_mat, model.unary_mat), "Loaded unary features were different"
+                assert np.allclose(loaded.edge_pot_tensor, model.edge_pot_tensor), "Loaded edge features were different"
+
+                model.set_weights(weights)
+
     def test_matrix_structure(self):
         """Test that the sparse matrix structure in matrix mode is correct."""
         k = [2, 3, 4, 5, 6]
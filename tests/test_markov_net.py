@@ -1,6 +1,9 @@
 """Tests for the MarkovNet model objects"""
 import unittest
+import os
+import tempfile
 from mrftools import *
+from mrftools.MarkovNet import POTENTIAL_LOG_LENGTH
 import numpy as np
 
 
@@ -65,3 +68,137 @@ class TestMarkovNet(unittest.TestCase):
         assert mn.matrix_mode, "Matrix mode flag wasn't set correctly"
 
         assert mn.unary_mat.shape == (max_states, 5)
+
+    def test_sum_messages(self):
+        """Test that summing messages into variables matches the sparse product with message_to_map."""
+        mn = self.create_chain_model()
+        mn.create_matrices()
+
+        messages = np.random.randn(mn.max_states, 2 * mn.num_edges)
+        expected = mn.message_to_map.T.dot(messages.T).T
+
+        assert np.allclose(mn.sum_messages(messages), expected), "Summed messages were incorrect"
+        assert np.allclose(mn.sum_messages(messages[0]), expected[0]), "Summed message vector was incorrect"
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'model.npz')
+        mn.save(path)
+        loaded = MarkovNet.load(path)
+
+        assert np.allclose(loaded.sum_messages(messages), expected), "Loaded model summed messages incorrectly"
+
+    def test_save_load(self):
+        """Test that a saved and loaded Markov net, with or without memory mapping, gives the same inference results"""
+        mn = self.create_chain_model()
+        # use tuple variable names, like pixel coordinates
+        tuple_mn = MarkovNet()
+        for var in mn.variables:
+            tuple_mn.set_unary_factor((var, 0), mn.unary_potentials[var])
+        for (var, neighbor), potential in mn.edge_potentials.items():
+            tuple_mn.set_edge_factor(((var, 0), (neighbor, 0)), potential)
+
+        for model in [mn, tuple_mn]:
+            model.create_matrices()
+            bp = MatrixBeliefPropagator(model)
+            bp.infer(display='off')
+            bp.load_beliefs()
+
+            directory = tempfile.mkdtemp()
+            path = os.path.join(directory, 'model.npz')
+            model.save(path)
+
+            for mmap in [False, True]:
+                loaded = MarkovNet.load(path, mmap=mmap)
+
+                assert loaded.var_list == model.var_list, "Variable order was not preserved"
+                assert loaded.neighbors == model.neighbors, "Graph structure was not preserved"
+                assert np.array_equal(loaded.edge_pot_tensor, model.edge_pot_tensor), "Edge potentials changed"
+                for var in model.variables:
+                    assert np.array_equal(loaded.unary_potentials[var], model.unary_potentials[var])
+
+                loaded_bp = MatrixBeliefPropagator(loaded)
+                loaded_bp.infer(display='off')
+                loaded_bp.load_beliefs()
+
+                for var in model.variables:
+                    assert np.allclose(bp.var_beliefs[var], loaded_bp.var_beliefs[var]), \
+                        "Beliefs of loaded model were different"
+                for edge in bp.pair_beliefs:
+                    assert np.allclose(bp.pair_beliefs[edge], loaded_bp.pair_beliefs[edge]), \
+                        "Pairwise beliefs of loaded model were different"
+
+                # memory-mapped arrays are copy-on-write, so modifying the loaded model must not change the file
+                loaded.set_unary_mat(np.zeros(loaded.unary_mat.shape))
+
+            assert np.array_equal(MarkovNet.load(path).unary_mat, model.unary_mat), "Saved file was modified"
+
+    def test_lazy_load(self):
+        """Test that loading builds dictionary views only when accessed and keeps memory-mapped arrays mapped"""
+        mn = self.create_chain_model()
+        mn.create_matrices()
+        mn.tree_probabilities = dict((edge, 0.5) for edge in mn.edge_potentials)
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'model.npz')
+        mn.save(path)
+
+        loaded = MarkovNet.load(path, mmap=True)
+        assert not loaded.edge_pot_tensor.flags.owndata and not loaded.unary_mat.flags.owndata, \
+            "Memory-mapped arrays were copied"
+
+        bp = MatrixBeliefPropagator(loaded)
+        bp.infer(display='off')
+        assert loaded._pending_views == {'variable', 'edge'}, "Inference built dictionary views"
+
+        # replacing a view before it is built keeps the new value when the rest of its group is built
+        loaded.tree_probabilities = {(0, 1): 1.0}
+        assert loaded.neighbors == mn.neighbors
+        assert loaded.tree_probabilities == {(0, 1): 1.0}
+
+        assert MarkovNet.load(path).tree_probabilities == mn.tree_probabilities, "Tree probabilities were not restored"
+
+        # models saved by older versions only store the backward edge potentials
+        arrays = mn._get_matrix_arrays()
+        arrays['edge_pot_tensor'] = arrays['edge_pot_tensor'][:, :, mn.num_edges:]
+        np.savez(path, **arrays)
+        assert np.array_equal(MarkovNet.load(path).edge_pot_tensor, mn.edge_pot_tensor), "Old format was misread"
+
+        # names that cannot be stored as a plain array are pickled
+        object_mn = MarkovNet()
+        for var in [(0,), (0, 1), (1,)]:
+            object_mn.set_unary_factor(var, np.random.randn(2))
+        object_mn.set_edge_factor(((0,), (0, 1)), np.random.randn(2, 2))
+        object_mn.set_edge_factor(((0, 1), (1,)), np.random.randn(2, 2))
+        object_mn.create_matrices()
+        object_mn.save(path)
+
+        object_loaded = MarkovNet.load(path)
+        assert object_loaded.var_list == object_mn.var_list
+        assert object_loaded.neighbors == object_mn.neighbors
+
+    def test_potential_changes(self):
+        """Test that the model logs which potentials each setter changed"""
+        mn = self.create_chain_model()
+        mn.create_matrices()
+        version = mn.potential_version
+        assert mn.potential_changes_since(version - 1) is None, "Rebuilding the matrices was logged as a small change"
+
+        unary_mat = mn.unary_mat.copy()
+        unary_mat[0, mn.var_index[2]] += 1
+        mn.set_unary_mat(unary_mat)
+
+        edge_tensor = mn.edge_pot_tensor.copy()
+        i = mn.message_index[(2, 3)]
+        edge_tensor[0, 1, i + mn.num_edges] += 1
+        mn.set_edge_tensor(edge_tensor)
+
+        variables, edges = mn.potential_changes_since(version)
+        assert np.array_equal(variables, [mn.var_index[2]]), "Wrong variables were logged"
+        assert np.array_equal(edges, [i]), "Wrong edges were logged"
+
+        variables, edges = mn.potential_changes_since(mn.potential_version)
+        assert variables.size == 0 and edges.size == 0, "Changes were logged without any change"
+
+        for _ in range(POTENTIAL_LOG_LENGTH):
+            mn.set_unary_mat(unary_mat)
+        assert mn.potential_changes_since(version) is None, "Changes older than the log were reported"
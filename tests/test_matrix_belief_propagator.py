@@ -81,6 +81,26 @@ class TestMatrixBeliefPropagator(unittest.TestCase):
 
         return mn
 
+    def create_spin_glass_model(self, length=8, strength=0.7):
+        """Create a grid of binary variables with random attractive and repulsive couplings that make BP oscillate."""
+        mn = MarkovNet()
+
+        np.random.seed(0)
+
+        for x in range(length):
+            for y in range(length):
+                mn.set_unary_factor((x, y), 0.1 * np.random.randn(2))
+
+        for x in range(length - 1):
+            for y in range(length):
+                for edge in [((x, y), (x + 1, y)), ((y, x), (y, x + 1))]:
+                    coupling = strength * np.random.randn()
+                    mn.set_edge_factor(edge, coupling * np.array([[1.0, -1.0], [-1.0, 1.0]]))
+
+        mn.create_matrices()
+
+        return mn
+
     def test_exactness(self):
         """Test that Matrix BP produces the true marginals in a chain model."""
         mn = self.create_chain_model()
@@ -177,6 +197,117 @@ class TestMatrixBeliefPropagator(unittest.TestCase):
                            + "\n" + repr(bp.pair_beliefs[edge]) \
                            + "\n" + repr(slow_bp.pair_beliefs[edge])
 
+    def test_skip_converged_inference(self):
+        """Test that inference is skipped when nothing changed since it converged, and rerun when potentials change"""
+        mn = self.create_loop_model()
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        assert bp.is_converged(), "Inference did not record that it converged"
+
+        messages = bp.message_mat
+        bp.infer(display='off')
+        assert bp.message_mat is messages, "Inference reran even though nothing changed"
+
+        unary_mat = mn.unary_mat.copy()
+        unary_mat[0, 0] += 1.0
+        mn.set_unary_mat(unary_mat)
+        assert bp.potentials_stale(), "Propagator did not detect changed potentials"
+
+        bp.infer(display='off')
+        assert bp.message_mat is not messages, "Inference did not rerun after the potentials changed"
+        assert not bp.potentials_stale(), "Potentials still marked stale after inference"
+
+        messages = bp.message_mat
+        bp.condition(2, 0)
+        bp.infer(display='off')
+        assert bp.message_mat is not messages, "Inference did not rerun after conditioning"
+
+    def test_convergence_policies(self):
+        """Test that strided and alternative-norm convergence checks reach the same beliefs as the default"""
+        mn = self.create_loop_model()
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+        bp.load_beliefs()
+        default_beliefs = bp.belief_mat
+
+        for interval, norm in [(5, 'sum'), (1, 'mean'), (1, 'max'), (3, 'max')]:
+            policy_bp = MatrixBeliefPropagator(mn)
+            policy_bp.set_convergence_policy(interval=interval, norm=norm)
+
+            self.update_count = 0
+            update_messages = policy_bp.update_messages
+
+            def counting_update(compute_change=True):
+                self.update_count += 1
+                return update_messages(compute_change)
+
+            policy_bp.update_messages = counting_update
+            policy_bp.infer(display='off')
+            policy_bp.load_beliefs()
+
+            assert self.update_count % interval == 0, "Inference did not stop on a convergence check iteration"
+            assert np.allclose(default_beliefs, policy_bp.belief_mat), \
+                "Convergence policy (%d, %s) changed the beliefs" % (interval, norm)
+
+            if norm == 'max':
+                assert policy_bp.residuals.shape == (2 * mn.num_edges,), "Per-message residuals have the wrong shape"
+                assert np.all(policy_bp.residuals <= 1e-8), "Per-message residuals did not converge"
+
+    def test_damping(self):
+        """Test that damping keeps the same fixed point and makes oscillating BP converge"""
+        mn = self.create_loop_model()
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        damped_bp = MatrixBeliefPropagator(mn)
+        damped_bp.set_damping(0.5)
+        damped_bp.infer(display='off')
+
+        bp.compute_beliefs()
+        damped_bp.compute_beliefs()
+        assert np.allclose(bp.belief_mat, damped_bp.belief_mat), "Damping changed the converged beliefs"
+
+        mn = self.create_spin_glass_model()
+        for damping, adaptive in [(0.0, False), (0.5, False), (0.0, True)]:
+            bp = MatrixBeliefPropagator(mn)
+            bp.set_max_iter(1000)
+            bp.set_damping(damping, adaptive)
+
+            changes = [bp.update_messages() for _ in range(bp.max_iter)]
+            converged = np.any(np.asarray(changes) < 1e-8)
+
+            if damping == 0.0 and not adaptive:
+                assert not converged, "Undamped BP converged on the spin glass, so the test model is too easy"
+            else:
+                assert converged, "Damped BP (%f, %s) did not converge" % (damping, adaptive)
+
+    def test_inference_callback(self):
+        """Test that the inference callback records every iteration and samples diagnostics at the set interval"""
+        mn = self.create_loop_model()
+        bp = MatrixBeliefPropagator(mn)
+        record = InferenceRecord()
+        bp.set_callback(record.callback, diagnostic_interval=3)
+        bp.infer(display='off')
+
+        arrays = record.to_arrays()
+        assert np.array_equal(arrays['iteration'], np.arange(bp.num_iterations)), "Not every iteration was recorded"
+        assert arrays['change'][-1] <= 1e-8, "Recorded final change was not converged"
+        assert np.all(arrays['time'] >= 0), "Recorded iteration times were negative"
+        assert np.array_equal(arrays['diagnostic_iteration'], np.arange(0, bp.num_iterations, 3)), \
+            "Diagnostics were not sampled at the requested interval"
+        assert len(arrays['energy_functional']) == len(arrays['diagnostic_iteration']), "Diagnostics were not stored"
+
+    def test_inference_logging(self):
+        """Test that inference reports progress through logging instead of printing"""
+        mn = self.create_loop_model()
+        bp = MatrixBeliefPropagator(mn)
+
+        with self.assertLogs('mrftools.MatrixBeliefPropagator', level='DEBUG') as logs:
+            bp.infer(display='full')
+
+        assert len(logs.output) == bp.num_iterations + 1, "Inference did not log each iteration and the final count"
+
     def test_conditioning(self):
         """Test that conditioning on variable properly sets variables to conditioned state"""
         mn = self.create_loop_model()
@@ -267,3 +398,260 @@ class TestMatrixBeliefPropagator(unittest.TestCase):
             bp.load_beliefs()
             mat_bp.update_messages()
             mat_bp.load_beliefs()
+
+    def test_belief_caching(self):
+        """Test that beliefs are only recomputed when the messages, potentials, or conditioning change"""
+        mn = self.create_loop_model()
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        calls = {'unary': 0, 'pairwise': 0}
+        compute_beliefs = bp._compute_beliefs
+        compute_pairwise_beliefs = bp._compute_pairwise_beliefs
+
+        def count_unary():
+            calls['unary'] += 1
+            compute_beliefs()
+
+        def count_pairwise():
+            calls['pairwise'] += 1
+            compute_pairwise_beliefs()
+
+        bp._compute_beliefs = count_unary
+        bp._compute_pairwise_beliefs = count_pairwise
+
+        bp.compute_beliefs()
+        bp.compute_beliefs()
+        bp.load_beliefs(pairwise=False)
+        assert calls == {'unary': 1, 'pairwise': 0}, "Beliefs were recomputed without any change"
+
+        bp.load_beliefs()
+        bp.compute_energy_functional()
+        assert calls == {'unary': 1, 'pairwise': 1}, "Pairwise beliefs were recomputed without any change"
+
+        bp.update_messages()
+        bp.compute_beliefs()
+        assert calls['unary'] == 2, "Beliefs were not recomputed after a message update"
+
+        bp.condition(0, 1)
+        bp.load_beliefs()
+        assert calls == {'unary': 3, 'pairwise': 2}, "Beliefs were not recomputed after conditioning"
+        assert np.allclose(np.exp(bp.var_beliefs[0]), [0, 1, 0, 0]), "Stale beliefs ignored the conditioning"
+
+        mn.set_unary_mat(mn.unary_mat + 1)
+        bp.compute_beliefs()
+        assert calls['unary'] == 4, "Beliefs were not recomputed after the potentials changed"
+
+        bp.invalidate_beliefs()
+        bp.compute_beliefs()
+        assert calls['unary'] == 5, "Beliefs were not recomputed after being invalidated"
+
+    def test_invalidate_after_in_place_change(self):
+        """Test that invalidating beliefs after changing potentials in place makes inference run again"""
+        mn = self.create_chain_model()
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+        bp.load_beliefs()
+
+        mn.unary_mat[:, mn.var_index[2]] += np.random.randn(mn.max_states)
+        bp.invalidate_beliefs()
+        bp.infer(display='off')
+        bp.load_beliefs()
+
+        assert bp.num_iterations > 0, "Inference was skipped after invalidating beliefs"
+
+        fresh_bp = MatrixBeliefPropagator(mn)
+        fresh_bp.infer(display='off')
+        fresh_bp.load_beliefs()
+
+        for var in mn.variables:
+            assert np.allclose(bp.var_beliefs[var], fresh_bp.var_beliefs[var]), "Beliefs were stale after invalidating"
+
+    def test_unary_feature_expectations(self):
+        """Test that unary-only feature expectations do not compute pairwise beliefs and match the full computation"""
+        mn = self.create_loop_model()
+        mn.unary_feature_mat = np.eye(len(mn.variables))
+        mn.edge_feature_mat = np.zeros((0, mn.num_edges))
+
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+        bp.compute_pairwise_beliefs = None  # fails if called
+
+        expectations = bp.get_feature_expectations()
+
+        bp.compute_beliefs()
+        expected = np.eye(len(mn.variables)).dot(np.exp(bp.belief_mat).T).reshape(-1)
+        assert np.allclose(expectations, expected), "Unary feature expectations are wrong"
+
+    def test_memoized_objectives(self):
+        """Test that the learning objectives share one belief computation and are recomputed after changes"""
+        model = LogLinearModel()
+        np.random.seed(0)
+        for var in range(4):
+            model.declare_variable(var, 3)
+            model.set_unary_weights(var, np.random.randn(3, 2))
+            model.set_unary_features(var, np.random.randn(2))
+        model.set_all_unary_factors()
+        for edge in [(0, 1), (1, 2), (2, 3), (3, 0)]:
+            model.set_edge_features(edge, np.random.randn(2))
+        model.create_matrices()
+        weights = np.random.randn(2 * 3 + 2 * 9)
+        model.set_weights(weights)
+
+        bp = MatrixBeliefPropagator(model)
+        bp.infer(display='off')
+
+        calls = {'unary': 0, 'pairwise': 0}
+        compute_beliefs = bp._compute_beliefs
+        compute_pairwise_beliefs = bp._compute_pairwise_beliefs
+
+        def count_unary():
+            calls['unary'] += 1
+            compute_beliefs()
+
+        def count_pairwise():
+            calls['pairwise'] += 1
+            compute_pairwise_beliefs()
+
+        bp._compute_beliefs = count_unary
+        bp._compute_pairwise_beliefs = count_pairwise
+
+        expectations = bp.get_feature_expectations()
+        energy_functional = bp.compute_energy_functional()
+        dual_objective = bp.compute_dual_objective()
+        entropy = bp.compute_bethe_entropy()
+
+        assert calls == {'unary': 1, 'pairwise': 1}, "Beliefs were computed more than once"
+        assert np.allclose(energy_functional, bp.compute_energy() + entropy)
+        assert np.allclose(dual_objective, bp.compute_dual_objective())
+
+        expectations[:] = 0
+        assert np.any(bp.get_feature_expectations() != 0), "Modifying returned expectations changed the stored ones"
+
+        model.set_weights(weights + 1)
+        assert not np.allclose(bp.compute_energy_functional(), energy_functional), \
+            "Energy functional was not recomputed after the weights changed"
+        assert calls == {'unary': 2, 'pairwise': 2}
+
+        bp.update_messages()
+        bp.compute_dual_objective()
+        assert calls == {'unary': 3, 'pairwise': 3}, "Dual objective was not recomputed after a message update"
+
+    def test_incremental_inference(self):
+        """Test that incremental inference after local changes matches full inference with fewer message updates"""
+        np.random.seed(0)
+        mn = self.create_grid_model()
+        mn.tree_probabilities = ImageLoader.calculate_tree_probabilities_snake_shape(16, 16)
+        mn.create_matrices()
+        var = (8, 8)
+
+        for inference_type in [MatrixBeliefPropagator, MatrixTRBeliefPropagator, ConvexBeliefPropagator]:
+            bp = inference_type(mn)
+            bp.set_max_iter(1000)
+            bp.infer_incremental(tolerance=1e-10, display='off')
+            full_updates = bp.num_updates
+            assert full_updates == bp.num_iterations * 2 * mn.num_edges, "First call did not run full inference"
+
+            edge_tensor = mn.edge_pot_tensor.copy()
+
+            # condition one variable and change the potential of one edge
+            bp.condition(var, 3)
+            i = mn.message_index[((8, 8), (9, 8))]
+            changed_tensor = edge_tensor.copy()
+            changed_tensor[:, :, i] += np.random.random((8, 8))
+            changed_tensor[:, :, i + mn.num_edges] = changed_tensor[:, :, i].T
+            mn.set_edge_tensor(changed_tensor)
+
+            bp.infer_incremental(tolerance=1e-10, display='off')
+
+            assert bp.converged_messages is bp.message_mat, "Incremental inference did not converge"
+            assert bp.num_updates < full_updates / 2, "Incremental inference updated too many messages"
+
+            full_bp = inference_type(mn)
+            full_bp.set_max_iter(1000)
+            full_bp.condition(var, 3)
+            full_bp.infer(tolerance=1e-10, display='off')
+
+            assert np.allclose(bp.message_mat, full_bp.message_mat, atol=1e-6), \
+                "%s incremental inference did not match full inference" % inference_type.__name__
+
+            bp.load_beliefs()
+            assert np.allclose(np.exp(bp.var_beliefs[var]), np.eye(8)[3]), "Beliefs did not reflect the conditioning"
+
+            bp.infer_incremental(tolerance=1e-10, display='off')
+            assert bp.num_updates == 0, "Incremental inference updated messages without any change"
+
+            mn.set_edge_tensor(edge_tensor)
+
+        # max-product does not converge on the random grid, so check it on a chain
+        mn = self.create_chain_model()
+        bp = MaxProductBeliefPropagator(mn)
+        bp.infer_incremental(display='off')
+        bp.condition(2, 4)
+        bp.infer_incremental(display='off')
+
+        full_bp = MaxProductBeliefPropagator(mn)
+        full_bp.condition(2, 4)
+        full_bp.infer(display='off')
+
+        assert np.allclose(bp.message_mat, full_bp.message_mat), \
+            "Incremental max-product did not match full inference"
+
+    def test_threaded_updates(self):
+        """Test that message updates computed in parallel blocks match updates computed in one block"""
+        mn = self.create_grid_model()
+        mn.tree_probabilities = ImageLoader.calculate_tree_probabilities_snake_shape(16, 16)
+        mn.create_matrices()
+
+        inference_types = [MatrixBeliefPropagator, MatrixTRBeliefPropagator, ConvexBeliefPropagator,
+                           MaxProductBeliefPropagator, MaxProductLinearProgramming]
+        settings = [(0.0, False, 'sum'), (0.5, False, 'max'), (-0.2, False, 'mean'), (0.3, True, 'sum')]
+
+        for inference_type in inference_types:
+            for damping, adaptive, norm in settings:
+                bp = inference_type(mn)
+                threaded_bp = inference_type(mn)
+                threaded_bp.set_num_threads(3)
+
+                for inference in [bp, threaded_bp]:
+                    inference.set_damping(damping, adaptive)
+                    inference.set_convergence_policy(norm=norm)
+                    inference.condition((2, 3), 1)
+
+                for i in range(5):
+                    change = bp.update_messages()
+                    threaded_change = threaded_bp.update_messages()
+
+                    assert np.allclose(change, threaded_change), "%s change differed" % inference_type.__name__
+                    assert np.allclose(bp.message_mat, threaded_bp.message_mat), \
+                        "%s messages differed" % inference_type.__name__
+                    if norm == 'max':
+                        assert np.allclose(bp.residuals, threaded_bp.residuals), "Residuals differed"
+
+                threaded_bp.update_messages(compute_change=False)
+                bp.update_messages(compute_change=False)
+                assert np.allclose(bp.message_mat, threaded_bp.message_mat), "Unmeasured updates differed"
+
+        # more threads than messages leaves some blocks empty
+        mn = self.create_chain_model()
+        bp = MatrixBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        threaded_bp = MatrixBeliefPropagator(mn)
+        threaded_bp.set_num_threads(2 * mn.num_edges + 3)
+        threaded_bp.set_convergence_policy(norm='max')
+        threaded_bp.infer(display='off')
+
+        assert bp.num_iterations == threaded_bp.num_iterations
+        assert np.allclose(bp.message_mat, threaded_bp.message_mat)
+
+        # replacing or removing the thread pool stops its worker threads
+        pool = threaded_bp._thread_pool
+        threaded_bp.set_num_threads(2)
+        assert all(not thread.is_alive() for thread in pool._threads), "Replaced thread pool was not shut down"
+
+        pool = threaded_bp._thread_pool
+        threaded_bp.update_messages()
+        threaded_bp.set_num_threads(1)
+        assert threaded_bp._thread_pool is None
+        assert all(not thread.is_alive() for thread in pool._threads), "Removed thread pool was not shut down"
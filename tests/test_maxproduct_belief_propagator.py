@@ -82,4 +82,42 @@ class TestMaxProductBeliefPropagator(unittest.TestCase):
 
         with np.errstate(all='raise'):
             bp.infer()
-            bp.load_beliefs()
\ No newline at end of file
+            bp.load_beliefs()
+
+    def test_decode(self):
+        """Test that decode returns the argmax states of the loaded beliefs in var_index order."""
+        mn = self.create_loop_model()
+        bp = MaxProductBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        states = bp.decode()
+        assert states.dtype.kind == 'i', "Decoded states are not integers"
+
+        bp.load_beliefs()
+        for var, i in mn.var_index.items():
+            assert states[i] == np.argmax(bp.var_beliefs[var]), "Decoded state disagrees with beliefs"
+            assert states[i] < mn.num_states[var], "Decoded an impossible state"
+
+    def test_predict_batch(self):
+        """Test that batch prediction matches running inference and decoding on each model."""
+        models = []
+        for seed in range(3):
+            np.random.seed(seed)
+            model = LogLinearModel()
+            for i in range(4):
+                model.set_unary_factor(i, np.zeros(3))
+                model.set_unary_features(i, np.random.randn(2))
+            for i in range(3):
+                model.set_edge_factor((i, i + 1), np.zeros((3, 3)))
+            model.create_matrices()
+            models.append(model)
+
+        weights = np.random.randn(models[0].weight_dim)
+        predictions = MaxProductBeliefPropagator.predict_batch(models, weights)
+
+        assert len(predictions) == len(models)
+        for model, prediction in zip(models, predictions):
+            model.set_weights(weights)
+            bp = MaxProductBeliefPropagator(model)
+            bp.infer(display='off')
+            assert np.array_equal(prediction, bp.decode()), "Batch prediction differs from single prediction"
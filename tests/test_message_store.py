@@ -0,0 +1,84 @@
+"""Test class for the warm-start message store"""
+import numpy as np
+from mrftools import *
+import unittest
+
+
+class TestMessageStore(unittest.TestCase):
+    """Test class for the warm-start message store"""
+    def create_grid_model(self, length, num_states, seed=0, noise=None):
+        """Create a grid-structured MRF with random potentials, optionally perturbed to mimic a similar image."""
+        mn = MarkovNet()
+
+        np.random.seed(seed)
+
+        for x in range(length):
+            for y in range(length):
+                mn.set_unary_factor((x, y), np.random.randn(num_states))
+
+        for x in range(length):
+            for y in range(length):
+                for neighbor in [(x + 1, y), (x, y + 1)]:
+                    if neighbor[0] < length and neighbor[1] < length:
+                        mn.set_edge_factor(((x, y), neighbor), np.random.randn(num_states, num_states))
+
+        if noise is not None:
+            np.random.seed(noise)
+            for var in mn.variables:
+                mn.set_unary_factor(var, mn.unary_potentials[var] + 0.01 * np.random.randn(num_states))
+
+        mn.create_matrices()
+        return mn
+
+    def test_fingerprint(self):
+        """Test that models with the same structure share a fingerprint and models with different ones do not."""
+        mn = self.create_grid_model(4, 3)
+
+        assert MessageStore.fingerprint(mn) == MessageStore.fingerprint(self.create_grid_model(4, 3, seed=1))
+        assert MessageStore.fingerprint(mn) != MessageStore.fingerprint(self.create_grid_model(5, 3))
+        assert MessageStore.fingerprint(mn) != MessageStore.fingerprint(self.create_grid_model(4, 2))
+
+    def test_eviction_and_copies(self):
+        """Test that the least recently used structure is evicted and that stored messages are copies."""
+        store = MessageStore(capacity=2)
+        models = [self.create_grid_model(length, 2) for length in [2, 3, 4]]
+
+        for mn in models[:2]:
+            store.save(mn, np.ones((mn.max_states, 2 * mn.num_edges)))
+
+        # loading the first structure makes the second one the least recently used
+        messages = store.load(models[0])
+        messages[:] = 5
+        assert np.all(store.load(models[0]) == 1), "Modifying loaded messages changed the stored messages"
+
+        store.save(models[2], np.ones((models[2].max_states, 2 * models[2].num_edges)))
+
+        assert len(store) == 2
+        assert models[0] in store and models[2] in store
+        assert store.load(models[1]) is None, "Least recently used messages were not evicted"
+
+    def test_warm_start(self):
+        """Test that propagators for a sequence of similar models warm-start from the previous converged messages."""
+        store = MessageStore()
+        frames = [self.create_grid_model(8, 3, noise=frame) for frame in range(3)]
+
+        bp = MatrixBeliefPropagator(frames[0])
+        bp.set_message_store(store)
+        bp.infer(display='off')
+
+        assert frames[1] in store, "Converged messages were not saved"
+
+        for mn in frames[1:]:
+            bp = MatrixBeliefPropagator(mn)
+            bp.set_message_store(store)
+            bp.infer(display='off')
+
+            cold_bp = MatrixBeliefPropagator(mn)
+            cold_bp.infer(display='off')
+
+            assert bp.num_iterations < cold_bp.num_iterations, "Warm start did not reduce the number of iterations"
+            assert np.allclose(bp.message_mat, cold_bp.message_mat, atol=1e-5), "Warm start converged elsewhere"
+
+
+if __name__ == '__main__':
+    unittest.main()
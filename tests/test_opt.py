@@ -3,6 +3,8 @@ import unittest
 from mrftools import *
 import numpy as np
 import itertools
+import os
+import tempfile
 
 class TestOpt(unittest.TestCase):
     """Test class for optimizers"""
@@ -65,6 +67,69 @@ class TestOpt(unittest.TestCase):
             assert self.did_receive_grad_args and self.did_receive_obj_args, \
                 "Args were not properly passed for %s" % optimizer.__name__
 
+    def test_weight_record(self):
+        """Test that weight records store iterates in order, thin them, sample them, and spill them to disk"""
+        np.random.seed(0)
+        iterates = [np.random.randn(5) for _ in range(100)]
+
+        full = WeightRecord()
+        assert full.weight_record.size == 0 and full.time_record.size == 0, "New record was not empty"
+        full.callback(iterates[0])
+        assert full.weight_record.shape == (1, 5) and full.time_record.shape == (1,)
+        for x in iterates[1:]:
+            full.callback(x)
+        assert np.array_equal(full.weight_record, np.vstack(iterates)), "Full record did not store every iterate"
+        assert full.time_record.shape == (100, 1), "Time record shape changed"
+        assert np.all(np.diff(full.time_record[:, 0]) >= 0), "Time record was not in order"
+
+        thinned = WeightRecord(interval=7)
+        for x in iterates:
+            thinned.callback(x)
+        assert np.array_equal(thinned.weight_record, np.vstack(iterates[::7])), "Thinned record was wrong"
+        assert np.array_equal(thinned.iteration_record, np.arange(0, 100, 7)), "Thinned iterations were wrong"
+
+        sampled = WeightRecord(max_records=10)
+        random_state = np.random.get_state()[1].copy()
+        for x in iterates:
+            sampled.callback(x)
+        assert np.array_equal(np.random.get_state()[1], random_state), "Sampling changed the global random state"
+        assert sampled.weight_record.shape == (10, 5), "Reservoir did not bound the number of records"
+        assert np.all(np.diff(sampled.iteration_record) > 0), "Reservoir records were not in iteration order"
+        assert np.array_equal(sampled.weight_record, np.vstack(iterates)[sampled.iteration_record]), \
+            "Reservoir records did not match their iterations"
+
+        path = os.path.join(tempfile.mkdtemp(), 'weights.dat')
+        spilled = WeightRecord(path=path)
+        for x in iterates:
+            spilled.callback(x)
+        assert np.array_equal(spilled.weight_record, np.vstack(iterates)), "Memory-mapped record was wrong"
+        assert os.path.getsize(path) >= 100 * 5 * 8, "Weights were not stored in the file"
+
+    def test_objective_monitor(self):
+        """Test that the objective monitor records the values the optimizer computed without extra evaluations"""
+        self.values = []
+
+        def counting_objective(x, args=None):
+            self.values.append(objective(x))
+            return self.values[-1]
+
+        path = os.path.join(tempfile.mkdtemp(), 'monitor.tsv')
+        records = []
+
+        for sink in [path, records.append]:
+            self.values = []
+            with ObjectiveMonitor(sink=sink) as monitor:
+                func, grad = monitor.wrap(counting_objective, gradient)
+                ada_grad(func, grad, np.zeros(3), {'max_iter': 50}, callback=monitor.callback)
+
+            assert len(self.values) == 49, "Monitoring re-evaluated the objective"
+            assert monitor.objectives == self.values, "Monitor did not record the computed objective values"
+
+        with open(path) as f:
+            assert len(f.readlines()) == 49, "Monitor did not write every record to the file"
+        assert len(records) == 49 and records[0]['objective'] == monitor.objectives[0], \
+            "Monitor did not pass records to the sink function"
+
 
 def objective(x, args=None):
     """
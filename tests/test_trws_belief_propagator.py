@@ -0,0 +1,183 @@
+"""Test class for sequential tree-reweighted message passing"""
+import itertools
+import numpy as np
+from mrftools import *
+import unittest
+
+
+class TestTRWSBeliefPropagator(unittest.TestCase):
+    """Test class for sequential tree-reweighted message passing"""
+    def create_chain_model(self):
+        """Create chain-structured MRF with different cardinalities."""
+        mn = MarkovNet()
+
+        np.random.seed(1)
+
+        k = [4, 3, 6, 2, 5]
+
+        mn.set_unary_factor(0, np.random.randn(k[0]))
+        mn.set_unary_factor(1, np.random.randn(k[1]))
+        mn.set_unary_factor(2, np.random.randn(k[2]))
+        mn.set_unary_factor(3, np.random.randn(k[3]))
+
+        factor4 = np.random.randn(k[4])
+        factor4[2] = -float('inf')
+
+        mn.set_unary_factor(4, factor4)
+
+        mn.set_edge_factor((0, 1), np.random.randn(k[0], k[1]))
+        mn.set_edge_factor((1, 2), np.random.randn(k[1], k[2]))
+        mn.set_edge_factor((2, 3), np.random.randn(k[2], k[3]))
+        mn.set_edge_factor((3, 4), np.random.randn(k[3], k[4]))
+        mn.create_matrices()
+
+        return mn
+
+    def create_grid_model(self, length, num_states):
+        """Create a grid-structured MRF with random potentials."""
+        mn = MarkovNet()
+
+        np.random.seed(0)
+
+        for x in range(length):
+            for y in range(length):
+                mn.set_unary_factor((x, y), np.random.randn(num_states))
+
+        for x in range(length):
+            for y in range(length):
+                for neighbor in [(x + 1, y), (x, y + 1)]:
+                    if neighbor[0] < length and neighbor[1] < length:
+                        mn.set_edge_factor(((x, y), neighbor), np.random.randn(num_states, num_states))
+
+        mn.create_matrices()
+        return mn
+
+    def get_score(self, bp):
+        """Compute the log score of the decoded state."""
+        bp.load_beliefs()
+        states = dict((var, int(np.argmax(bp.var_beliefs[var]))) for var in bp.mn.variables)
+        return bp.mn.evaluate_state(states)
+
+    def brute_force_score(self, mn):
+        """Find the best score by trying every state."""
+        variables = mn.var_list
+        return max(mn.evaluate_state(dict(zip(variables, states)))
+                   for states in itertools.product(*[range(mn.num_states[var]) for var in variables]))
+
+    def test_exactness(self):
+        """Test that TRW-S finds the MAP state and a tight bound on a chain."""
+        mn = self.create_chain_model()
+        bp = TRWSBeliefPropagator(mn)
+        bp.infer(display='full')
+
+        best_score = self.brute_force_score(mn)
+
+        assert np.allclose(self.get_score(bp), best_score), "TRW-S did not find the MAP state of a chain"
+        assert np.allclose(bp.bounds[-1], best_score), "TRW-S bound is not tight on a chain"
+        assert bp.num_iterations <= 3, "TRW-S took more than one sweep to converge on a chain"
+
+    def test_monotone_bound(self):
+        """Test that the bound never increases and always bounds the MAP score on a loopy graph."""
+        mn = self.create_grid_model(3, 3)
+        bp = TRWSBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        best_score = self.brute_force_score(mn)
+
+        assert len(bp.bounds) == bp.num_iterations, "Bound was not recorded every sweep"
+        assert np.all(np.diff(bp.bounds) <= 1e-8), "TRW-S bound increased"
+        assert np.all(np.array(bp.bounds) >= best_score - 1e-8), "TRW-S bound is smaller than the MAP score"
+        assert self.get_score(bp) <= best_score + 1e-8
+
+    def test_sequential_equivalence(self):
+        """Test that updating wavefronts of variables together matches updating variables one at a time."""
+        mn = self.create_grid_model(4, 3)
+        bp = TRWSBeliefPropagator(mn)
+        bp.update_messages()
+
+        # run a sweep that processes one variable at a time in order
+        messages = np.zeros(bp.message_mat.shape)
+        order = [mn.var_index[var] for var in bp.order]
+        rank = dict((var, i) for i, var in enumerate(order))
+        num_edges = mn.num_edges
+        unary_mat = mn.unary_mat + bp.augmented_mat
+
+        for sweep_order, later in [(order, lambda s, t: rank[t] > rank[s]), (order[::-1], lambda s, t: rank[t] < rank[s])]:
+            for s in sweep_order:
+                belief = unary_mat[:, s] + messages[:, mn.message_to == s].sum(1)
+                for m in np.flatnonzero(mn.message_from == s):
+                    t = mn.message_to[m]
+                    if later(s, t):
+                        reverse = (m + num_edges) % (2 * num_edges)
+                        adjusted = bp.tree_probabilities[m] * belief - messages[:, reverse]
+                        new_message = (mn.edge_pot_tensor[:, :, m] + adjusted).max(1)
+                        messages[:, m] = new_message - new_message.max()
+
+        assert np.allclose(bp.message_mat, messages), "Wavefront updates differ from sequential updates"
+
+    def test_tree_probabilities(self):
+        """Test that TRW-S uses the Markov net's tree probabilities and still produces a valid bound."""
+        mn = self.create_grid_model(3, 2)
+        mn.tree_probabilities = ImageLoader.calculate_tree_probabilities_snake_shape(3, 3)
+
+        bp = TRWSBeliefPropagator(mn)
+        bp.infer(display='off')
+
+        edge, i = next(iter(mn.message_index.items()))
+        assert bp.tree_probabilities[i] in (mn.tree_probabilities.get(edge), mn.tree_probabilities.get(edge[::-1]))
+        assert bp.bounds[-1] >= self.brute_force_score(mn) - 1e-8
+
+    def test_fewer_iterations_than_max_product(self):
+        """Test that TRW-S converges in fewer sweeps than parallel max-product needs iterations on a loopy grid."""
+        mn = self.create_grid_model(8, 3)
+
+        trws = TRWSBeliefPropagator(mn)
+        trws.set_max_iter(300)
+        trws.infer(tolerance=1e-6, display='off')
+
+        bp = MaxProductBeliefPropagator(mn)
+        bp.set_max_iter(300)
+        bp.infer(tolerance=1e-6, display='off')
+
+        assert trws.num_iterations < bp.num_iterations
+        assert self.get_score(trws) >= self.get_score(bp) - 1e-8
+
+    def test_frustrated_grid(self):
+        """Test that TRW-S stops before max_iter with its default tolerance on a frustrated grid with non-Potts edges."""
+        mn = MarkovNet()
+
+        np.random.seed(2)
+        length = 20
+
+        for x in range(length):
+            for y in range(length):
+                mn.set_unary_factor((x, y), 0.5 * np.random.randn(4))
+
+        # strong random edge potentials whose preferred pairs of states disagree around most cycles
+        for x in range(length):
+            for y in range(length):
+                for neighbor in [(x + 1, y), (x, y + 1)]:
+                    if neighbor[0] < length and neighbor[1] < length:
+                        mn.set_edge_factor(((x, y), neighbor), 2 * np.random.randn(4, 4))
+
+        mn.create_matrices()
+
+        bp = TRWSBeliefPropagator(mn)
+        bp.set_max_iter(300)
+        bp.infer(display='off')
+
+        assert bp.num_iterations < 300, "TRW-S ran until max_iter on a frustrated grid"
+        assert np.all(np.diff(bp.bounds) <= 1e-8), "TRW-S bound increased"
+        assert bp.bounds[-1] >= self.get_score(bp) - 1e-8, "TRW-S bound is smaller than the decoded score"
+
+        # a tighter tolerance keeps improving the bound
+        tight_bp = TRWSBeliefPropagator(mn)
+        tight_bp.set_max_iter(300)
+        tight_bp.infer(tolerance=1e-7, display='off')
+
+        assert tight_bp.num_iterations > bp.num_iterations
+        assert tight_bp.bounds[-1] <= bp.bounds[-1]
+
+
+if __name__ == '__main__':
+    unittest.main()